@@ -0,0 +1,217 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Re-run the processing stages on every *_results.yaml found under a logs tree"""
+
+import os
+import sys
+import glob
+import time
+import yaml
+import queue as queue_lib
+import argparse
+import traceback
+import multiprocessing as mp
+# tell matplotlib not to try to load up GTK as it returns errors over ssh
+from matplotlib import use as plt_use
+plt_use("Agg")
+
+from utils import log_utils
+from utils import plot_utils
+from utils import stage_utils
+from utils.stage_utils import STAGES
+
+
+def find_jobs(root):
+    '''List the results yaml files under root'''
+    return sorted(glob.glob(os.path.join(root, '**', '*_results.yaml'), recursive=True))
+
+
+def run_job(yaml_file, stages, use_cache, force, out_file, queue):
+    '''Worker: run the stages on one yaml file, reporting each stage outcome on queue.
+    Everything printed by the stages goes to out_file'''
+    job = yaml_file
+    with open(out_file, 'w') as out:
+        sys.stdout = out
+        sys.stderr = out
+        try:
+            logs = stage_utils.log_files(yaml_file)
+        except Exception as e:
+            queue.put((job, stages[0], 'failed', 0., str(e)))
+            return
+        for stage in stages:
+            missing = [logs[name] for name in STAGES[stage]['logs'] if not os.path.isfile(logs[name])]
+            if missing:
+                print('[i] Skipping ' + stage + ', missing: ' + ', '.join(missing))
+                queue.put((job, stage, 'skipped', 0., 'missing ' + ', '.join(os.path.basename(m) for m in missing)))
+                continue
+            queue.put((job, stage, 'running', 0., ''))
+            print('[i] Starting ' + stage)
+            t0 = time.perf_counter()
+            try:
+                yaml_file, ran = stage_utils.run_stage(stage, yaml_file, use_cache=use_cache, force=force)
+                # a job is a child process, which draws its figures itself as the stage goes (see plot_utils.render):
+                # the stage time and errors include them, the jobs running in parallel with each other
+                plot_utils.flush()
+            except Exception as e:
+                traceback.print_exc()
+                queue.put((job, stage, 'failed', time.perf_counter() - t0, f'{type(e).__name__}: {e}'))
+                # later stages depend on the results of the earlier ones
+                return
+            out.flush()
+            queue.put((job, stage, 'ok' if ran else 'unchanged', time.perf_counter() - t0, ''))
+
+
+def load_state(state_file):
+    if not os.path.isfile(state_file):
+        return {}
+    with open(state_file) as f:
+        try:
+            return yaml.safe_load(f) or {}
+        except Exception:
+            raise Exception('error in yaml parsing')
+
+
+def save_state(state_file, state):
+    log_utils.save_yaml(state_file, state)
+
+
+def print_summary(jobs, stages, state):
+    colors = {'ok': plot_utils.bcolors.OKGREEN,
+              'unchanged': plot_utils.bcolors.OKGREEN,
+              'skipped': plot_utils.bcolors.OKBLUE,
+              'failed': plot_utils.bcolors.FAIL,
+              'timeout': plot_utils.bcolors.FAIL}
+    name_width = max([len(os.path.basename(j)) for j in jobs] + [4])
+    print(f"{'file':<{name_width}}  " + ''.join(f'{s:>11}' for s in stages))
+    for yaml_file in jobs:
+        row = f'{os.path.basename(yaml_file):<{name_width}}  '
+        for stage in stages:
+            entry = state.get(yaml_file, {}).get(stage)
+            if entry is None:
+                row += f"{'-':>11}"
+            elif entry['status'] == 'ok':
+                row += colors['ok'] + f"{entry['time']:>10.1f}s" + plot_utils.bcolors.ENDC
+            else:
+                row += colors[entry['status']] + f"{entry['status']:>11}" + plot_utils.bcolors.ENDC
+        print(row)
+
+    count = {}
+    for yaml_file in jobs:
+        for stage in stages:
+            status = state.get(yaml_file, {}).get(stage, {'status': '-'})['status']
+            count[status] = count.get(status, 0) + 1
+    print(', '.join(f'{n} {s}' for s, n in sorted(count.items())))
+    for yaml_file in jobs:
+        for stage in stages:
+            entry = state.get(yaml_file, {}).get(stage)
+            if entry is not None and entry['status'] in ('failed', 'timeout'):
+                print(colors['failed'] + f"[✗] {os.path.basename(yaml_file)} {stage}: {entry['message']}" + plot_utils.bcolors.ENDC)
+
+
+def process(root='/logs', stages=None, jobs=None, timeout=None, resume=False, state_file=None, use_cache=True, force=False):
+    '''Run the selected stages on every results yaml under root, one yaml per worker process.
+    A job running longer than timeout seconds is killed; with resume, the stages that already
+    succeeded in a previous run (as recorded in state_file) are not run again.
+    Stages whose inputs did not change since they last ran are skipped too, unless force is set'''
+    if stages is None:
+        stages = list(STAGES)
+    for stage in stages:
+        if stage not in STAGES:
+            raise Exception(f"unknown stage '{stage}'")
+    stages = [s for s in STAGES if s in stages]
+    if jobs is None:
+        jobs = os.cpu_count()
+    if state_file is None:
+        state_file = os.path.join(root, 'batch_process.yaml')
+
+    all_jobs = find_jobs(root)
+    print(f'[i] Found {len(all_jobs)} results files in {root}')
+    state = load_state(state_file) if resume else {}
+
+    todo = []
+    for yaml_file in all_jobs:
+        done = state.get(yaml_file, {})
+        job_stages = [s for s in stages if not (resume and done.get(s, {}).get('status') in ('ok', 'unchanged'))]
+        if job_stages:
+            todo.append((yaml_file, job_stages))
+    if resume:
+        print(f'[i] Resuming: {len(all_jobs) - len(todo)} files already done')
+
+    running = {}
+    current = {}
+    finished = 0
+
+    def collect(job_queue, timeout=0.):
+        # queue.empty() is not reliable: get returns the messages already sent, waiting up to timeout for the first one
+        while True:
+            try:
+                job, stage, status, elapsed, message = job_queue.get(timeout=timeout)
+            except queue_lib.Empty:
+                return
+            timeout = 0.
+            current[job] = stage
+            if status != 'running':
+                state.setdefault(job, {})[stage] = {'status': status, 'time': float(elapsed), 'message': message}
+
+    while todo or running:
+        while todo and len(running) < jobs:
+            yaml_file, job_stages = todo.pop(0)
+            out_file = yaml_file[:-len('_results.yaml')] + '_batch-process.log'
+            # one queue per job: a job killed while sending cannot corrupt the messages of the others
+            job_queue = mp.Queue()
+            p = mp.Process(target=run_job, args=(yaml_file, job_stages, use_cache, force, out_file, job_queue))
+            p.start()
+            running[yaml_file] = (p, job_queue, time.monotonic())
+
+        time.sleep(0.1)
+        for yaml_file, (p, job_queue, t_start) in list(running.items()):
+            collect(job_queue)
+            if p.is_alive() and timeout is not None and time.monotonic() - t_start > timeout:
+                # the results yaml files are written atomically, so killing the job cannot truncate them
+                p.terminate()
+                p.join()
+                state.setdefault(yaml_file, {})[current.get(yaml_file, stages[0])] = \
+                    {'status': 'timeout', 'time': float(timeout), 'message': f'killed after {timeout}s'}
+            elif p.is_alive():
+                continue
+            else:
+                # the job exited: everything it sent is already in the queue
+                collect(job_queue, timeout=0.1)
+                p.join()
+            job_queue.close()
+            del running[yaml_file]
+            finished += 1
+            print(f'[i] [{finished}/{finished + len(running) + len(todo)}] Done: {yaml_file}')
+            save_state(state_file, state)
+
+    save_state(state_file, state)
+    print_summary(all_jobs, stages, state)
+    print('[i] Saved batch state in: ' + state_file)
+    return state
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-process every calibration found under a logs tree")
+    parser.add_argument('root', type=str, nargs='?', default='/logs', help="the logs tree to search for *_results.yaml (default: /logs)")
+    parser.add_argument('-s', '--stages', type=str, nargs='+', choices=list(STAGES), default=list(STAGES), help="the stages to run (default: all)")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="number of worker processes (default: number of cores)")
+    parser.add_argument('-t', '--timeout', type=float, default=None, help="seconds after which a job is killed")
+    parser.add_argument('-r', '--resume', action='store_true', help="skip the stages that succeeded in the previous run")
+    parser.add_argument('--state-file', type=str, default=None, help="where the outcome of each stage is stored (default: <root>/batch_process.yaml)")
+    parser.add_argument('-f', '--force', action='store_true', help="run the stages even if their inputs did not change")
+    parser.add_argument('--no-cache', action='store_true', help="do not use the parsed log caches")
+    args = parser.parse_args()
+
+    plot_utils.print_alberobotics()
+    state = process(root=args.root,
+                    stages=args.stages,
+                    jobs=args.jobs,
+                    timeout=args.timeout,
+                    resume=args.resume,
+                    state_file=args.state_file,
+                    use_cache=not args.no_cache,
+                    force=args.force)
+
+    if any(entry['status'] in ('failed', 'timeout') for job in state.values() for entry in job.values()):
+        sys.exit(plot_utils.bcolors.FAIL + u'[✗] Some stages failed' + plot_utils.bcolors.ENDC)
+    print(plot_utils.bcolors.OKGREEN + u'[✓] Ending program successfully' + plot_utils.bcolors.ENDC)
@@ -5,7 +5,10 @@ import os
 import sys
 import glob
 import yaml
+import shutil
+import argparse
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 # tell matplotlib not to try to load up GTK as it returns errors over ssh
 from matplotlib import use as plt_use
 plt_use("Agg")
@@ -20,6 +23,7 @@ from utils import process_frequency
 from utils import process_report
 from utils import plot_utils
 from utils import move_utils
+from utils import stage_utils
 from utils import database_utils
 from utils.prompt_utils import single_yes_or_no_question as prompt_user
 
@@ -47,6 +51,68 @@ config_file = os.path.expanduser('~/ecat_dev_old/ec_master_app/examples/motor-ca
 # path to credentials to connect to the motors' database
 credentials_file = os.path.expanduser('~/ecat_dev_old/motor_calibration')
 
+parser = argparse.ArgumentParser()
+parser.add_argument('-p', '--pipeline', action='store_true',
+                    help="process the data of each test in the background while the next test runs")
+args = parser.parse_args()
+
+# In pipeline mode the processing of a test is queued on a single background worker, so that the
+# stages still run one at a time and in order (friction needs the ripple results, the report all of them).
+# The test executables read and write config_file, so a stage works on its own copy of it while the
+# next test runs, and its results are merged back into config_file between tests.
+pipeline = ProcessPoolExecutor(max_workers=1) if args.pipeline else None
+pending = []
+merged = []
+
+def run_processing(name, stage, process, wait=False, **kwargs):
+    '''Run process(**kwargs), in the background in pipeline mode unless wait is set'''
+    print(plot_utils.bcolors.OKBLUE + f"[i] Processing {name} data" + plot_utils.bcolors.ENDC)
+    if pipeline is None:
+        return process(**kwargs)
+    if not wait:
+        # without log location and name the processing moves the yaml file, and the next test needs the new one
+        with open(kwargs['yaml_file']) as f:
+            log_dict = yaml.safe_load(f).get('log', {})
+        wait = not ('location' in log_dict and 'name' in log_dict)
+    if wait:
+        # on config_file itself, once the stages queued before are merged into it
+        wait_processing()
+        pending.append((name, None, None, pipeline.submit(plot_utils.call_and_flush, process, **kwargs)))
+        return wait_processing()
+    # a copy next to config_file, so that the logs are found the same way
+    yaml_file = kwargs['yaml_file']
+    work_file = yaml_file[:-len('.yaml')] + f'_{stage}-pipeline.yaml'
+    shutil.copyfile(yaml_file, work_file)
+    earlier = [(s, f) for _, s, f, _ in pending if s is not None]
+    kwargs['yaml_file'] = work_file
+    pending.append((name, stage, work_file, pipeline.submit(stage_utils.process_copy, process, earlier=earlier, **kwargs)))
+    print(plot_utils.bcolors.OKBLUE + f"[i] Processing {name} data in the background" + plot_utils.bcolors.ENDC)
+    return yaml_file
+
+def merge_processing(block=False):
+    '''Merge the results of the ended processing into config_file, in order (with block, wait for all of them).
+    Called between tests only, as the test executables rewrite config_file. Returns the result of the last one'''
+    ret = None
+    while pending and (block or pending[0][3].done()):
+        name, stage, work_file, future = pending.pop(0)
+        try:
+            ret = future.result()
+        except Exception as e:
+            sys.exit(plot_utils.bcolors.FAIL + f"[\u2717] Error while processing {name} data: {e}" + plot_utils.bcolors.ENDC)
+        if stage is not None:
+            stage_utils.merge_outputs(stage, work_file, config_file)
+            merged.append(work_file)
+        print(plot_utils.bcolors.OKBLUE + f"[i] Ended processing {name} data" + plot_utils.bcolors.ENDC)
+    if not pending:
+        # the later stages merge the copies of the earlier ones, until none is left in the queue
+        while merged:
+            os.remove(merged.pop())
+    return ret
+
+def wait_processing():
+    '''Wait for the queued processing to end and merge its results, returns the result of the last one'''
+    return merge_processing(block=True)
+
 #print logo
 plot_utils.print_alberobotics()
 
@@ -65,13 +131,13 @@ if not prompt_user("""[?] Run phase angle calibration?"""):
     print(plot_utils.bcolors.OKBLUE + "[i] Skipping phase-calib" + plot_utils.bcolors.ENDC)
 else:
     print(plot_utils.bcolors.OKBLUE + "[i] Starting phase-calib" + plot_utils.bcolors.ENDC)
+    merge_processing()
     if os.system(cmd1 + ' ' + config_file):
         sys.exit(plot_utils.bcolors.FAIL + u'[\u2717] Error during phase-calib' + plot_utils.bcolors.ENDC)
     print(plot_utils.bcolors.OKBLUE + "[i] Ended phase-calib successfully" + plot_utils.bcolors.ENDC)
 
-    # process extracted data
-    print(plot_utils.bcolors.OKBLUE + "[i] Processing phase data" + plot_utils.bcolors.ENDC)
-    config_file = process_phase.process(yaml_file=config_file, plot_all=False)
+    # process extracted data, set-phase needs the result
+    config_file = run_processing('phase', 'phase', process_phase.process, wait=True, yaml_file=config_file, plot_all=False)
 
     # Upload to motor the best phase angle
     print(plot_utils.bcolors.OKBLUE + "[i] Sending phase angle to motor using set-phase" +  plot_utils.bcolors.ENDC)
@@ -91,13 +157,13 @@ Continue?"""):
 
     #run test
     print(plot_utils.bcolors.OKBLUE + "[i] Starting torque-calib" + plot_utils.bcolors.ENDC)
+    merge_processing()
     if os.system(cmd2 + ' ' + config_file):
         sys.exit(plot_utils.bcolors.FAIL + u'[\u2717] Error during torque-calib' + plot_utils.bcolors.ENDC)
     print(plot_utils.bcolors.OKBLUE + "[i] Ended torque-calib successfully" + plot_utils.bcolors.ENDC)
 
-    # process extracted data
-    print(plot_utils.bcolors.OKBLUE + "[i] Processing torque data" + plot_utils.bcolors.ENDC)
-    config_file = process_torque.process(yaml_file=config_file, plot_all=False)
+    # process extracted data, set-torque needs the result
+    config_file = run_processing('torque', 'torque', process_torque.process, wait=True, yaml_file=config_file, plot_all=False)
 
     # Upload to motor the updated torsion bar stiffness (and torque constant?)
     print(plot_utils.bcolors.OKBLUE + "[i] Sending torsion bar stiffness to motor using set-torque" +  plot_utils.bcolors.ENDC)
@@ -118,13 +184,13 @@ Continue?"""):
 
     # run test
     print(plot_utils.bcolors.OKBLUE + "[i] Starting ripple-calib" + plot_utils.bcolors.ENDC)
+    merge_processing()
     if os.system(cmd3 + ' ' + config_file):
         sys.exit(plot_utils.bcolors.FAIL + u'[\u2717] Error during ripple-calib' + plot_utils.bcolors.ENDC)
     print(plot_utils.bcolors.OKBLUE + "[i] Ended ripple-calib successfully" + plot_utils.bcolors.ENDC)
 
     # process extracted data
-    print(plot_utils.bcolors.OKBLUE + "[i] Processing ripple data" + plot_utils.bcolors.ENDC)
-    config_file = process_ripple.process(yaml_file=config_file, plot_all=False)
+    config_file = run_processing('ripple', 'ripple', process_ripple.process, yaml_file=config_file, plot_all=False)
 
 ## Friction identification
 if not prompt_user("""[?] Run inertia and friction identification?"""):
@@ -138,6 +204,7 @@ else:
             pass
 
     print(plot_utils.bcolors.OKBLUE + "[i] Starting friction-calib" + plot_utils.bcolors.ENDC)
+    merge_processing()
     if os.system(cmd4 + ' ' + config_file):
         sys.exit(plot_utils.bcolors.FAIL + u'[\u2717] Error during friction-calib' + plot_utils.bcolors.ENDC)
     print(plot_utils.bcolors.OKBLUE + "[i] Ended friction-calib successfully" + plot_utils.bcolors.ENDC)
@@ -146,12 +213,11 @@ else:
     print(plot_utils.bcolors.OKBLUE + "[i] Starting inertia-calib" + plot_utils.bcolors.ENDC)
     if os.system(cmd4b + ' ' + config_file):
         sys.exit(plot_utils.bcolors.FAIL + u'[\u2717] Error during inertia-calib' + plot_utils.bcolors.ENDC)
-    move_utils.move_log(yaml_file=config_file)
+    config_file = move_utils.move_log(yaml_file=config_file)
     print(plot_utils.bcolors.OKBLUE + "[i] Ended inertia-calib successfully" + plot_utils.bcolors.ENDC)
 
     # process extracted data
-    print(plot_utils.bcolors.OKBLUE + "[i] Processing friction and inertia data" + plot_utils.bcolors.ENDC)
-    process_friction.process(yaml_file=config_file, plot_all=False)
+    run_processing('friction and inertia', 'friction', process_friction.process, yaml_file=config_file, plot_all=False)
 
 ## Frequency response calibration
 if not prompt_user("""[?] Run frequency response calibration?"""):
@@ -165,14 +231,20 @@ Continue?"""):
 
     # run test
     print(plot_utils.bcolors.OKBLUE + "[i] Starting frequency-calib" + plot_utils.bcolors.ENDC)
+    merge_processing()
     if os.system(cmd5 + ' ' + config_file):
         sys.exit(plot_utils.bcolors.FAIL + u'[\u2717] Error during frequency-calib' + plot_utils.bcolors.ENDC)
-    move_utils.move_log(yaml_file=config_file)
+    config_file = move_utils.move_log(yaml_file=config_file)
     print(plot_utils.bcolors.OKBLUE + "[i] Ended frequency-calib successfully" + plot_utils.bcolors.ENDC)
 
     # process extracted data
-    print(plot_utils.bcolors.OKBLUE + "[i] Processing frequency response data" + plot_utils.bcolors.ENDC)
-    process_frequency.process(yaml_file=config_file, plot_all=False)
+    run_processing('frequency response', 'frequency', process_frequency.process, yaml_file=config_file, plot_all=False)
+
+# the report and the database need the results of every test
+wait_processing()
+plot_utils.flush()
+if pipeline is not None:
+    pipeline.shutdown()
 
 # generate report
 if not prompt_user("""[?] Genereate the report?"""):
@@ -0,0 +1,242 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Calibrate several actuators at once, one process per bench/slave, with a live status board"""
+
+import os
+import re
+import sys
+import time
+import yaml
+import argparse
+import traceback
+import queue as queue_lib
+import subprocess
+import multiprocessing as mp
+# tell matplotlib not to try to load up GTK as it returns errors over ssh
+from matplotlib import use as plt_use
+plt_use("Agg")
+
+#import costum files
+from utils import plot_utils
+from utils import move_utils
+from utils import stage_utils
+
+# executables, relative to bin_dir (same layout as the ec_master_app build used by motor_calibration.py)
+BIN_DIR = '~/ecat_dev_old/ec_master_app/build/examples/motor-calib'
+CMD = {
+    'test-pdo':       'calib-test-pdo/calib-test-pdo',
+    'phase-calib':    'phase-calib/phase-calib',
+    'set-phase':      'set-phase/set-phase',
+    'torque-calib':   'torque-calib/torque-calib',
+    'set-torque':     'set-torque/set-torque',
+    'ripple-calib':   'ripple-calib/ripple-calib',
+    'friction-calib': 'friction-calib/friction-calib',
+    'inertia-calib':  'inertia-calib/inertia-calib',
+    'frequency-calib':'frequency-calib/frequency-calib',
+}
+ESC_LOG = '/tmp/CentAcESC_*_log.txt'
+
+# tests in the order they are run: the acquisition, the processing stage that follows it and
+# the executable sending its result to the motor
+TESTS = {
+    'phase':     {'cmd': ['phase-calib'],                     'stage': 'phase',     'set': 'set-phase'},
+    'torque':    {'cmd': ['torque-calib'],                    'stage': 'torque',    'set': 'set-torque'},
+    'ripple':    {'cmd': ['ripple-calib'],                    'stage': 'ripple',    'set': None},
+    'friction':  {'cmd': ['friction-calib', 'inertia-calib'], 'stage': 'friction',  'set': None},
+    'frequency': {'cmd': ['frequency-calib'],                 'stage': 'frequency', 'set': None},
+    'report':    {'cmd': [],                                  'stage': 'report',    'set': None},
+}
+
+
+def load_runs(runs_file):
+    '''Read the list of runs. Each run needs a name and a config file; optional fields are
+    results (the results yaml test-pdo creates for this config, default the path it prints),
+    esc_log (pattern of the CentAcESC log of this slave, default any) and tests (default all).
+    The CentAcESC logs are written in /tmp by the tests of every run: when several runs run tests,
+    each of them needs its own esc_log pattern, matching the log of its slave only'''
+    with open(runs_file) as f:
+        try:
+            runs_dict = yaml.safe_load(f)
+        except Exception:
+            raise Exception('error in yaml parsing')
+    if not 'runs' in runs_dict:
+        raise Exception("missing 'runs' in yaml parsing")
+
+    runs = []
+    for run in runs_dict['runs']:
+        if not ('name' in run and 'config' in run):
+            raise Exception("every run needs a 'name' and a 'config'")
+        run = dict(run)
+        run['config'] = os.path.expanduser(run['config'])
+        if 'results' in run:
+            run['results'] = os.path.expanduser(run['results'])
+        run.setdefault('esc_log', ESC_LOG)
+        run.setdefault('tests', list(TESTS))
+        for test in run['tests']:
+            if test not in TESTS:
+                raise Exception(f"unknown test '{test}' in run '{run['name']}'")
+        runs.append(run)
+    if len(set(run['name'] for run in runs)) != len(runs):
+        raise Exception('run names must be unique')
+    testing = [run for run in runs if any(TESTS[test]['cmd'] for test in run['tests'])]
+    if len(testing) > 1:
+        patterns = [run['esc_log'] for run in testing]
+        if ESC_LOG in patterns or len(set(patterns)) != len(patterns):
+            raise Exception("runs testing at once need an esc_log pattern each, matching only the CentAcESC log of their slave")
+    return runs_dict.get('bin_dir', BIN_DIR), runs
+
+
+def find_results(output, results=None):
+    '''Results yaml created by test-pdo: the given one, or else the last *_results.yaml path test-pdo printed.
+    Each run knows its own yaml this way, also when several runs save theirs in the same directory at once'''
+    if results is None:
+        printed = re.findall(r'(\S+_results\.yaml)', output)
+        if not printed:
+            raise Exception('test-pdo did not print the path of the results yaml')
+        results = printed[-1]
+    if not os.path.isfile(results):
+        raise Exception('no results yaml created in ' + results)
+    return results
+
+
+def run_calibration(run, bin_dir, out_file, queue):
+    '''Worker: run the tests of one actuator, reporting its progress on queue.
+    Everything printed (also by the executables) goes to out_file'''
+    name = run['name']
+
+    def status(step, state='running', message=''):
+        queue.put((name, step, state, message))
+
+    with open(out_file, 'w') as out:
+        sys.stdout = out
+        sys.stderr = out
+
+        def execute(cmd, yaml_file):
+            '''Run cmd on yaml_file, returning what it printed (also saved in out_file)'''
+            print(f'[i] Starting {cmd}', flush=True)
+            proc = subprocess.run([os.path.join(bin_dir, CMD[cmd]), yaml_file], stdout=subprocess.PIPE,
+                                  stderr=subprocess.STDOUT, universal_newlines=True)
+            out.write(proc.stdout)
+            if proc.returncode:
+                raise Exception(f'Error during {cmd}')
+            print(f'[i] Ended {cmd} successfully', flush=True)
+            return proc.stdout
+
+        step = 'test-pdo'
+        try:
+            # test-pdo creates the results yaml and prints its path
+            status(step)
+            yaml_file = find_results(execute(step, run['config']), run.get('results'))
+            status(step, message=os.path.basename(yaml_file))
+
+            for test in [t for t in TESTS if t in run['tests']]:
+                for cmd in TESTS[test]['cmd']:
+                    step = cmd
+                    status(step)
+                    if cmd == 'inertia-calib':
+                        # the log is handed over in /tmp: the newest one of this slave (see load_runs) written by this test
+                        t0 = time.time()
+                        execute(cmd, yaml_file)
+                        yaml_file = move_utils.move_log(yaml_file=yaml_file, tmp_pattern=run['esc_log'], newer_than=t0)
+                    else:
+                        execute(cmd, yaml_file)
+
+                # a run is a child process: its figures are drawn during the processing (see plot_utils.render),
+                # while the other runs go on with their tests
+                step = 'process ' + test
+                status(step)
+                yaml_file, _ = stage_utils.run_stage(TESTS[test]['stage'], yaml_file, force=True)
+                sys.stdout.flush()
+
+                if TESTS[test]['set'] is not None:
+                    step = TESTS[test]['set']
+                    status(step)
+                    execute(step, yaml_file)
+
+        except (Exception, SystemExit) as e:
+            traceback.print_exc()
+            status(step, 'failed', str(e))
+            return
+        status('done', 'ok', yaml_file)
+
+
+def print_board(runs, board, redraw):
+    colors = {'running': plot_utils.bcolors.OKBLUE,
+              'ok': plot_utils.bcolors.OKGREEN,
+              'failed': plot_utils.bcolors.FAIL}
+    name_width = max(len(run['name']) for run in runs)
+    if redraw:
+        # go back to the top of the previous board
+        sys.stdout.write('\033[F' * len(runs))
+    now = time.monotonic()
+    for run in runs:
+        step, state, message, t_start = board[run['name']]
+        line = f"{run['name']:<{name_width}}  {colors.get(state, '')}{state:<8}{plot_utils.bcolors.ENDC}" \
+               f"  {step:<18} {now - t_start:7.0f}s  {message}"
+        sys.stdout.write('\033[K' + line[:200] + '\n')
+    sys.stdout.flush()
+
+
+def process(runs_file, bin_dir=None):
+    '''Run the calibration of every actuator listed in runs_file concurrently.
+    Returns, for each run, its final status and its results yaml (None if it failed)'''
+    runs_bin_dir, runs = load_runs(runs_file)
+    bin_dir = os.path.expanduser(bin_dir if bin_dir is not None else runs_bin_dir)
+    out_base = os.path.splitext(runs_file)[0]
+
+    queue = mp.Queue()
+    board = {run['name']: ('waiting', 'waiting', '', time.monotonic()) for run in runs}
+    workers = []
+    for run in runs:
+        out_file = f"{out_base}_{run['name']}.log"
+        print(f"[i] {run['name']}: using {run['config']}, output in {out_file}")
+        p = mp.Process(target=run_calibration, args=(run, bin_dir, out_file, queue))
+        p.start()
+        workers.append(p)
+
+    results = {run['name']: None for run in runs}
+
+    def collect(timeout):
+        # queue.empty() is not reliable: get waits up to timeout for the first message, then takes the ones already there
+        changed = False
+        while True:
+            try:
+                name, step, state, message = queue.get(timeout=timeout)
+            except queue_lib.Empty:
+                return changed
+            timeout = 0.
+            if step != board[name][0]:
+                board[name] = (step, state, message, time.monotonic())
+            else:
+                board[name] = (step, state, message, board[name][3])
+            if step == 'done':
+                results[name] = message
+            changed = True
+
+    tty = sys.stdout.isatty()
+    redraw = False
+    while any(p.is_alive() for p in workers):
+        if collect(0.5) or tty:
+            print_board(runs, board, redraw and tty)
+            redraw = True
+    # the workers exited: what they sent is already in the queue
+    collect(0.1)
+    for p in workers:
+        p.join()
+    print_board(runs, board, redraw and tty)
+
+    return {name: {'status': entry[1], 'results': results[name]} for name, entry in board.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calibrate several actuators concurrently")
+    parser.add_argument('runs_file', type=str, help="yaml listing the runs (name, config and optionally results, esc_log, tests)")
+    parser.add_argument('--bin-dir', type=str, default=None, help="directory of the motor-calib executables (e.g. stubs for testing)")
+    args = parser.parse_args()
+
+    plot_utils.print_alberobotics()
+    results = process(runs_file=args.runs_file, bin_dir=args.bin_dir)
+
+    if any(result['status'] != 'ok' for result in results.values()):
+        sys.exit(plot_utils.bcolors.FAIL + u'[✗] Some calibrations failed' + plot_utils.bcolors.ENDC)
+    print(plot_utils.bcolors.OKGREEN + u'[✓] Ended calibrations successfully' + plot_utils.bcolors.ENDC)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules import each other as `from utils import X`, as when run from the repo root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,89 @@
+import math
+
+import numpy as np
+from scipy.fftpack import fft
+from scipy.interpolate import interp1d
+
+from utils import bode_utils
+
+
+# reference: the list based implementation bode_utils had before it was vectorized
+def ref_mag2db(mag): return [20*math.log10(np.abs(m)) for m in mag]
+def ref_rangeFloat(start, stop, step): return [start+n*step for n in range(0,round((stop-start)/step))]
+
+def ref_resampleUniformedData(time, data, dt=None):
+    if dt==None:
+        dt  = np.mean(np.diff(time))
+    t_RS = ref_rangeFloat(min(time), max(time), dt)
+    data = interp1d(time, data)(t_RS)
+
+    return data, dt, t_RS
+
+def ref_bode(t, u, y, roi = [0.1, 100]):
+    u, dt, _  = ref_resampleUniformedData(t, u)
+    y, dt, _  = ref_resampleUniformedData(t, y, dt=dt)
+
+    Fs      = 1/dt
+    L       = len(t)
+    NFFT    = 2**bode_utils.nextpow2(L)
+    NFFT_2  = int(NFFT/2)
+    Y       = fft(y,NFFT)/L
+    f       = Fs/2*np.linspace(0, 1, NFFT_2)
+    U       = fft(u,NFFT)/L
+    H       = [y/u for y,u in zip(Y,U)]
+
+    mag     = [abs(h) for h in H[:NFFT_2]]
+    mag_db  = ref_mag2db(mag)
+    phase = np.unwrap([np.angle(h) for h in H[:NFFT_2]])
+
+    return f, mag_db, phase
+
+
+def chirp(samples=20000, seed=0):
+    '''Chirp through a second order system, sampled with a jittered (non uniform) time step'''
+    rng = np.random.default_rng(seed)
+    t = np.cumsum(1e-3 * (1 + 0.1 * rng.uniform(-1, 1, samples)))
+    t -= t[0]
+    u = np.sin(2 * np.pi * (0.1 * t + 2 * t**2))
+    # y'' + 2 zeta w y' + w^2 y = w^2 u, integrated with a semi-implicit Euler step
+    w, zeta = 2 * np.pi * 15, 0.2
+    y = np.zeros(samples)
+    v = 0.
+    for k in range(1, samples):
+        dt = t[k] - t[k-1]
+        v += dt * (w**2 * (u[k-1] - y[k-1]) - 2 * zeta * w * v)
+        y[k] = y[k-1] + dt * v
+    return t, u, y
+
+
+def test_resample_uniformed_data():
+    t, u, _ = chirp()
+    data, dt, t_RS = bode_utils.resampleUniformedData(t, u)
+    ref_data, ref_dt, ref_t_RS = ref_resampleUniformedData(t, u)
+    assert dt == ref_dt
+    np.testing.assert_allclose(t_RS, ref_t_RS, rtol=0, atol=1e-12)
+    np.testing.assert_allclose(data, ref_data, rtol=0, atol=1e-12)
+
+
+def test_resample_with_given_dt():
+    t, _, y = chirp()
+    data, dt, t_RS = bode_utils.resampleUniformedData(t, y, dt=2e-3)
+    ref_data, _, ref_t_RS = ref_resampleUniformedData(t, y, dt=2e-3)
+    assert dt == 2e-3
+    np.testing.assert_allclose(t_RS, ref_t_RS, rtol=0, atol=1e-12)
+    np.testing.assert_allclose(data, ref_data, rtol=0, atol=1e-12)
+
+
+def test_bode():
+    t, u, y = chirp()
+    f, mag_db, phase = bode_utils.bode(t, u, y)
+    ref_f, ref_mag_db, ref_phase = ref_bode(t, u, y)
+    assert isinstance(mag_db, np.ndarray) and isinstance(phase, np.ndarray)
+    np.testing.assert_allclose(f, ref_f, rtol=1e-12)
+    np.testing.assert_allclose(mag_db, ref_mag_db, rtol=0, atol=1e-9)
+    np.testing.assert_allclose(phase, ref_phase, rtol=0, atol=1e-9)
+
+
+def test_mag2db():
+    mag = np.array([1e-3, 0.5, 1., 2., 1e3]) * np.exp(1j * np.linspace(0, 3, 5))
+    np.testing.assert_allclose(bode_utils.mag2db(mag), ref_mag2db(mag), rtol=1e-14)
@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from utils import fit_sine
+
+
+def ripple(t):
+    return 0.1 + 0.3 * np.sin(t + 0.2) + 0.05 * np.sin(2 * t + 1.) + 0.02 * np.sin(4 * t)
+
+
+def test_fit_orders():
+    t = np.linspace(-np.pi, np.pi, 200, endpoint=False)
+    fits, pred, best = fit_sine.fit_orders(t, ripple(t))
+    assert len(fits) == 3 and pred.shape == (3, len(t))
+    assert best == 2
+    np.testing.assert_allclose(pred[best], ripple(t), atol=1e-12)
+    np.testing.assert_allclose([fits[2]['a1'], fits[2]['a2'], fits[2]['a3']], [0.3, 0.05, 0.02])
+
+
+def test_fit_orders_few_samples():
+    # 5 clustered positions support 1 and 2 sines, not the 7 parameters of 3 sines
+    t = np.array([-2., -1., 0., 1., 2.])
+    fits, pred, best = fit_sine.fit_orders(t, ripple(t))
+    assert len(fits) == 2 and pred.shape == (2, len(t))
+    assert best in (0, 1)
+    # the same positions measured several times are still 5 distinct samples
+    fits, _, _ = fit_sine.fit_orders(np.repeat(t, 3), ripple(np.repeat(t, 3)))
+    assert len(fits) == 2
+
+
+def test_fit_orders_not_enough_samples():
+    with pytest.raises(Exception):
+        fit_sine.fit_orders(np.array([0., 1.]), np.array([1., 2.]))
@@ -0,0 +1,176 @@
+import os
+import sys
+import time
+import yaml
+import importlib.util
+
+import pytest
+
+import multi_calibration
+from utils import stage_utils
+
+
+# stand-in for calib-test-pdo: creates the results yaml of the motor named in the config, in the directory
+# shared by all the runs, records the process that ran it and prints the path, as the real executable does
+TEST_PDO = '''#!{python}
+import os, sys, time, yaml
+with open(sys.argv[1]) as f:
+    config = yaml.safe_load(f)
+if config.get('fail'):
+    sys.exit(1)
+time.sleep(0.5)
+yaml_file = os.path.join(config['log_root'], config['motor'] + '_results.yaml')
+with open(yaml_file, 'w') as f:
+    yaml.dump({{'log': {{'location': config['log_root'] + '/', 'name': config['motor']}},
+               'stub': {{'motor': config['motor'], 'worker': os.getppid(), 'esc_dir': config['esc_dir']}}}}, f)
+print('[i] Saved results in: ' + yaml_file)
+'''
+
+# stand-in for the calib executables: writes the CentAcESC log of its slave, while the other runs test too
+CALIB = '''#!{python}
+import os, sys, time, yaml
+with open(sys.argv[1]) as f:
+    stub = yaml.safe_load(f)['stub']
+cmd = os.path.basename(sys.argv[0])
+with open(os.path.join(stub['esc_dir'], 'CentAcESC_' + stub['motor'] + '_' + cmd + '_log.txt'), 'w') as f:
+    f.write(cmd + ' ' + stub['motor'])
+time.sleep(0.5)
+'''
+
+# stand-in for the set-* executables: records the results they would send to the motor
+SET = '''#!{python}
+import os, sys, yaml
+with open(sys.argv[1]) as f:
+    out_dict = yaml.safe_load(f)
+with open(out_dict['log']['location'] + out_dict['log']['name'] + '_' + os.path.basename(sys.argv[0]) + '.yaml', 'w') as f:
+    yaml.dump(out_dict['results'], f)
+'''
+
+# stand-in for a processing stage: stores the inertia-calib log it is given
+STAGE = '''import yaml
+def process(yaml_file, plot_all=False, use_cache=True):
+    with open(yaml_file) as f:
+        out_dict = yaml.safe_load(f)
+    with open(out_dict['log']['location'] + out_dict['log']['name'] + '_inertia-calib.log') as f:
+        out_dict['results'] = {'stub': f.read()}
+    with open(yaml_file, 'w') as f:
+        yaml.dump(out_dict, f)
+    return yaml_file
+'''
+
+
+def write_stubs(bin_dir):
+    for cmd, path in multi_calibration.CMD.items():
+        exe = os.path.join(bin_dir, path)
+        os.makedirs(os.path.dirname(exe), exist_ok=True)
+        with open(exe, 'w') as f:
+            if cmd == 'test-pdo':
+                f.write(TEST_PDO.format(python=sys.executable))
+            elif cmd.startswith('set-'):
+                f.write(SET.format(python=sys.executable))
+            else:
+                f.write(CALIB.format(python=sys.executable))
+        os.chmod(exe, 0o755)
+
+
+def write_runs(tmp_path, motors, fail=(), results=None, tests=(), esc_log=True):
+    log_root = tmp_path / 'logs'
+    log_root.mkdir(exist_ok=True)
+    esc_dir = tmp_path / 'tmp'
+    esc_dir.mkdir(exist_ok=True)
+    runs = []
+    for motor in motors:
+        config = tmp_path / f'{motor}.yaml'
+        config.write_text(yaml.dump({'motor': motor, 'log_root': str(log_root), 'esc_dir': str(esc_dir), 'fail': motor in fail}))
+        run = {'name': motor, 'config': str(config), 'tests': list(tests)}
+        if esc_log:
+            run['esc_log'] = str(esc_dir / f'CentAcESC_{motor}_*_log.txt')
+        if results is not None and motor in results:
+            run['results'] = str(log_root / results[motor])
+        runs.append(run)
+    bin_dir = tmp_path / 'bin'
+    write_stubs(str(bin_dir))
+    runs_file = tmp_path / 'runs.yaml'
+    runs_file.write_text(yaml.dump({'bin_dir': str(bin_dir), 'runs': runs}))
+    return str(runs_file)
+
+
+@pytest.fixture
+def stub_test(tmp_path, monkeypatch):
+    '''A test acquiring as the friction one (friction-calib, then inertia-calib with the log handed over in /tmp),
+    followed by a stub processing stage and set-phase'''
+    stage_file = tmp_path / 'process_stub.py'
+    stage_file.write_text(STAGE)
+    spec = importlib.util.spec_from_file_location('utils.process_stub', str(stage_file))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    monkeypatch.setitem(sys.modules, 'utils.process_stub', module)
+    monkeypatch.setitem(stage_utils.STAGES, 'stub', {'logs': ['inertia-calib'], 'inputs': [], 'outputs': 'results.stub'})
+    monkeypatch.setitem(multi_calibration.TESTS, 'stub', {'cmd': ['friction-calib', 'inertia-calib'], 'stage': 'stub', 'set': 'set-phase'})
+    return 'stub'
+
+
+def test_one_process_per_motor(tmp_path):
+    motors = ['m1', 'm2', 'm3']
+    results = multi_calibration.process(write_runs(tmp_path, motors))
+
+    workers = set()
+    for motor in motors:
+        assert results[motor]['status'] == 'ok'
+        # each run gets the yaml its own test-pdo created, not the newest one in the shared directory
+        with open(results[motor]['results']) as f:
+            stub = yaml.safe_load(f)['stub']
+        assert stub['motor'] == motor
+        workers.add(stub['worker'])
+        assert os.path.isfile(tmp_path / f'runs_{motor}.log')
+    assert len(workers) == len(motors)
+    assert os.getpid() not in workers
+
+
+def test_failed_run(tmp_path):
+    results = multi_calibration.process(write_runs(tmp_path, ['m1', 'm2'], fail=['m2']))
+    assert results['m1']['status'] == 'ok'
+    assert results['m1']['results'].endswith('m1_results.yaml')
+    assert results['m2'] == {'status': 'failed', 'results': None}
+    with open(tmp_path / 'runs_m2.log') as f:
+        assert 'Error during test-pdo' in f.read()
+
+
+def test_given_results(tmp_path):
+    runs_file = write_runs(tmp_path, ['m1', 'm2'], results={'m1': 'm1_results.yaml', 'm2': 'other_results.yaml'})
+    results = multi_calibration.process(runs_file)
+    assert results['m1']['status'] == 'ok'
+    assert results['m1']['results'] == str(tmp_path / 'logs' / 'm1_results.yaml')
+    # test-pdo did not create the results yaml given for m2
+    assert results['m2'] == {'status': 'failed', 'results': None}
+
+
+def test_esc_log_handoff(tmp_path, stub_test):
+    motors = ['m1', 'm2']
+    runs_file = write_runs(tmp_path, motors, tests=[stub_test])
+    # a log of the slave left by an earlier calibration
+    for motor in motors:
+        old_log = tmp_path / 'tmp' / f'CentAcESC_{motor}_old_log.txt'
+        old_log.write_text('stale')
+        os.utime(old_log, (time.time() - 100, time.time() - 100))
+    results = multi_calibration.process(runs_file)
+
+    for motor in motors:
+        assert results[motor]['status'] == 'ok'
+        # each run gets the log its own slave wrote during inertia-calib
+        with open(tmp_path / 'logs' / f'{motor}_inertia-calib.log') as f:
+            assert f.read() == 'inertia-calib ' + motor
+        # processed, fingerprinted, and sent to the motor
+        out_dict = stage_utils.load_yaml(results[motor]['results'])
+        assert out_dict['results'] == {'stub': 'inertia-calib ' + motor}
+        assert 'stub' in out_dict['fingerprints']
+        with open(tmp_path / 'logs' / f'{motor}_set-phase.yaml') as f:
+            assert yaml.safe_load(f) == {'stub': 'inertia-calib ' + motor}
+
+
+def test_shared_esc_log(tmp_path, stub_test):
+    with pytest.raises(Exception, match='esc_log'):
+        multi_calibration.process(write_runs(tmp_path, ['m1', 'm2'], tests=[stub_test], esc_log=False))
+    # a single run testing can use any CentAcESC log
+    _, runs = multi_calibration.load_runs(write_runs(tmp_path, ['m1'], tests=[stub_test], esc_log=False))
+    assert runs[0]['esc_log'] == multi_calibration.ESC_LOG
@@ -0,0 +1,39 @@
+import numpy as np
+from matplotlib import pyplot as plt
+
+from utils import plot_utils
+
+
+N = 1000000
+
+
+def noisy_chirp(n=N):
+    t = np.arange(n) / 1000.
+    rng = np.random.default_rng(0)
+    return t, np.sin(2 * np.pi * (0.1 + 0.05 * t) * t) + 0.1 * rng.standard_normal(n)
+
+
+def test_line_decimated_to_envelope(tmp_path):
+    t, tor = noisy_chirp()
+    with plt.rc_context({'savefig.dpi': 300}):
+        fig, ax = plt.subplots()
+        line = plot_utils.plot(ax, t, tor, color='#1f77b4', linewidth=1)[0]
+        width, _ = plot_utils.axes_pixels(ax)
+        fig.savefig(str(tmp_path / 'chirp.png'))
+    plt.close(fig)
+    # min/max envelope: at most 4 samples per column, with 2 columns per pixel
+    assert len(line.get_xdata()) <= 8 * width + 4
+    assert line.get_ydata().min() == tor.min() and line.get_ydata().max() == tor.max()
+
+
+def test_markers_decimated_to_marker_size():
+    t, tor = noisy_chirp()
+    with plt.rc_context({'savefig.dpi': 300}):
+        fig, ax = plt.subplots()
+        line = plot_utils.plot(ax, t, tor, 'b.', markersize=2)[0]
+        width, height = plot_utils.axes_pixels(ax)
+    plt.close(fig)
+    marker = (2 + line.get_markeredgewidth()) * 300 / 72.
+    assert len(line.get_xdata()) <= (width / marker) * (height / marker)
+    # the markers still cover the band of the noisy samples
+    assert line.get_ydata().min() < tor.min() + 0.1 and line.get_ydata().max() > tor.max() - 0.1
@@ -0,0 +1,64 @@
+import numpy as np
+from scipy.integrate import solve_ivp
+
+from utils import sim_utils
+
+
+SAMP_FREQ = 1000.
+INERTIA = 2e-3
+
+
+def friction(v):
+    # smoothed coulomb + viscous friction, as the friction models fitted by process_friction
+    return 0.05 * np.tanh(1000. * v) + 0.01 * v
+
+
+def multisine(duration=5.):
+    '''Motor torque of a multisine trajectory, and the motor state it produces (the ode backend reference)'''
+    t = np.arange(int(duration * SAMP_FREQ)) / SAMP_FREQ
+    tau = sum(0.2 * np.sin(2 * np.pi * f * t + f) for f in (0.3, 0.7, 1.3, 2.9))
+
+    def rhs(time, x):
+        return [x[1], (np.interp(time, t, tau) - friction(x[1])) / INERTIA]
+
+    sol = solve_ivp(rhs, (t[0], t[-1]), [0., 0.], t_eval=t, method='LSODA', rtol=1e-8, atol=1e-10, max_step=1 / SAMP_FREQ)
+    return tau, sol.y[0], sol.y[1]
+
+
+def nrmse(actual, predicted):
+    return np.sqrt(np.mean((actual - predicted)**2)) / np.std(actual)
+
+
+def test_fixed_step_matches_ode():
+    tau, pos, vel = multisine()
+    sim_pos, sim_vel = sim_utils.simulate(tau, pos, vel, SAMP_FREQ, INERTIA, friction)
+    assert sim_pos.shape == pos.shape and sim_vel.shape == vel.shape
+    assert nrmse(pos, sim_pos) < 5e-3
+    assert nrmse(vel, sim_vel) < 1e-2
+
+
+def test_substeps_converge_to_ode():
+    tau, pos, vel = multisine()
+    errors = [nrmse(pos, sim_utils.simulate(tau, pos, vel, SAMP_FREQ, INERTIA, friction, substeps=substeps)[0])
+              for substeps in (1, 4)]
+    assert errors[1] < errors[0]
+
+
+def test_segments():
+    tau, pos, vel = multisine()
+    sim_pos, sim_vel = sim_utils.simulate(tau, pos, vel, SAMP_FREQ, INERTIA, friction, segments=7)
+    assert sim_pos.shape == pos.shape
+    # every segment restarts from the measured state
+    starts = np.arange(7) * -(-len(tau) // 7)
+    np.testing.assert_array_equal(sim_pos[starts], pos[starts])
+    np.testing.assert_array_equal(sim_vel[starts], vel[starts])
+    assert nrmse(pos, sim_pos) < 5e-3
+
+
+def test_segments_not_dividing_samples():
+    tau, pos, vel = multisine(duration=60.001)
+    assert len(tau) % 1000 != 0
+    sim_pos, sim_vel = sim_utils.simulate(tau, pos, vel, SAMP_FREQ, INERTIA, friction, segments=1000)
+    assert sim_pos.shape == pos.shape and sim_vel.shape == vel.shape
+    assert np.all(np.isfinite(sim_pos)) and np.all(np.isfinite(sim_vel))
+    assert nrmse(pos, sim_pos) < 5e-3
@@ -0,0 +1,40 @@
+import yaml
+
+from utils import stage_utils
+
+
+def add_result(yaml_file, stage, value):
+    out_dict = stage_utils.load_yaml(yaml_file)
+    stage_utils.set_entry(out_dict, stage_utils.STAGES[stage]['outputs'], value)
+    with open(yaml_file, 'w') as f:
+        yaml.safe_dump(out_dict, f)
+    return yaml_file
+
+
+def ripple_c_to_friction(yaml_file):
+    # friction reads results.ripple.c
+    out_dict = stage_utils.load_yaml(yaml_file)
+    return add_result(yaml_file, 'friction', {'c': out_dict['results']['ripple']['c']})
+
+
+def test_process_copies_and_merge(tmp_path):
+    results = tmp_path / 'm_results.yaml'
+    results.write_text(yaml.safe_dump({'log': {'name': 'm'}, 'results': {'flash_params': {'k': 1}}}))
+    ripple = tmp_path / 'm_results_ripple-pipeline.yaml'
+    friction = tmp_path / 'm_results_friction-pipeline.yaml'
+    ripple.write_text(results.read_text())
+    friction.write_text(results.read_text())
+
+    stage_utils.process_copy(add_result, str(ripple), stage='ripple', value={'c': 0.5})
+    # friction was copied before the ripple results were merged back: it takes them from the ripple copy
+    stage_utils.process_copy(ripple_c_to_friction, str(friction), earlier=[('ripple', str(ripple))])
+    # meanwhile a test rewrote the results
+    out_dict = stage_utils.load_yaml(str(results))
+    out_dict['log']['test'] = 'frequency'
+    results.write_text(yaml.safe_dump(out_dict))
+
+    stage_utils.merge_outputs('ripple', str(ripple), str(results))
+    stage_utils.merge_outputs('friction', str(friction), str(results))
+    assert stage_utils.load_yaml(str(results)) == {
+        'log': {'name': 'm', 'test': 'frequency'},
+        'results': {'flash_params': {'k': 1}, 'ripple': {'c': 0.5}, 'friction': {'c': 0.5}}}
@@ -1,39 +1,79 @@
 import math
 import numpy as np
-from scipy.fftpack import fft
-from scipy.interpolate import interp1d
+import scipy.fft
+from scipy.signal import get_window
+from numpy.lib.stride_tricks import sliding_window_view
 
 def nextpow2(x): return math.ceil(math.log2(abs(x)))
-def mag2db(mag): return [20*math.log10(np.abs(m)) for m in mag]
-def rangeFloat(start, stop, step): return [start+n*step for n in range(0,round((stop-start)/step))]
+def mag2db(mag): return 20*np.log10(np.abs(mag))
+# same grid as [start+n*step for n in range(...)], built as an array
+def rangeFloat(start, stop, step): return start + np.arange(round((stop-start)/step))*step
 
 def bode(t, u, y, roi = [0.1, 100]):
     # Resample data based on timestep
     u, dt, _  = resampleUniformedData(t, u)
     y, dt, _  = resampleUniformedData(t, y, dt=dt)
 
-    # FFT
+    # FFT (real input: rfft returns the same first NFFT/2+1 bins as the full fft)
     Fs      = 1/dt
     L       = len(t)
     NFFT    = 2**nextpow2(L)
     NFFT_2  = int(NFFT/2)
-    Y       = fft(y,NFFT)/L
+    Y       = np.fft.rfft(y,NFFT)/L
     f       = Fs/2*np.linspace(0, 1, NFFT_2)# NFFT/2+1)
-    U       = fft(u,NFFT)/L
-    H       = [y/u for y,u in zip(Y,U)]
+    U       = np.fft.rfft(u,NFFT)/L
+    H       = Y[:NFFT_2]/U[:NFFT_2]
 
     # Calculate amplitude in decibels
-    mag     = [abs(h) for h in H[:NFFT_2]]
-    mag_db  = mag2db(mag)
+    mag_db  = mag2db(H)
 
     # Calculate phase and unwrap it to obtain a continuous phase plot.
-    phase = np.unwrap([np.angle(h) for h in H[:NFFT_2]]) # [:NFFT/2+1]
-    #phase = [np.angle(h) for h in H[:NFFT_2]]
+    phase = np.unwrap(np.angle(H)) # [:NFFT/2+1]
     # make sure phase is within [-2pi,0)
     #phase = [p-2*np.pi if p>0 else p for p in phase]
 
     return f, mag_db, phase
 
+def tf_welch(t, u, y, nperseg=4096, window='hann', overlap=0.5, estimator='H1', workers=1, batch=256):
+    '''Segment-averaged (Welch) estimate of the transfer function from u to y.
+    estimator is 'H1' (noise on y) or 'H2' (noise on u); segments are transformed
+    in batches of `batch`, each one spread over `workers` threads.
+    Returns frequency, magnitude (dB), unwrapped phase and magnitude-squared coherence'''
+    # Resample data based on timestep
+    u, dt, _ = resampleUniformedData(t, u)
+    y, dt, _ = resampleUniformedData(t, y, dt=dt)
+
+    nperseg = min(nperseg, len(u))
+    step = max(1, int(nperseg * (1 - overlap)))
+    win = get_window(window, nperseg)
+    # overlapping segments as strided views of the data, nothing is copied here
+    u_seg = sliding_window_view(u, nperseg)[::step]
+    y_seg = sliding_window_view(y, nperseg)[::step]
+
+    # accumulate auto and cross spectra (scaling cancels out in H and coherence)
+    Suu = np.zeros(nperseg // 2 + 1)
+    Syy = np.zeros(nperseg // 2 + 1)
+    Suy = np.zeros(nperseg // 2 + 1, dtype=complex)
+    for i in range(0, len(u_seg), batch):
+        us = u_seg[i:i + batch]
+        ys = y_seg[i:i + batch]
+        U = scipy.fft.rfft((us - us.mean(axis=-1, keepdims=True)) * win, axis=-1, workers=workers)
+        Y = scipy.fft.rfft((ys - ys.mean(axis=-1, keepdims=True)) * win, axis=-1, workers=workers)
+        Suu += np.sum(U.real**2 + U.imag**2, axis=0)
+        Syy += np.sum(Y.real**2 + Y.imag**2, axis=0)
+        Suy += np.sum(np.conj(U) * Y, axis=0)
+
+    if estimator == 'H1':
+        H = Suy / Suu
+    elif estimator == 'H2':
+        H = Syy / np.conj(Suy)
+    else:
+        raise Exception(f"unknown transfer function estimator '{estimator}'")
+    coherence = (Suy.real**2 + Suy.imag**2) / (Suu * Syy)
+
+    f = np.fft.rfftfreq(nperseg, dt)
+    return f, mag2db(H), np.unwrap(np.angle(H)), coherence
+
 
 from matplotlib.mlab import csd, psd
 def tfestimate(t, u, y, *args, **kwargs):
@@ -49,9 +89,10 @@ def tfestimate(t, u, y, *args, **kwargs):
     return  Pyx/Pxx, f
 
 def resampleUniformedData(time, data, dt=None):
-    if dt==None:
+    time = np.asarray(time, dtype=float)
+    if dt is None:
         dt  = np.mean(np.diff(time))
-    t_RS = rangeFloat(min(time), max(time), dt)
-    data = interp1d(time, data)(t_RS)
+    t_RS = rangeFloat(np.min(time), np.max(time), dt)
+    data = np.interp(t_RS, time, data)
 
     return data, dt, t_RS
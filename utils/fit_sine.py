@@ -2,16 +2,18 @@
 # -*- coding: utf-8 -*-
 
 import numpy
+import scipy.linalg
 import scipy.optimize
 
-def sinfunc(t, A1, p1, c):
-    return sine_1(t=t, A1=A1, w1=1., p1=p1, c=c)
-
 def sine_1(t, A1, w1, p1, c):
     return A1 * numpy.sin(w1 * t + p1) + c
 
 def fit_sin1(tt, yy, fit_w=False):
-    '''Fit sin to the input time sequence, and return fitting parameters "amp", "omega", "phase", "offset", "freq", "period" and "fitfunc"'''
+    '''Fit sin to the input time sequence, and return fitting parameters "amp", "omega", "phase", "offset", "freq", "period" and "fitfunc".
+    Unless fit_w is set the angular velocities are fixed to 1 and the fit is linear (see fit_harmonics): curve_fit is only used to fit them'''
+    if not fit_w:
+        return fit_harmonics(tt, yy, [1.])
+
     tt = numpy.array(tt)
     yy = numpy.array(yy)
     ff = numpy.fft.fftfreq(len(tt), (tt[1]-tt[0]))   # assume uniform spacing
@@ -19,16 +21,10 @@ def fit_sin1(tt, yy, fit_w=False):
     guess_amp = numpy.std(yy) * 2.**0.5
     guess_offset = numpy.mean(yy)
 
-    if fit_w:
-        guess_freq = abs(ff[numpy.argmax(Fyy[1:])+1])   # excluding the zero frequency "peak", which is related to offset
-        guess = numpy.array([guess_amp, 2.*numpy.pi*guess_freq, 0., guess_offset])
-        popt, pcov = scipy.optimize.curve_fit(sine_1, tt, yy, p0=guess)
-        A1, w1, p1, c = popt
-    else:
-        guess = numpy.array([guess_amp, 0., guess_offset])
-        popt, pcov = scipy.optimize.curve_fit(sinfunc, tt, yy, p0=guess)
-        A1, p1, c = popt
-        w1 = 1.
+    guess_freq = abs(ff[numpy.argmax(Fyy[1:])+1])   # excluding the zero frequency "peak", which is related to offset
+    guess = numpy.array([guess_amp, 2.*numpy.pi*guess_freq, 0., guess_offset])
+    popt, pcov = scipy.optimize.curve_fit(sine_1, tt, yy, p0=guess)
+    A1, w1, p1, c = popt
 
     f1 = w1/(2.*numpy.pi)
     # fitfunc = lambda t: A * numpy.sin(w*t + p) + c
@@ -45,15 +41,16 @@ def fit_sin1(tt, yy, fit_w=False):
     }
 
 
-def sin2func(t, A1, A2, p1, p2, c):
-    return sine_2(t=t, A1=A1, A2=A2, w1=1., w2=2., p1=p1, p2=p2, c=c)
-
 def sine_2(t, A1, A2, w1, w2, p1, p2, c):
     return A1 * numpy.sin(w1 * t + p1) + \
            A2 * numpy.sin(w2 * t + p2) + c
 
 def fit_sin2(tt, yy, fit_w=False):
-    '''Fit sin to the input time sequence, and return fitting parameters "amp", "omega", "phase", "offset", "freq", "period" and "fitfunc"'''
+    '''Fit sin to the input time sequence, and return fitting parameters "amp", "omega", "phase", "offset", "freq", "period" and "fitfunc".
+    Unless fit_w is set the angular velocities are fixed to 1, 2 and the fit is linear (see fit_harmonics): curve_fit is only used to fit them'''
+    if not fit_w:
+        return fit_harmonics(tt, yy, [1., 2.])
+
     tt = numpy.array(tt)
     yy = numpy.array(yy)
     ff = numpy.fft.fftfreq(len(tt), (tt[1] - tt[0]))  # assume uniform spacing
@@ -61,27 +58,15 @@ def fit_sin2(tt, yy, fit_w=False):
     guess_a = numpy.std(yy) * 2.**0.5
     guess_c = numpy.mean(yy)
 
-    if fit_w:
-        guess_w = 2. * numpy.pi * abs(ff[numpy.argmax(Fyy[1:]) + 1])  # excluding the zero frequency "peak", which is related to offset
-        guess = numpy.array([
-            guess_a/2, guess_a / 4,
-            guess_w  , guess_w * 2,
-            0., 0.,
-            guess_c
-        ])
-        popt, pcov = scipy.optimize.curve_fit(sine_2, tt, yy, p0=guess)
-        A1, A2, w1, w2, p1, p2, c = popt
-
-    else:
-        guess = numpy.array([
-            guess_a/2, guess_a / 4,
-            0., 0.,
-            guess_c
-        ])
-        popt, pcov = scipy.optimize.curve_fit(sin2func, tt, yy, p0=guess)
-        A1, A2, p1, p2, c = popt
-        w1 = 1.
-        w2 = 2.
+    guess_w = 2. * numpy.pi * abs(ff[numpy.argmax(Fyy[1:]) + 1])  # excluding the zero frequency "peak", which is related to offset
+    guess = numpy.array([
+        guess_a/2, guess_a / 4,
+        guess_w  , guess_w * 2,
+        0., 0.,
+        guess_c
+    ])
+    popt, pcov = scipy.optimize.curve_fit(sine_2, tt, yy, p0=guess)
+    A1, A2, w1, w2, p1, p2, c = popt
 
     f1 = w1 / (2. * numpy.pi)
     f2 = w2 / (2. * numpy.pi)
@@ -104,16 +89,17 @@ def fit_sin2(tt, yy, fit_w=False):
     }
 
 
-def sin3func(t, A1, A2, A3, w3, p1, p2, p3, c):
-    return sine_3(t=t, A1=A1, A2=A2, A3=A3, w1=1., w2=2., w3=4., p1=p1, p2=p2, p3=p3, c=c)
-
 def sine_3(t, A1, A2, A3, w1, w2, w3, p1, p2, p3, c):
     return A1 * numpy.sin(w1 * t + p1) + \
            A2 * numpy.sin(w2 * t + p2) + \
            A3 * numpy.sin(w3 * t + p3) + c
 
 def fit_sin3(tt, yy, fit_w=False):
-    '''Fit sin to the input time sequence, and return fitting parameters "amp", "omega", "phase", "offset", "freq", "period" and "fitfunc"'''
+    '''Fit sin to the input time sequence, and return fitting parameters "amp", "omega", "phase", "offset", "freq", "period" and "fitfunc".
+    Unless fit_w is set the angular velocities are fixed to 1, 2, 4 and the fit is linear (see fit_harmonics): curve_fit is only used to fit them'''
+    if not fit_w:
+        return fit_harmonics(tt, yy, [1., 2., 4.])
+
     tt = numpy.array(tt)
     yy = numpy.array(yy)
     ff = numpy.fft.fftfreq(len(tt), (tt[1] - tt[0]))  # assume uniform spacing
@@ -121,30 +107,15 @@ def fit_sin3(tt, yy, fit_w=False):
     guess_a = numpy.std(yy) * 2.**0.5
     guess_c = numpy.mean(yy)
 
-    if fit_w:
-        guess_w = 2. * numpy.pi * abs(ff[numpy.argmax(Fyy[1:]) + 1])  # excluding the zero frequency "peak", which is related to offset
-        guess = numpy.array([
-            guess_a / 2, guess_a / 4, guess_a / 8,
-            guess_w    , guess_w * 2, guess_w * 4,
-            0., 0., 0.,
-            guess_c
-        ])
-        popt, pcov = scipy.optimize.curve_fit(sine_3, tt, yy, p0=guess)
-        A1, A2, A3, w1, w2, w3, p1, p2, p3, c = popt
-
-    else:
-        guess_w3 = 4.
-        guess = numpy.array([
-            guess_a / 2, guess_a / 4, guess_a / 8,
-            guess_w3,
-            0., 0., 0.,
-            guess_c
-        ])
-        popt, pcov = scipy.optimize.curve_fit(sin3func, tt, yy, p0=guess)
-        A1, A2, A3, w3, p1, p2, p3, c = popt
-        w1 = 1.
-        w2 = 2.
-        #w3 = 4.
+    guess_w = 2. * numpy.pi * abs(ff[numpy.argmax(Fyy[1:]) + 1])  # excluding the zero frequency "peak", which is related to offset
+    guess = numpy.array([
+        guess_a / 2, guess_a / 4, guess_a / 8,
+        guess_w    , guess_w * 2, guess_w * 4,
+        0., 0., 0.,
+        guess_c
+    ])
+    popt, pcov = scipy.optimize.curve_fit(sine_3, tt, yy, p0=guess)
+    A1, A2, A3, w1, w2, w3, p1, p2, p3, c = popt
 
     f1 = w1 / (2. * numpy.pi)
     f2 = w2 / (2. * numpy.pi)
@@ -171,3 +142,120 @@ def fit_sin3(tt, yy, fit_w=False):
         "maxcov": numpy.max(pcov),
         "rawres": (guess, popt, pcov)
     }
+
+
+def sine_n(t, a, w, p, c):
+    '''Sum of sines c + sum_i a[i] * sin(w[i] * t + p[i]), evaluated on the whole array t at once'''
+    t = numpy.asarray(t, dtype=float)
+    return c + numpy.sin(numpy.multiply.outer(t, w) + p) @ numpy.asarray(a, dtype=float)
+
+def num_of_sines(s):
+    n = 0
+    while f"a{n+1}" in s:
+        n += 1
+    return n
+
+def eval_fit(t, s):
+    '''Evaluate on t a fit returned by fit_sin1/2/3 or fit_harmonics'''
+    n = range(1, num_of_sines(s) + 1)
+    return sine_n(t, [s[f"a{i}"] for i in n], [s[f"w{i}"] for i in n], [s[f"p{i}"] for i in n], s["c"])
+
+def harmonic_design(tt, w):
+    '''Design matrix [1, sin(w_1 t), cos(w_1 t), sin(w_2 t), cos(w_2 t), ...] of a sum of sines with fixed angular velocities w'''
+    wt = numpy.multiply.outer(numpy.asarray(tt, dtype=float), numpy.asarray(w, dtype=float))
+    X = numpy.empty((len(wt), 1 + 2 * wt.shape[1]))
+    X[:, 0] = 1.
+    X[:, 1::2] = numpy.sin(wt)
+    X[:, 2::2] = numpy.cos(wt)
+    return X
+
+def information_criterion(rss, n, k, criterion='bic'):
+    '''AIC or BIC of a least squares fit with k parameters and residual sum of squares rss over n samples'''
+    # an exact fit would give log(0)
+    ll = n * numpy.log(max(rss, numpy.finfo(float).tiny) / n)
+    if criterion == 'bic':
+        return ll + k * numpy.log(n)
+    if criterion == 'aic':
+        return ll + 2. * k
+    raise Exception(f"unknown information criterion '{criterion}'")
+
+def nested_lstsq(X, yy, sizes):
+    '''Least squares fits of yy using the first k columns of X, for every k in sizes, from a single QR of X.
+    With X = QR, the fit on the first k columns only needs the leading k x k block of R and the first k entries of Q^T yy.
+    Only the sizes the data supports are fitted: at most as many parameters as samples, and no column
+    depending on the previous ones (e.g. too few distinct samples). It fails if the smallest size is not supported.
+    Returns the coefficients of every fit, the (fitted sizes, len(yy)) predictions and the residual sums of squares'''
+    sizes = numpy.sort(numpy.asarray(sizes, dtype=int))
+    # a QR of the columns that can be fitted at most, so that R is square
+    k_max = min(X.shape[1], len(yy), sizes.max())
+    Q, R = numpy.linalg.qr(X[:, :k_max])
+    degenerate = numpy.flatnonzero(numpy.abs(numpy.diag(R)) <= 1e-12 * numpy.abs(R[0, 0]))
+    rank = degenerate[0] if len(degenerate) else k_max
+    sizes = sizes[sizes <= rank]
+    if len(sizes) == 0:
+        raise Exception(f'sine fit is ill-conditioned: not enough distinct samples ({len(yy)} samples)')
+    qty = Q.T @ yy
+    coefs = [scipy.linalg.solve_triangular(R[:k, :k], qty[:k]) for k in sizes]
+    # the prediction on the first k columns is the projection of yy on the first k columns of Q
+    pred = numpy.cumsum(Q * qty, axis=1)[:, sizes - 1].T
+    res = yy - pred
+    rss = numpy.einsum('ij,ij->i', res, res)
+    return coefs, pred, rss, R
+
+def _harmonic_fit(coef, w, R, rss, n):
+    # same keys as fit_sin1/2/3, for any number of sines
+    k = len(coef)
+    # covariance of the sin/cos coefficients: sigma^2 (X^T X)^-1 = sigma^2 R^-1 R^-T
+    R_inv = scipy.linalg.solve_triangular(R[:k, :k], numpy.eye(k))
+    pcov = R_inv @ R_inv.T * rss / max(n - k, 1)
+
+    # b_s * sin(wt) + b_c * cos(wt) = A * sin(wt + p)
+    b_s = coef[1::2]
+    b_c = coef[2::2]
+    A = numpy.hypot(b_s, b_c)
+    p = numpy.arctan2(b_c, b_s)
+    f = w / (2. * numpy.pi)
+
+    out = {"c": float(coef[0])}
+    for i in range(len(w)):
+        out[f"a{i+1}"] = float(A[i])
+        out[f"w{i+1}"] = float(w[i])
+        out[f"p{i+1}"] = float(p[i])
+        out[f"f{i+1}"] = float(f[i])
+        out[f"per{i+1}"] = 1. / float(f[i])
+    out["maxcov"] = numpy.max(pcov)
+    out["rawres"] = (None, coef, pcov)
+    out["rss"] = float(rss)
+    out["n"] = n
+    return out
+
+def fit_harmonics(tt, yy, w=(1., 2., 4.)):
+    '''Fit c + sum_i a_i * sin(w_i * t + p_i) with fixed angular velocities w, in closed form.
+    With fixed w the model is linear in the sin/cos coefficients, so it is solved with a single least squares.
+    For integer w the model is 2pi-periodic: one period of data is enough, there is no need to repeat it.
+    Returns the same keys as fit_sin1/2/3 (for any number of sines), plus rss and the number of samples n'''
+    yy = numpy.asarray(yy, dtype=float)
+    w = numpy.atleast_1d(numpy.asarray(w, dtype=float))
+    X = harmonic_design(tt, w)
+    coefs, _, rss, R = nested_lstsq(X, yy, [X.shape[1]])
+    return _harmonic_fit(coefs[0], w, R, rss[0], len(yy))
+
+def fit_orders(tt, yy, w=(1., 2., 4.), criterion='bic'):
+    '''Fit the sums of the first 1, 2, ..., len(w) sines of w, and choose among them by information criterion.
+    The models are nested, so all of them come from one design matrix and one QR (see nested_lstsq).
+    Only the orders the data supports are fitted (see nested_lstsq), at least the one with a single sine.
+    Returns the list of fits (as from fit_harmonics, with the criterion value in "ic"), their
+    (fitted orders, len(tt)) predictions on tt and the index of the best one'''
+    yy = numpy.asarray(yy, dtype=float)
+    w = numpy.atleast_1d(numpy.asarray(w, dtype=float))
+    X = harmonic_design(tt, w)
+    orders = numpy.arange(1, len(w) + 1)
+    coefs, pred, rss, R = nested_lstsq(X, yy, 1 + 2 * orders)
+    orders = orders[:len(coefs)]
+    fits = []
+    for m, coef, r in zip(orders, coefs, rss):
+        s = _harmonic_fit(coef, w[:m], R, r, len(yy))
+        s["ic"] = float(information_criterion(r, len(yy), 1 + 2 * m, criterion))
+        fits.append(s)
+    best = int(numpy.argmin([s["ic"] for s in fits]))
+    return fits, pred, best
@@ -0,0 +1,81 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import numpy
+import scipy.optimize
+
+# Transfer functions are parametrized as
+#     H(s) = k * (s^m + b[0] s^(m-1) + ... + b[m-1]) / (s^n + a[0] s^(n-1) + ... + a[n-1])
+# with p = [k, b[0..m-1], a[0..n-1]], n poles and m zeros.
+
+def tf_split(p, n_poles, n_zeros):
+    k = p[0]
+    num = numpy.concatenate(([1.], p[1:1 + n_zeros]))
+    den = numpy.concatenate(([1.], p[1 + n_zeros:1 + n_zeros + n_poles]))
+    return k, num, den
+
+def tf_eval(p, w, n_poles, n_zeros):
+    '''Evaluate the transfer function at s = 1j*w, for all w at once'''
+    s = 1j * numpy.asarray(w)
+    k, num, den = tf_split(p, n_poles, n_zeros)
+    return k * numpy.polyval(num, s) / numpy.polyval(den, s)
+
+def tf_jacobian(p, w, n_poles, n_zeros):
+    '''Analytic derivatives of H(1j*w) w.r.t. p, one column per parameter'''
+    s = 1j * numpy.asarray(w)
+    k, num, den = tf_split(p, n_poles, n_zeros)
+    N = numpy.polyval(num, s)
+    D = numpy.polyval(den, s)
+    H = k * N / D
+    J = numpy.empty((len(s), 1 + n_zeros + n_poles), dtype=complex)
+    J[:, 0] = N / D
+    # dH/db[j] = k s^(m-1-j) / D, dH/da[j] = -H s^(n-1-j) / D
+    if n_zeros:
+        J[:, 1:1 + n_zeros] = (k / D)[:, None] * numpy.vander(s, n_zeros)
+    J[:, 1 + n_zeros:] = (-H / D)[:, None] * numpy.vander(s, n_poles)
+    return J
+
+def guess_from_2nd_order(k, wn, zeta, n_poles, n_zeros):
+    '''Initial guess for an (n_poles, n_zeros) model: the 2nd order k*wn^2/(s^2+2*zeta*wn*s+wn^2)
+    with the extra poles and zeros placed at -wn and k scaled to keep the same dc gain'''
+    if n_poles < 2 or n_zeros > n_poles:
+        raise Exception(f'unsupported transfer function order ({n_poles} poles, {n_zeros} zeros)')
+    den = numpy.polymul([1., 2 * zeta * wn, wn**2], numpy.poly(-wn * numpy.ones(n_poles - 2)))
+    num = numpy.poly(-wn * numpy.ones(n_zeros))
+    k_poly = k * wn**2 * den[-1] / (wn**2 * num[-1])
+    return numpy.concatenate(([k_poly], num[1:], den[1:]))
+
+def fit_tf(w, h, n_poles, n_zeros, p0):
+    '''Fit an (n_poles, n_zeros) transfer function to the complex frequency response h(w).
+    Real and imaginary residuals are stacked and solved with an analytic Jacobian.
+    Returns the parameters, numerator and denominator coefficients, the fitted response and fit statistics'''
+    w = numpy.asarray(w, dtype=float)
+    h = numpy.asarray(h, dtype=complex)
+
+    def residuals(p):
+        e = h - tf_eval(p, w, n_poles, n_zeros)
+        return numpy.concatenate((e.real, e.imag))
+
+    def jacobian(p):
+        J = -tf_jacobian(p, w, n_poles, n_zeros)
+        return numpy.concatenate((J.real, J.imag))
+
+    t0 = time.perf_counter()
+    res = scipy.optimize.least_squares(residuals, numpy.asarray(p0, dtype=float), jac=jacobian, method='lm', x_scale='jac')
+    fit_time = time.perf_counter() - t0
+
+    k, num, den = tf_split(res.x, n_poles, n_zeros)
+    h_fit = tf_eval(res.x, w, n_poles, n_zeros)
+    return {
+        "p": res.x,
+        "num": k * num,
+        "den": den,
+        "h": h_fit,
+        # same definition used so far in process_frequency, kept for comparability of stored results
+        "NRMSE": numpy.abs(numpy.sqrt(numpy.mean(numpy.square(h - h_fit))) / (numpy.max(h) - numpy.min(h))),
+        "nfev": int(res.nfev),
+        "njev": int(res.njev) if res.njev is not None else int(res.nfev),
+        "time": fit_time,
+        "success": bool(res.success),
+    }
@@ -0,0 +1,284 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import yaml
+import hashlib
+import tempfile
+import itertools
+import numpy as np
+
+# Column layout of each *-calib.log written by the ec_master_app tests.
+# Every entry is (column name, dtype), in the same order as the tab-separated
+# fields of the log; dtypes follow the printf format used when logging
+# ('%u64' -> uint64, '%u' -> uint32, '%d' -> int16, '%f' -> float64).
+LOG_SCHEMA = {
+    # '%u64\t%u\t%u\t%u\t%u\t%f\t%f\t%d\t%f\t%f\t%f'
+    'phase-calib': (
+        ('ns',         np.uint64),
+        ('curr_type',  np.uint32),
+        ('loop_cnt',   np.uint32),
+        ('step_cnt',   np.uint32),
+        ('trj_cnt',    np.uint32),
+        ('ph_angle',   np.float64),
+        ('i_q',        np.float64),
+        ('motor_vel',  np.int16),
+        ('motor_pos',  np.float64),
+        ('link_pos',   np.float64),
+        ('aux_var',    np.float64),
+    ),
+    # '%u64\t%u\t%f\t%f\t%f\t%f\t%f\t%f'
+    'torque-calib': (
+        ('ns',         np.uint64),
+        ('stationary', np.uint32),
+        ('tor_cell',   np.float64),
+        ('tor_motor',  np.float64),
+        ('pos_link',   np.float64),
+        ('pos_motor',  np.float64),
+        ('i_ref',      np.float64),
+        ('i_fb',       np.float64),
+    ),
+    # '%u64\t%u\t%u\t%f\t%f\t%f\t%f\t%f\t%d\t%d\t%f'
+    'ripple-calib': (
+        ('ts',         np.uint64),
+        ('is_moving',  np.uint32),
+        ('trj_cnt',    np.uint32),
+        ('curr_ref',   np.float64),
+        ('torque',     np.float64),
+        ('pos_target', np.float64),
+        ('pos_motor',  np.float64),
+        ('pos_link',   np.float64),
+        ('vel_motor',  np.int16),
+        ('vel_link',   np.int16),
+        ('aux_var',    np.float64),
+    ),
+    # '%u64\t%f\t%f\t%f\t%f'
+    'frequency-calib': (
+        ('ns',         np.uint64),
+        ('motor_tor',  np.float64),
+        ('i_q',        np.float64),
+        ('i_fb',       np.float64),
+    ),
+}
+
+
+def cache_dir(log_file):
+    '''Path of the binary sidecar holding the parsed columns of log_file'''
+    return os.path.splitext(log_file)[0] + '.npy-cache'
+
+
+def file_hash(file_name, block_size=1 << 20):
+    h = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def log_hash(log_file):
+    '''sha1 of log_file, taken from its cache when the cache is still valid to avoid reading the whole log again'''
+    meta_file = os.path.join(cache_dir(log_file), 'meta.yaml')
+    if os.path.isfile(meta_file):
+        try:
+            with open(meta_file) as f:
+                meta = yaml.safe_load(f)
+            stat = os.stat(log_file)
+            if meta.get('size') == stat.st_size and meta.get('mtime_ns') == stat.st_mtime_ns:
+                return meta['sha1']
+        except Exception:
+            pass
+    return file_hash(log_file)
+
+
+def save_yaml(yaml_file, out_dict):
+    '''Write out_dict to yaml_file atomically: it is dumped to a temporary file in the same directory,
+    which then replaces yaml_file, so a reader (or a process killed while writing) never sees a truncated yaml'''
+    head, tail = os.path.split(os.path.abspath(yaml_file))
+    fd, tmp_file = tempfile.mkstemp(prefix='.' + tail + '.', suffix='.tmp', dir=head)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf8') as outfile:
+            yaml.dump(out_dict, outfile, default_flow_style=False, allow_unicode=True)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        if os.path.exists(yaml_file):
+            os.chmod(tmp_file, os.stat(yaml_file).st_mode & 0o777)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_file, 0o666 & ~umask)
+        os.replace(tmp_file, yaml_file)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+
+def _read_cache(log_file, log_type):
+    # returns None whenever the sidecar is missing, stale or unreadable
+    meta_file = os.path.join(cache_dir(log_file), 'meta.yaml')
+    if not os.path.isfile(meta_file):
+        return None
+    try:
+        with open(meta_file) as f:
+            meta = yaml.safe_load(f)
+    except Exception:
+        return None
+
+    schema = LOG_SCHEMA[log_type]
+    stat = os.stat(log_file)
+    if meta.get('log_type') != log_type or \
+       meta.get('columns') != [[name, np.dtype(dtype).str] for name, dtype in schema] or \
+       meta.get('size') != stat.st_size:
+        return None
+    # a different mtime alone (e.g. after a cp) does not invalidate the cache
+    if meta.get('mtime_ns') != stat.st_mtime_ns and meta.get('sha1') != file_hash(log_file):
+        return None
+
+    try:
+        return {name: np.load(os.path.join(cache_dir(log_file), name + '.npy'), mmap_mode='c')
+                for name, _ in schema}
+    except (OSError, ValueError):
+        return None
+
+
+class _CacheWriter:
+    '''Append parsed column blocks to the .npy files of the cache, so that the cache can be filled while streaming'''
+    def __init__(self, log_file, log_type):
+        self.log_file = log_file
+        self.log_type = log_type
+        self.path = cache_dir(log_file)
+        self.length = 0
+        self.files = {}
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            # drop the old meta first, so a half-written cache is never seen as valid
+            if os.path.isfile(os.path.join(self.path, 'meta.yaml')):
+                os.remove(os.path.join(self.path, 'meta.yaml'))
+            for name, dtype in LOG_SCHEMA[log_type]:
+                f = open(os.path.join(self.path, name + '.npy'), 'wb')
+                self.files[name] = f
+                self._write_header(f, dtype)
+                self.header_size = f.tell()
+        except OSError:
+            print("[!] Creation of the log cache %s failed" % self.path)
+            self.abort()
+
+    def _write_header(self, f, dtype):
+        # the header is padded to a fixed size, so it can be rewritten in place once the length is known
+        np.lib.format.write_array_header_1_0(f, {'descr': np.dtype(dtype).str,
+                                                 'fortran_order': False,
+                                                 'shape': (self.length,)})
+
+    def append(self, columns):
+        if not self.files:
+            return
+        try:
+            for name, col in columns.items():
+                self.files[name].write(np.ascontiguousarray(col).tobytes())
+            self.length += len(col)
+        except OSError:
+            print("[!] Writing the log cache %s failed" % self.path)
+            self.abort()
+
+    def close(self):
+        if not self.files:
+            return
+        try:
+            for name, dtype in LOG_SCHEMA[self.log_type]:
+                f = self.files[name]
+                f.seek(0)
+                self._write_header(f, dtype)
+                if f.tell() != self.header_size:
+                    raise OSError('cache header size changed')
+                f.close()
+            self.files = {}
+            stat = os.stat(self.log_file)
+            meta = {
+                'log_type': self.log_type,
+                'columns': [[name, np.dtype(dtype).str] for name, dtype in LOG_SCHEMA[self.log_type]],
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+                'sha1': file_hash(self.log_file),
+            }
+            save_yaml(os.path.join(self.path, 'meta.yaml'), meta)
+        except OSError:
+            print("[!] Writing the log cache %s failed" % self.path)
+            self.abort()
+
+    def abort(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+
+def _parse_lines(lines, schema):
+    data = np.loadtxt(lines,
+                      delimiter='\t',
+                      dtype=np.dtype(list(schema)),
+                      usecols=range(len(schema)),
+                      ndmin=1)
+    return {name: np.ascontiguousarray(data[name]) for name, _ in schema}
+
+
+def load_log(log_file, log_type, use_cache=True):
+    '''Parse a tab-separated *-calib.log in a single pass and return a dict of typed numpy columns, one per entry of LOG_SCHEMA[log_type].
+    When use_cache is set, the columns are stored as .npy files next to the log and memory-mapped on later calls, skipping the text parsing'''
+    if log_type not in LOG_SCHEMA:
+        raise Exception(f"unknown log type '{log_type}'")
+    schema = LOG_SCHEMA[log_type]
+
+    if use_cache:
+        columns = _read_cache(log_file, log_type)
+        if columns is not None:
+            print('[i] Using cached log: ' + cache_dir(log_file))
+            return columns
+
+    columns = _parse_lines(log_file, schema)
+
+    if use_cache:
+        writer = _CacheWriter(log_file, log_type)
+        writer.append(columns)
+        writer.close()
+    return columns
+
+
+def iter_log(log_file, log_type, chunk_size=100000, use_cache=True):
+    '''Same as load_log, but yields the columns in blocks of at most chunk_size rows, so that only one block of the log is in memory at a time'''
+    if log_type not in LOG_SCHEMA:
+        raise Exception(f"unknown log type '{log_type}'")
+    schema = LOG_SCHEMA[log_type]
+
+    if use_cache:
+        columns = _read_cache(log_file, log_type)
+        if columns is not None:
+            print('[i] Using cached log: ' + cache_dir(log_file))
+            length = len(columns[schema[0][0]])
+            for i in range(0, length, chunk_size):
+                yield {name: col[i:i + chunk_size] for name, col in columns.items()}
+            return
+
+    writer = _CacheWriter(log_file, log_type) if use_cache else None
+    try:
+        with open(log_file) as f:
+            while True:
+                lines = list(itertools.islice(f, chunk_size))
+                if not lines:
+                    break
+                columns = _parse_lines(lines, schema)
+                if writer:
+                    writer.append(columns)
+                yield columns
+    except BaseException:
+        # also reached when the caller stops iterating early: leave no valid cache behind
+        if writer:
+            writer.abort()
+        raise
+    if writer:
+        writer.close()
+
+
+if __name__ == "__main__":
+    columns = load_log(log_file=sys.argv[1], log_type=sys.argv[2])
+    for k, v in columns.items():
+        print(f'{k}:\t{v.dtype}\t{len(v)} points')
@@ -0,0 +1,114 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Fit statistics (RMSE, NRMSE, max error) computed in one pass, on whole arrays or on a stream of chunks"""
+
+import numpy as np
+
+
+class RunningStats:
+    '''Count, mean, variance, min and max of a stream of values, updated one chunk at a time.
+    Each chunk is reduced with numpy and merged with Welford/Chan's update: only the running totals are kept between chunks'''
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.
+        self.m2 = 0.
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, x):
+        x = np.asarray(x, dtype=float).ravel()
+        n = len(x)
+        if n == 0:
+            return self
+        mean = np.mean(x)
+        m2 = np.sum(np.square(x - mean))
+        delta = mean - self.mean
+        total = self.n + n
+        self.mean += delta * n / total
+        self.m2 += m2 + delta * delta * self.n * n / total
+        self.n = total
+        self.min = min(self.min, float(np.min(x)))
+        self.max = max(self.max, float(np.max(x)))
+        return self
+
+    @property
+    def var(self):
+        # population variance, as np.var
+        return self.m2 / self.n if self.n else np.nan
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+    @property
+    def ptp(self):
+        return self.max - self.min if self.n else np.nan
+
+
+class ErrorStats:
+    '''Statistics of a fit, accumulated over chunks of (actual, predicted) samples'''
+
+    def __init__(self):
+        self.actual = RunningStats()
+        self.predicted = RunningStats()
+        self.sse = 0.
+        self.max_abs = 0.
+
+    def update(self, actual, predicted):
+        actual = np.asarray(actual, dtype=float).ravel()
+        predicted = np.asarray(predicted, dtype=float).ravel()
+        if actual.shape != predicted.shape:
+            raise Exception(f'{len(actual)} actual samples but {len(predicted)} predicted ones')
+        error = actual - predicted
+        self.sse += float(error @ error)
+        if len(error):
+            self.max_abs = max(self.max_abs, float(np.max(np.abs(error))))
+        self.actual.update(actual)
+        self.predicted.update(predicted)
+        return self
+
+    @property
+    def n(self):
+        return self.actual.n
+
+    @property
+    def rmse(self):
+        return np.sqrt(self.sse / self.n) if self.n else np.nan
+
+    def nrmse(self, norm='range'):
+        '''RMSE normalised by the range of the actual data ('range'), its standard deviation ('std'),
+        or the standard deviation of the prediction ('std_pred')'''
+        if norm == 'range':
+            return self.rmse / self.actual.ptp
+        if norm == 'std':
+            return self.rmse / self.actual.std
+        if norm == 'std_pred':
+            return self.rmse / self.predicted.std
+        raise Exception(f"unknown NRMSE normalisation '{norm}'")
+
+    @property
+    def max_error(self):
+        return self.max_abs
+
+
+def error_stats(actual, predicted=None):
+    '''ErrorStats of arrays of actual and predicted samples, or of an iterable of (actual, predicted) chunks'''
+    stats = ErrorStats()
+    if predicted is not None:
+        return stats.update(actual, predicted)
+    for a, p in actual:
+        stats.update(a, p)
+    return stats
+
+
+def rmse(actual, predicted):
+    return error_stats(actual, predicted).rmse
+
+
+def nrmse(actual, predicted, norm='range'):
+    return error_stats(actual, predicted).nrmse(norm)
+
+
+def max_error(actual, predicted):
+    return error_stats(actual, predicted).max_error
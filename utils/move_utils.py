@@ -8,6 +8,12 @@ import yaml
 
 from datetime import datetime
 
+# custom files
+try:
+    from utils import log_utils
+except ImportError:
+    import log_utils
+
 def move_yaml(yaml_file):
     # read parameters from yaml file
     with open(yaml_file) as f:
@@ -54,14 +60,18 @@ def move_yaml(yaml_file):
 
     # move file to new location
     yaml_name=head[:-5]+tail+'_results.yaml'
-    with open(yaml_name, 'w', encoding='utf8') as outfile:
-        yaml.dump(out_dict, outfile, default_flow_style=False, allow_unicode=True)
+    log_utils.save_yaml(yaml_name, out_dict)
     os.remove(yaml_file)
     return yaml_name
 
-def move_log(yaml_file, new_name='NULL'):
-    '''Moves lastest CentAcESC_*_log.txt log file to new_name location, default is taken'''
-    list_of_files = glob.glob('/tmp/CentAcESC_*_log.txt')
+def move_log(yaml_file, new_name='NULL', tmp_pattern='/tmp/CentAcESC_*_log.txt', newer_than=None):
+    '''Moves lastest CentAcESC_*_log.txt log file to new_name location, default is taken.
+    tmp_pattern and newer_than (a time.time() value) restrict the candidates, e.g. to the log of a given slave written by the last test'''
+    list_of_files = glob.glob(tmp_pattern)
+    if newer_than is not None:
+        list_of_files = [f for f in list_of_files if os.path.getmtime(f) >= newer_than]
+    if not list_of_files:
+        sys.exit(u'\033[91m[\u2717] No log matching ' + tmp_pattern + u'\033[0m')
     tmp_file = max(list_of_files, key=os.path.getctime)
     if new_name == 'NULL':
         # read parameters from yaml file
@@ -81,6 +91,7 @@ def move_log(yaml_file, new_name='NULL'):
     if os.system(cmd):
         sys.exit(u'\033[91m[\u2717] Error while copying logs\033[0m')
     print('log_file: ' + new_name)
+    return yaml_file
 
 if __name__ == "__main__":
     #import costum files
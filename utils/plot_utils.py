@@ -1,7 +1,13 @@
 #! /usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
+import pickle
 import numpy as np
+import matplotlib
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from matplotlib import pyplot as plt
 
 def multiple_formatter(denominator=2, number=np.pi, latex='\pi'):
@@ -46,6 +52,255 @@ def formatter(self):
     return plt.FuncFormatter(multiple_formatter(self.denominator, self.number, self.latex))
 
 
+def _savefig_dpi(fig):
+    dpi = plt.rcParams['savefig.dpi']
+    if dpi == 'figure':
+        dpi = fig.dpi
+    return dpi
+
+
+def axes_pixels(ax):
+    '''Size in pixels (width, height) of ax in the saved figure'''
+    fig = ax.figure
+    dpi = _savefig_dpi(fig)
+    pos = ax.get_position()
+    return pos.width * fig.get_figwidth() * dpi, pos.height * fig.get_figheight() * dpi
+
+
+def figure_pixels(figsize=None):
+    '''Size in pixels (width, height) of a saved figure of figsize inches (the default one if None),
+    which bounds the size of its axes: to decimate data before the figure is built'''
+    if figsize is None:
+        figsize = plt.rcParams['figure.figsize']
+    dpi = plt.rcParams['savefig.dpi']
+    if dpi == 'figure':
+        dpi = plt.rcParams['figure.dpi']
+    return figsize[0] * dpi, figsize[1] * dpi
+
+
+def _bins(v, n):
+    '''Index of the bin, out of n equal ones over the range of v, of every sample'''
+    v_min = np.min(v)
+    span = np.max(v) - v_min
+    if span == 0:
+        return np.zeros(len(v), dtype=np.intp)
+    return np.minimum(((v - v_min) * (n / span)).astype(np.intp), n - 1)
+
+
+def minmax_decimate(x, y, n_bins):
+    '''Indices of the samples to draw of a line with increasing x: first, last, min and max of each
+    of n_bins columns (M4). The line drawn through them covers the same pixels as the full one'''
+    col = _bins(x, n_bins)
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(col)) + 1))
+    ends = np.append(starts[1:], len(x))
+    ids = np.repeat(np.arange(len(starts)), ends - starts)
+    # first occurrence of the min/max of every column
+    i_min = np.flatnonzero(y == np.minimum.reduceat(y, starts)[ids])
+    i_max = np.flatnonzero(y == np.maximum.reduceat(y, starts)[ids])
+    i_min = i_min[np.unique(ids[i_min], return_index=True)[1]]
+    i_max = i_max[np.unique(ids[i_max], return_index=True)[1]]
+    return np.unique(np.concatenate((starts, ends - 1, i_min, i_max)))
+
+
+def lttb_decimate(x, y, n_out):
+    '''Indices of n_out samples of a line with increasing x chosen by Largest-Triangle-Three-Buckets:
+    in each bucket the sample making the largest triangle with the previous pick and the mean of the next bucket'''
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.intp)
+    out = np.empty(n_out, dtype=np.intp)
+    out[0] = 0
+    out[-1] = n - 1
+    # mean of every bucket, the last one being the final sample
+    sizes = np.diff(edges)
+    x_mean = np.append(np.add.reduceat(x[:-1], edges[:-1]) / sizes, x[-1])
+    y_mean = np.append(np.add.reduceat(y[:-1], edges[:-1]) / sizes, y[-1])
+    a = 0
+    for i in range(n_out - 2):
+        xs = x[edges[i]:edges[i + 1]]
+        ys = y[edges[i]:edges[i + 1]]
+        area = np.abs((x[a] - x_mean[i + 1]) * (ys - y[a]) - (x[a] - xs) * (y_mean[i + 1] - y[a]))
+        a = edges[i] + np.argmax(area)
+        out[i + 1] = a
+    return out
+
+
+def grid_decimate(x, y, n_x, n_y):
+    '''Indices of the samples to draw as markers: one for every cell of a n_x by n_y grid they fall in'''
+    cell = _bins(x, n_x) * n_y + _bins(y, n_y)
+    return np.sort(np.unique(cell, return_index=True)[1])
+
+
+def decimate(x, y, width, height, line=True, method='minmax', oversample=2, marker=1.):
+    '''Indices of the samples of (x, y) needed to draw it in a width by height pixels axes.
+    line:   decimate a line (x must be monotonic) with method 'minmax' (envelope) or 'lttb',
+            otherwise the markers, keeping one per cell of a grid as wide as a marker (marker pixels)
+    The columns of a line are oversample times narrower than a pixel, not to move its corners visibly'''
+    n = len(x)
+    n_x = max(int(width * oversample), 1)
+    n_y = max(int(height * oversample), 1)
+    if line:
+        if n <= 4 * n_x:
+            return np.arange(n)
+        dx = np.diff(x)
+        if np.any(dx < 0):
+            if np.any(dx > 0):
+                return np.arange(n)
+            # decreasing x: decimate the reversed line
+            return n - 1 - decimate(x[::-1], y[::-1], width, height, line, method, oversample)[::-1]
+        if method == 'lttb':
+            return lttb_decimate(x, y, 2 * n_x)
+        if method != 'minmax':
+            raise Exception(f"unknown decimation method '{method}'")
+        return minmax_decimate(x, y, n_x)
+    marker = max(marker, 1.)
+    n_x = max(int(width / marker), 1)
+    n_y = max(int(height / marker), 1)
+    if n <= n_x:
+        return np.arange(n)
+    return grid_decimate(x, y, n_x, n_y)
+
+
+def _has_style(line):
+    '''Whether line is drawn with a line and with markers'''
+    return line.get_linestyle() not in ('None', '', ' ', 'none'), line.get_marker() not in ('None', '', ' ', 'none', None)
+
+
+def plot(ax, x, y, *args, method='minmax', **kwargs):
+    '''ax.plot of the samples of (x, y) that show up at the resolution of the saved figure.
+    Lines are decimated to the pixel width of ax (min/max envelope or LTTB), markers without
+    a line to one per marker sized cell, so millions of samples render as fast as a few thousands.
+    Lines with markers keep every sample, as each measured sample has its own marker.
+    The axes limits still come from all the samples'''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    lines = ax.plot(x, y, *args, **kwargs)
+    if len(lines) != 1 or x.ndim != 1 or len(x) != len(y) or len(x) == 0 \
+            or ax.get_xscale() != 'linear' or ax.get_yscale() != 'linear' \
+            or not (np.all(np.isfinite(x)) and np.all(np.isfinite(y))):
+        return lines
+    line = lines[0]
+    has_line, has_marker = _has_style(line)
+    if has_line and has_marker:
+        return lines
+    width, height = axes_pixels(ax)
+    # the marker outline is drawn around its size, both in points
+    marker = (line.get_markersize() + line.get_markeredgewidth()) * _savefig_dpi(ax.figure) / 72.
+    idx = decimate(x, y, width, height, line=has_line, method=method, marker=marker)
+    if len(idx) < len(x):
+        line.set_data(x[idx], y[idx])
+    return lines
+
+
+def plot_many(ax, xs, ys, *args, method='minmax', **kwargs):
+    '''plot of several (x, y) lines with the same style as a single one, broken by NaNs:
+    hundreds of short lines cost as much to draw as one. Each line is decimated as in plot,
+    unless it is drawn with markers'''
+    lines = ax.plot([], [], *args, **kwargs)
+    has_line, has_marker = _has_style(lines[0])
+    width, height = axes_pixels(ax)
+    x_all, y_all = [], []
+    for x, y in zip(xs, ys):
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        if has_line and not has_marker and len(x) and np.all(np.isfinite(x)) and np.all(np.isfinite(y)):
+            idx = decimate(x, y, width, height, line=True, method=method)
+            x, y = x[idx], y[idx]
+        x_all += [x, [np.nan]]
+        y_all += [y, [np.nan]]
+    if not x_all:
+        return lines
+    x_all = np.concatenate(x_all[:-1])
+    y_all = np.concatenate(y_all[:-1])
+    lines[0].set_data(x_all, y_all)
+    finite = np.isfinite(x_all) & np.isfinite(y_all)
+    ax.update_datalim(np.column_stack((x_all[finite], y_all[finite])))
+    ax.autoscale_view()
+    return lines
+
+
+# Deferred figures: render hands a plotting function and the data of one figure to a pool of
+# processes, which draw and save it while the caller goes on; flush waits for all of them
+_render_workers = min(4, os.cpu_count() or 1)
+_renderer = None
+_pending = []
+
+
+def set_render_workers(workers):
+    '''Number of processes rendering the figures, 0 to render them in the caller when submitted'''
+    global _render_workers, _renderer
+    flush()
+    if _renderer is not None:
+        _renderer.shutdown()
+        _renderer = None
+    _render_workers = workers
+
+
+def _render_init():
+    plt.switch_backend('Agg')
+
+
+def _rc():
+    '''rcParams changed by the caller (e.g. savefig.dpi), so that the workers render with the same ones'''
+    return {k: v for k, v in plt.rcParams.items()
+            if k not in ('backend', 'backend_fallback', 'interactive') and v != matplotlib.rcParamsDefault[k]}
+
+
+def _render(task):
+    func, rc, args, kwargs = pickle.loads(task) if isinstance(task, bytes) else task
+    figures = set(plt.get_fignums())
+    with plt.rc_context(rc):
+        try:
+            func(*args, **kwargs)
+        finally:
+            for num in set(plt.get_fignums()) - figures:
+                plt.close(num)
+
+
+def render(func, *args, **kwargs):
+    '''Draw and save a figure with func(*args, **kwargs), in the background.
+    func is a module level function (it is sent to a worker process with its data) that builds the
+    figure and saves it to its fig_name argument. Figures to show (show=True), and those of child processes,
+    are rendered right away'''
+    global _renderer
+    if kwargs.get('show') or _render_workers == 0 or mp.parent_process() is not None:
+        # only the main process owns the workers: a child process (batch job, pipeline stage, calibration run)
+        # would wait for them at exit, and its workers can deadlock when forked after the parent started its own.
+        # It draws the figures itself, in parallel with the main process and the other children
+        _render((func, _rc(), args, kwargs))
+        return
+    if _renderer is None:
+        _renderer = ProcessPoolExecutor(max_workers=_render_workers, initializer=_render_init)
+    # pickled now: the caller may change its arrays once render returns
+    future = _renderer.submit(_render, pickle.dumps((func, _rc(), args, kwargs), protocol=pickle.HIGHEST_PROTOCOL))
+    _pending.append((kwargs.get('fig_name', func.__name__), future))
+
+
+def flush():
+    '''Wait for the figures passed to render to be saved, e.g. before the report includes them'''
+    global _renderer
+    errors = []
+    while _pending:
+        name, future = _pending.pop(0)
+        try:
+            future.result()
+        except BrokenProcessPool as e:
+            _renderer = None
+            errors.append(f'{name}: {e}')
+        except Exception as e:
+            errors.append(f'{name}: {e}')
+    if errors:
+        raise Exception('error while rendering ' + ', '.join(errors))
+
+
+def call_and_flush(func, *args, **kwargs):
+    '''func(*args, **kwargs), returning once its figures are saved too (e.g. when run in another process)'''
+    ret = func(*args, **kwargs)
+    flush()
+    return ret
+
+
 class bcolors:
     HEADER = '\033[95m'
     OKBLUE = '\033[94m'
@@ -5,9 +5,9 @@ import os
 import sys
 import yaml
 import math
+import resource
 import numpy as np
 from scipy import signal
-from scipy.optimize import leastsq
 # tell matplotlib not to try to load up GTK as it returns errors over ssh
 from matplotlib import use as plt_use
 plt_use("Agg")
@@ -18,65 +18,25 @@ import control
 try:
     from utils import bode_utils
     from utils import plot_utils
+    from utils import log_utils
+    from utils import fit_tf
+    from utils import metrics_utils
 except ImportError:
     import plot_utils
     import bode_utils
+    import log_utils
+    import fit_tf
+    import metrics_utils
 
-def process(yaml_file, plot_all=False):
-    plt.rcParams['savefig.dpi'] = 300
-
-    # read parameters from yaml file
-    print('[i] Using yaml_file: ' + yaml_file)
-    with open(yaml_file) as f:
-        try:
-            out_dict = yaml.safe_load(f)
-        except Exception:
-            raise Exception('error in yaml parsing')
-
-    # find logs
-    if 'location' in out_dict['log']:
-        head = out_dict['log']['location']
-    else:
-        head, _ = os.path.split(yaml_file)
-
-    if 'name' in out_dict['log']:
-        code_string = out_dict['log']['name']
-    else:
-        _, tail = os.path.split(yaml_file)
-        code_string = tail[:-len("-results.yaml")]
-
-    # set path to save graphs
-    if len(head)>6 and head[-6:]=='/logs/':
-        new_head = f'{head[:-6]}/images/'
-    else:
-        new_head = f'{head}/images/'
-
-    if os.path.isdir(new_head) is False:
-        try:
-            os.makedirs(new_head)
-        except OSError:
-            print("Creation of the directory %s failed" % new_head)
-    image_base_path = new_head +f'{code_string}_frequency-calib'
-
-    log_file = head + f'{code_string}_frequency-calib.log'
-    print('[i] Reading log_file: ' + log_file)
-
-    # log format: '%u64\t%f\t%f\t%f\t%f'
-    ns        = [np.uint64(x.split('\t')[0]) for x in open(log_file).readlines()]
-    motor_tor = [    float(x.split('\t')[1]) for x in open(log_file).readlines()]
-    i_q       = [    float(x.split('\t')[2]) for x in open(log_file).readlines()]
-    i_fb      = [    float(x.split('\t')[3]) for x in open(log_file).readlines()]
-
-    if not 'calib_freq' in out_dict:
-        raise Exception("missing 'calib_freq' in yaml parsing")
-
-    print(f'[i] Processing data (loaded {len(ns)} points)')
-
+def plot_chirp(t, i_fb, i_q, motor_tor, n_zoom, t_full, tor_full, tor_min, tor_max, fig_name, show=False):
+    '''Current and motor torque over the first n_zoom samples (t, i_fb, i_q, motor_tor hold n_zoom + 1 of them),
+    and the motor torque over the whole chirp (t_full, tor_full, already decimated by the caller)'''
     fig, axs = plt.subplots(2)
-    l0 = axs[0].plot([s/1e9 for s in ns[0:10000]], i_fb[0:10000], color='#8e8e8e', marker='.', markersize=0.2, linestyle="", label='current out fb (A)')
-    l1 = axs[0].plot([s/1e9 for s in ns[0:10000]], i_q[0:10000], color='#1e1e1e', marker='.', markersize=0.2, linestyle="-", label='current reference (A)')
-    l2 = axs[0].plot([s/1e9 for s in ns[0:10000]], motor_tor[0:10000], color='#1f77b4', marker='.', markersize=0.2, label='motor torque (Nm)', zorder=1)
-    l3 = axs[1].plot([s/1e9 for s in ns], motor_tor, color='#1f77b4', marker='.', markersize=0.2, label='motor torque (Nm)')
+    l0 = plot_utils.plot(axs[0], t[0:n_zoom], i_fb[0:n_zoom], color='#8e8e8e', marker='.', markersize=0.2, linestyle="", label='current out fb (A)')
+    l1 = plot_utils.plot(axs[0], t[0:n_zoom], i_q[0:n_zoom], color='#1e1e1e', marker='.', markersize=0.2, linestyle="-", label='current reference (A)')
+    l2 = plot_utils.plot(axs[0], t[0:n_zoom], motor_tor[0:n_zoom], color='#1f77b4', marker='.', markersize=0.2, label='motor torque (Nm)', zorder=1)
+    # the whole chirp as a plain line, so that it is decimated to the min/max envelope of each pixel column
+    l3 = plot_utils.plot(axs[1], t_full, tor_full, color='#1f77b4', linewidth=1, label='motor torque (Nm)')
     lgnd = axs[0].legend(loc='lower left')
     for handle in lgnd.legendHandles:
         handle._legmarker.set_markersize(6)
@@ -86,14 +46,13 @@ def process(yaml_file, plot_all=False):
     axs[1].set_xlabel('Time (s)')
     axs[1].set_ylabel('motor torque (Nm)')
 
-    axs[0].set_xlim(ns[0]/1e9, ns[10000]/1e9)# first 15s
-    axs[1].set_xlim(ns[0]/1e9, ns[-1]/1e9)
+    axs[0].set_xlim(t[0], t[n_zoom])# first 15s
+    axs[1].set_xlim(t_full[0], t_full[-1])
 
-    plt_max = (max(motor_tor) -min(motor_tor)) * 0.05
-    axs[1].set_ylim(min(motor_tor)-plt_max,max(motor_tor)+plt_max)
-    plt_max = (max(motor_tor[0:10000]) -min(motor_tor[0:10000])) * 0.05
-    axs[0].set_ylim(min(motor_tor[0:10000])-plt_max,max(motor_tor[0:10000])+plt_max)
-    plt_max = (max(i_q[0:10000]) -min(i_q[0:10000])) * 0.05
+    plt_max = (tor_max - tor_min) * 0.05
+    axs[1].set_ylim(tor_min-plt_max,tor_max+plt_max)
+    plt_max = (np.max(motor_tor[0:n_zoom]) -np.min(motor_tor[0:n_zoom])) * 0.05
+    axs[0].set_ylim(np.min(motor_tor[0:n_zoom])-plt_max,np.max(motor_tor[0:n_zoom])+plt_max)
 
     axs[0].grid(b=True, which='major', axis='x', linestyle=':')
     axs[0].grid(b=True, which='major', axis='y', linestyle='-')
@@ -109,97 +68,30 @@ def process(yaml_file, plot_all=False):
 
     # Save the graph
     plt.tight_layout()
-    fig_name = image_base_path + '_1.png'
     plt.savefig(fname=fig_name, format='png')
     print('[i] Saved graph as: ' + fig_name)
-    if plot_all:
+    if show:
         plt.show()
 
-    ## bode plot ----------------------------------------------------------------------------------------------------------------
-    #bode wants even numer of data
-    if len(ns)%2 !=0:
-        ns = ns[:-1]
-        motor_tor = motor_tor[:-1]
-        i_q = i_q[:-1]
-
-    # Only select frequencies used touched by the chirp
-    w, mag, phase = bode_utils.bode([s/1e9 for s in ns],i_q,motor_tor)
-    id_0= (np.abs(w - 0.1) <= 0.01).argmax()
-    id_1= (np.abs(w - 50) <= 0.01).argmax()
-    w_f = w[id_0:id_1+1]
-    mag_f = mag[id_0:id_1+1]
-    phase_f = phase[id_0:id_1+1]
-    if np.mean(phase_f)<-2*np.pi:
-        phase_f = [p+2*np.pi for p in phase_f]
-    elif np.mean(phase_f)>0:
-        phase_f = [p-2*np.pi for p in phase_f]
-    complex_f = [(10**(m/20))*np.exp(1j*p) for m,p in zip(mag_f,phase_f)]
-
-    # Filter signal
-    b,a = signal.butter(2, 0.002, btype='lowpass')
-    # padlen is needed: see https://dsp.stackexchange.com/questions/11466/#47945
-    mag_filt = signal.filtfilt(b,a, mag_f, padlen=3*(max(len(b),len(a))-1))
-    phase_filt = signal.filtfilt(b,a, phase_f, padlen=3*(max(len(b),len(a))-1))
-    # while testing we found that using complex_f form filtered frequencies gave worse results
-    # complex_f = [(10**(m/20))*np.exp(1j*p) for m,p in zip(mag_filt, phase_filt)]
-
-    # get first estimate of natural freq and dc gain
-    wf_0=w_f[np.where(mag_filt == max(mag_filt))][0]
-    torque_const = float(out_dict['results']['flash_params']['motorTorqueConstant']) * float(out_dict['results']['flash_params']['Motor_gear_ratio'])
 
-    print("[i] Starting scipy.leastsq")
-    # 2poles 0zeros system
-    def tf20(p,w):
-        s=1j*w
-        k,wf,z = p #p=[g,ωf,ζ]
-        return k*(wf**2)/(s**2+s*z*wf+wf**2)
-    def residuals20(p,y,x):
-        a = y-tf20(p,x)
-        return a.real**2 + a.imag**2
-
-    p_lsq20=[torque_const, wf_0, 1/math.sqrt(wf_0)]
-    print("guess_lsq20: ", p_lsq20)
-    (p_lsq20, _) = leastsq(residuals20, x0=p_lsq20, args=(complex_f,w_f))
-    h_lsq20 = [tf20(p_lsq20,w) for w in w_f]
-    print("param_lsq20: ", p_lsq20)
-    NRMSE_lsq20 = np.abs(np.sqrt(np.mean(np.square([complex_f[v] - h_lsq20[v] for v in range(0,len(w_f))])))/(max(complex_f)-min(complex_f)))
-    print("NRMSE_lsq20: ", NRMSE_lsq20)
-    tf_lsq20 = p_lsq20[0]*(p_lsq20[1]**2)/(control.TransferFunction.s**2+control.TransferFunction.s*2*p_lsq20[1]*p_lsq20[2]+p_lsq20[1]**2)
-    print("TF_lsq20: ", tf_lsq20)
-
-    # 3poles 1zero system
-    def tf31(p,w):
-        s=1j*w
-        k,b0,a0,a1,a2 = p
-        return k*(s+b0)/(s**3+(s**2)*a0+s*a1+a2)
-    def residuals31(p,y,x):
-        a = y-tf31(p,x)
-        return a.real**2 + a.imag**2
-
-    p_lsq31= [torque_const, 0.0, 2*p_lsq20[1]*p_lsq20[2], p_lsq20[1]**2, 0.0]
-    (p_lsq31, _) = leastsq(residuals31, x0=p_lsq31, args=(complex_f,w_f), maxfev=20000)
-    h_lsq31 = [tf31(p_lsq31,w) for w in w_f]
-    print("param_lsq31: ", p_lsq31)
-    NRMSE_lsq31 = np.abs(np.sqrt(np.mean(np.square([complex_f[v] - h_lsq31[v] for v in range(0,len(w_f))])))/(max(complex_f)-min(complex_f)))
-    print("NRMSE_lsq31: ", NRMSE_lsq31)
-    tf_lsq31 = p_lsq31[0]*(control.TransferFunction.s+p_lsq31[1])/(control.TransferFunction.s**3+(control.TransferFunction.s**2)*p_lsq31[2]+control.TransferFunction.s*p_lsq31[3]+p_lsq31[4])
-    print("TF_lsq31: ", tf_lsq31)
-
-
-    # plot bode
+def plot_bode(w_f, mag_f, mag_filt, phase_f, phase_filt, models, fig_name, log_scale=True, show=False):
+    '''Bode plot of the measured and filtered response and of the models (list of (label, h)),
+    over a logarithmic frequency axis or a linear one'''
     fig, axs = plt.subplots(2)
-    axs[0].semilogx(w_f, mag_f, color='#8e8e8e', marker='.', markersize=0.5, linestyle="", label='datapoints') # Bode magnitude plot
-    axs[0].semilogx(w_f, mag_filt, color='#1e1e1e', marker='.', markersize=0.5, linestyle="", label='filtered')
-    axs[0].semilogx(w_f, [20*math.log10(np.abs(m)) for m in h_lsq20], marker='.', markersize=0.5, linestyle="", label='model(2,0)')
-    axs[0].semilogx(w_f, [20*math.log10(np.abs(m)) for m in h_lsq31], marker='.', markersize=0.5, linestyle="", label='model(3,1)')
+    plot0 = axs[0].semilogx if log_scale else axs[0].plot
+    plot1 = axs[1].semilogx if log_scale else axs[1].plot
+    plot0(w_f, mag_f, color='#8e8e8e', marker='.', markersize=0.5, linestyle="", label='datapoints') # Bode magnitude plot
+    plot0(w_f, mag_filt, color='#1e1e1e', marker='.', markersize=0.5, linestyle="", label='filtered')
+    for label, h in models:
+        plot0(w_f, 20*np.log10(np.abs(h)), marker='.', markersize=0.5, linestyle="", label=label)
     lgnd = axs[0].legend()
     for handle in lgnd.legendHandles:
         handle._legmarker.set_markersize(6)
 
-    axs[1].semilogx(w_f, phase_f, color='#8e8e8e', marker='.', markersize=0.5, linestyle="", label='datapoints') # Bode phase plot
-    axs[1].semilogx(w_f, phase_filt, color='#1e1e1e', marker='.', markersize=0.5, linestyle="", label='filtered')
-    axs[1].semilogx(w_f, np.unwrap([np.angle(p) for p in h_lsq20]), marker='.', markersize=0.5, linestyle="", label='model(2,0)')
-    axs[1].semilogx(w_f, np.unwrap([np.angle(p) for p in h_lsq31]), marker='.', markersize=0.5, linestyle="", label='model(3,1)')
+    plot1(w_f, phase_f, color='#8e8e8e', marker='.', markersize=0.5, linestyle="", label='datapoints') # Bode phase plot
+    plot1(w_f, phase_filt, color='#1e1e1e', marker='.', markersize=0.5, linestyle="", label='filtered')
+    for label, h in models:
+        plot1(w_f, np.unwrap(np.angle(h)), marker='.', markersize=0.5, linestyle="", label=label)
     lgnd = axs[1].legend()
     for handle in lgnd.legendHandles:
         handle._legmarker.set_markersize(6)
@@ -209,19 +101,20 @@ def process(yaml_file, plot_all=False):
     axs[1].set_ylabel('Phase (rad)')
     axs[1].set_xlabel('Frequency (Hz)')
 
-    axs[0].set_xlim(1, 50)
+    for ax in axs:
+        ax.set_xlim(1, 50)
+        if log_scale:
+            ax.grid(b=True, which='major', axis='x', linestyle='-')
+            ax.grid(b=True, which='minor', axis='x', linestyle=':')
+        else:
+            ax.grid(b=True, which='major', axis='x', linestyle=':')
+        ax.grid(b=True, which='major', axis='y', linestyle='-')
+
     axs[0].set_ylim(math.floor(min(mag_f)/10)*10,math.ceil(max(mag_f)/10)*10)
-    axs[0].grid(b=True, which='major', axis='x', linestyle='-')
-    axs[0].grid(b=True, which='minor', axis='x', linestyle=':')
-    axs[0].grid(b=True, which='major', axis='y', linestyle='-')
     axs[0].yaxis.set_major_locator(plt.MultipleLocator(10))
     axs[0].yaxis.set_minor_locator(plt.MultipleLocator(10/3))
 
-    axs[1].set_xlim(1, 50)
     axs[1].set_ylim(-2*np.pi,0)
-    axs[1].grid(b=True, which='major', axis='x', linestyle='-')
-    axs[1].grid(b=True, which='minor', axis='x', linestyle=':')
-    axs[1].grid(b=True, which='major', axis='y', linestyle='-')
     axs[1].yaxis.set_major_locator(plt.MultipleLocator(np.pi / 2))
     axs[1].yaxis.set_minor_locator(plt.MultipleLocator(np.pi / 6))
     axs[1].yaxis.set_major_formatter(
@@ -230,87 +123,221 @@ def process(yaml_file, plot_all=False):
                                           number=np.pi,
                                           latex='\pi')))
 
-
     # Save the graph
-    fig_name = image_base_path + '_2.png'
     plt.savefig(fname=fig_name, format='png', bbox_inches='tight')
     print('[i] Saved graph as: ' + fig_name)
-    if plot_all:
+    if show:
         plt.show()
 
-    # plot
-    fig, axs = plt.subplots(2)
-    axs[0].plot(w_f, mag_f, color='#8e8e8e', marker='.', markersize=0.5, linestyle="", label='datapoints') # Bode magnitude plot
-    axs[0].plot(w_f, mag_filt, color='#1e1e1e', marker='.', markersize=0.5, linestyle="", label='filtered')
-    axs[0].plot(w_f, [20*math.log10(np.abs(m)) for m in h_lsq20], marker='.', markersize=0.5, linestyle="", label='model(2,0)')
-    axs[0].plot(w_f, [20*math.log10(np.abs(m)) for m in h_lsq31], marker='.', markersize=0.5, linestyle="", label='model(3,1)')
-    lgnd = axs[0].legend()
-    for handle in lgnd.legendHandles:
-        handle._legmarker.set_markersize(6)
 
-    axs[1].plot(w_f, phase_f, color='#8e8e8e', marker='.', markersize=0.5, linestyle="", label='datapoints') # Bode phase plot
-    axs[1].plot(w_f, phase_filt, color='#1e1e1e', marker='.', markersize=0.5, linestyle="", label='filtered')
-    axs[1].plot(w_f, np.unwrap([np.angle(p) for p in h_lsq20]), marker='.', markersize=0.5, linestyle="", label='model(2,0)')
-    axs[1].plot(w_f, np.unwrap([np.angle(p) for p in h_lsq31]), marker='.', markersize=0.5, linestyle="", label='model(3,1)')
-    lgnd = axs[1].legend()
-    for handle in lgnd.legendHandles:
-        handle._legmarker.set_markersize(6)
+def process(yaml_file, plot_all=False, use_cache=True, chunk_size=100000):
+    plt.rcParams['savefig.dpi'] = 300
 
-    # make plot pretty
-    axs[0].set_ylabel('Magnitude (dB)')
-    axs[1].set_ylabel('Phase (rad)')
-    axs[1].set_xlabel('Frequency (Hz)')
+    # read parameters from yaml file
+    print('[i] Using yaml_file: ' + yaml_file)
+    with open(yaml_file) as f:
+        try:
+            out_dict = yaml.safe_load(f)
+        except Exception:
+            raise Exception('error in yaml parsing')
 
-    axs[0].set_xlim(1, 50)
-    axs[0].set_ylim(math.floor(min(mag_f)/10)*10,math.ceil(max(mag_f)/10)*10)
-    axs[0].grid(b=True, which='major', axis='x', linestyle=':')
-    axs[0].grid(b=True, which='major', axis='y', linestyle='-')
-    axs[0].yaxis.set_major_locator(plt.MultipleLocator(10))
-    axs[0].yaxis.set_minor_locator(plt.MultipleLocator(10/3))
+    # find logs
+    if 'location' in out_dict['log']:
+        head = out_dict['log']['location']
+    else:
+        head, _ = os.path.split(yaml_file)
 
-    axs[1].set_xlim(1, 50)
-    axs[1].set_ylim(-2*np.pi,0)
-    axs[1].grid(b=True, which='major', axis='x', linestyle=':')
-    axs[1].grid(b=True, which='major', axis='y', linestyle='-')
-    axs[1].yaxis.set_major_locator(plt.MultipleLocator(np.pi / 2))
-    axs[1].yaxis.set_minor_locator(plt.MultipleLocator(np.pi / 6))
-    axs[1].yaxis.set_major_formatter(
-        plt.FuncFormatter(
-            plot_utils.multiple_formatter(denominator=4,
-                                          number=np.pi,
-                                          latex='\pi')))
+    if 'name' in out_dict['log']:
+        code_string = out_dict['log']['name']
+    else:
+        _, tail = os.path.split(yaml_file)
+        code_string = tail[:-len("-results.yaml")]
 
-    # Save the graph
-    fig_name = image_base_path + '_3.png'
-    plt.savefig(fname=fig_name, format='png', bbox_inches='tight')
-    print('[i] Saved graph as: ' + fig_name)
-    if plot_all:
-        plt.show()
+    # set path to save graphs
+    if len(head)>6 and head[-6:]=='/logs/':
+        new_head = f'{head[:-6]}/images/'
+    else:
+        new_head = f'{head}/images/'
+
+    if os.path.isdir(new_head) is False:
+        try:
+            os.makedirs(new_head)
+        except OSError:
+            print("Creation of the directory %s failed" % new_head)
+    image_base_path = new_head +f'{code_string}_frequency-calib'
+
+    log_file = head + f'{code_string}_frequency-calib.log'
+    print('[i] Reading log_file: ' + log_file)
+
+    if not 'calib_freq' in out_dict:
+        raise Exception("missing 'calib_freq' in yaml parsing")
+    yaml_dict = out_dict['calib_freq']
+
+    # transfer function estimator: 'fft' (single zero-padded FFT over the whole record)
+    # or 'H1'/'H2' (segment-averaged Welch estimate, see bode_utils.tf_welch)
+    tf_estimator = 'fft'
+    tf_nperseg = 4096
+    tf_window = 'hann'
+    tf_overlap = 0.5
+    tf_workers = 1
+    if 'tf_estimator' in yaml_dict:
+        tf_estimator = yaml_dict['tf_estimator']
+    if 'tf_nperseg' in yaml_dict:
+        tf_nperseg = int(yaml_dict['tf_nperseg'])
+    if 'tf_window' in yaml_dict:
+        tf_window = yaml_dict['tf_window']
+    if 'tf_overlap' in yaml_dict:
+        tf_overlap = float(yaml_dict['tf_overlap'])
+    if 'tf_workers' in yaml_dict:
+        tf_workers = int(yaml_dict['tf_workers'])
+    # transfer function models fitted, as [poles, zeros]; (2,0) is always fitted as it seeds the others
+    tf_models = [[2, 0], [3, 1]]
+    if 'tf_models' in yaml_dict:
+        tf_models = [[int(n), int(m)] for n, m in yaml_dict['tf_models']]
+    # each model once, in the given order (fits are stored by model name)
+    tf_models = [[2, 0]] + [m for i, m in enumerate(tf_models) if m != [2, 0] and m not in tf_models[:i]]
+
+    # log format: '%u64\t%f\t%f\t%f\t%f'
+    # stream the log in blocks, keeping only what is used below: time (s), torque and
+    # current reference for the whole chirp, current feedback for the zoomed plot only
+    n_zoom = 10000
+    t, motor_tor, i_q, i_fb = [], [], [], []
+    n_fb = 0
+    tor_stats = metrics_utils.RunningStats()
+    for block in log_utils.iter_log(log_file, 'frequency-calib', chunk_size=chunk_size, use_cache=use_cache):
+        t.append(block['ns'] / 1e9)
+        motor_tor.append(block['motor_tor'])
+        tor_stats.update(block['motor_tor'])
+        i_q.append(block['i_q'])
+        if n_fb <= n_zoom:
+            i_fb.append(block['i_fb'][:n_zoom + 1 - n_fb])
+            n_fb += len(i_fb[-1])
+    t = np.concatenate(t)
+    motor_tor = np.concatenate(motor_tor)
+    i_q = np.concatenate(i_q)
+    i_fb = np.concatenate(i_fb)
+
+    print(f'[i] Processing data (loaded {len(t)} points)')
+
+    fig_name = image_base_path + '_1.png'
+    # only the zoomed samples and the envelope of the whole chirp are sent to the figure, not the full arrays
+    width, height = plot_utils.figure_pixels()
+    idx = plot_utils.decimate(t, motor_tor, width, height)
+    plot_utils.render(plot_chirp, t[:n_zoom + 1], i_fb, i_q[:n_zoom + 1], motor_tor[:n_zoom + 1], n_zoom,
+                      t[idx], motor_tor[idx], tor_stats.min, tor_stats.max, fig_name=fig_name, show=plot_all)
+
+    ## bode plot ----------------------------------------------------------------------------------------------------------------
+    #bode wants even numer of data (slicing keeps views, no copies)
+    if len(t)%2 !=0:
+        t = t[:-1]
+        motor_tor = motor_tor[:-1]
+        i_q = i_q[:-1]
+
+    coherence = None
+    if tf_estimator == 'fft':
+        w, mag, phase = bode_utils.bode(t,i_q,motor_tor)
+    else:
+        print(f'[i] Using {tf_estimator} estimator ({tf_nperseg} samples/segment, {tf_window} window, {tf_overlap} overlap)')
+        w, mag, phase, coherence = bode_utils.tf_welch(t, i_q, motor_tor,
+                                                       nperseg=tf_nperseg,
+                                                       window=tf_window,
+                                                       overlap=tf_overlap,
+                                                       estimator=tf_estimator,
+                                                       workers=tf_workers)
+
+    # Only select frequencies used touched by the chirp
+    id_0= np.searchsorted(w, 0.1 - 0.01)
+    id_1= np.searchsorted(w, 50 - 0.01)
+    w_f = w[id_0:id_1+1]
+    mag_f = mag[id_0:id_1+1]
+    phase_f = phase[id_0:id_1+1]
+    if np.mean(phase_f)<-2*np.pi:
+        phase_f = phase_f + 2*np.pi
+    elif np.mean(phase_f)>0:
+        phase_f = phase_f - 2*np.pi
+    complex_f = 10**(mag_f/20) * np.exp(1j*phase_f)
+
+    # Filter signal
+    if coherence is None:
+        b,a = signal.butter(2, 0.002, btype='lowpass')
+        # padlen is needed: see https://dsp.stackexchange.com/questions/11466/#47945
+        mag_filt = signal.filtfilt(b,a, mag_f, padlen=3*(max(len(b),len(a))-1))
+        phase_filt = signal.filtfilt(b,a, phase_f, padlen=3*(max(len(b),len(a))-1))
+    else:
+        # the segment average is already smooth and too coarse for the 0.002 cutoff
+        mag_filt = mag_f
+        phase_filt = phase_f
+        coherence_f = coherence[id_0:id_1+1]
+        print('[i] Mean coherence: {:.3f}'.format(np.mean(coherence_f)))
+    # while testing we found that using complex_f form filtered frequencies gave worse results
+    # complex_f = [(10**(m/20))*np.exp(1j*p) for m,p in zip(mag_filt, phase_filt)]
+
+    # get first estimate of natural freq and dc gain
+    wf_0=w_f[np.where(mag_filt == max(mag_filt))][0]
+    torque_const = float(out_dict['results']['flash_params']['motorTorqueConstant']) * float(out_dict['results']['flash_params']['Motor_gear_ratio'])
+
+    print("[i] Starting scipy.least_squares")
+    fits = {}
+    models = []
+    for n_poles, n_zeros in tf_models:
+        name = f'lsq{n_poles}{n_zeros}'
+        if name == 'lsq20':
+            # k*wf^2/(s^2+s*z*wf+wf^2), with p=[g,ωf,ζ] = [torque_const, wf_0, 1/sqrt(wf_0)]
+            p0 = [torque_const*wf_0**2, math.sqrt(wf_0), wf_0**2]
+        else:
+            p0 = fit_tf.guess_from_2nd_order(fits['lsq20']['k'], fits['lsq20']['wn'], fits['lsq20']['zeta']/2, n_poles, n_zeros)
+        print(f"guess_{name}: ", p0)
+        fit = fit_tf.fit_tf(w_f, complex_f, n_poles, n_zeros, p0)
+        fit['tf'] = control.TransferFunction(fit['num'], fit['den'])
+        fit['k'] = float(fit['tf'].dcgain())
+        if name == 'lsq20':
+            fit['wn'] = math.sqrt(fit['den'][2])
+            fit['zeta'] = fit['den'][1]/fit['wn']
+        fits[name] = fit
+        models.append((f'model({n_poles},{n_zeros})', fit['h']))
+        print(f"param_{name}: ", fit['p'])
+        print(f"NRMSE_{name}: ", fit['NRMSE'])
+        print(f"[i] {name} fitted in {fit['time']*1000:.1f} ms ({fit['nfev']} function, {fit['njev']} jacobian evaluations)")
+        if not fit['success']:
+            print(f"[!] {name} fit did not converge")
+        print(f"TF_{name}: ", fit['tf'])
+
+    # plot bode, over logarithmic and linear frequency
+    plot_utils.render(plot_bode, w_f, mag_f, mag_filt, phase_f, phase_filt, models, fig_name=image_base_path + '_2.png', show=plot_all)
+    plot_utils.render(plot_bode, w_f, mag_f, mag_filt, phase_f, phase_filt, models, fig_name=image_base_path + '_3.png',
+                      log_scale=False, show=plot_all)
 
     if not('results' in out_dict):
         out_dict['results'] = {}
 
     out_dict['results']['frequency_response']={}
-    out_dict['results']['frequency_response']['lsq20'] = {}
-    out_dict['results']['frequency_response']['lsq20']['k'] = float(p_lsq20[0])
-    out_dict['results']['frequency_response']['lsq20']['wn'] = float(p_lsq20[1])
-    out_dict['results']['frequency_response']['lsq20']['zeta'] = float(p_lsq20[2])
-    out_dict['results']['frequency_response']['lsq20']['num'] = [float(v) for v in tf_lsq20.num[0][0]]
-    out_dict['results']['frequency_response']['lsq20']['den'] = [float(v) for v in tf_lsq20.den[0][0]]
-    out_dict['results']['frequency_response']['lsq20']['NRMSE'] = float(NRMSE_lsq20)
-    out_dict['results']['frequency_response']['lsq31'] = {}
-    out_dict['results']['frequency_response']['lsq31']['k'] = float(tf_lsq31.dcgain())
-    out_dict['results']['frequency_response']['lsq31']['num'] = [float(v) for v in tf_lsq31.num[0][0]]
-    out_dict['results']['frequency_response']['lsq31']['den'] = [float(v) for v in tf_lsq31.den[0][0]]
-    out_dict['results']['frequency_response']['lsq31']['NRMSE'] = float(NRMSE_lsq31)
-
-    with open(yaml_file, 'w', encoding='utf8') as outfile:
-        yaml.dump(out_dict, outfile, default_flow_style=False, allow_unicode=True)
+    out_dict['results']['frequency_response']['estimator'] = tf_estimator
+    if coherence is not None:
+        out_dict['results']['frequency_response']['mean_coherence'] = float(np.mean(coherence_f))
+        out_dict['results']['frequency_response']['min_coherence'] = float(np.min(coherence_f))
+    for name, fit in fits.items():
+        out_dict['results']['frequency_response'][name] = {}
+        out_dict['results']['frequency_response'][name]['k'] = fit['k']
+        if name == 'lsq20':
+            out_dict['results']['frequency_response'][name]['wn'] = float(fit['wn'])
+            out_dict['results']['frequency_response'][name]['zeta'] = float(fit['zeta'])
+        out_dict['results']['frequency_response'][name]['num'] = [float(v) for v in fit['tf'].num[0][0]]
+        out_dict['results']['frequency_response'][name]['den'] = [float(v) for v in fit['tf'].den[0][0]]
+        out_dict['results']['frequency_response'][name]['NRMSE'] = float(fit['NRMSE'])
+        out_dict['results']['frequency_response'][name]['fit_time'] = float(fit['time'])
+        out_dict['results']['frequency_response'][name]['nfev'] = fit['nfev']
+        out_dict['results']['frequency_response'][name]['njev'] = fit['njev']
+
+    log_utils.save_yaml(yaml_file, out_dict)
+
+    # ru_maxrss is in kB on linux
+    print('[i] Peak memory usage: {:.1f} MB'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
     return yaml_file
 
 if __name__ == "__main__":
     plot_utils.print_alberobotics()
     print(plot_utils.bcolors.OKBLUE + "[i] Starting process_current_free_smooth" + plot_utils.bcolors.ENDC)
     yaml_file = process(yaml_file=sys.argv[1], plot_all=False)
+    plot_utils.flush()
 
     print(plot_utils.bcolors.OKGREEN + u'[\u2713] Ending program successfully' + plot_utils.bcolors.ENDC)
@@ -8,11 +8,12 @@ import pandas as pd
 import numpy as np
 
 from os import path
-from math import sqrt
 from pprint import pprint
 from copy import deepcopy
 from collections.abc import Mapping
-from sklearn.metrics import mean_squared_error
+from itertools import product
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from scipy import signal
 
 #import costum files
 import sys
@@ -22,6 +23,19 @@ from matplotlib import use as plt_use
 plt_use("Agg")
 import matplotlib.pyplot as plt
 
+try:
+    from utils import log_utils
+    from utils import sim_utils
+    from utils import segment_utils
+    from utils import metrics_utils
+    from utils import plot_utils
+except ImportError:
+    import log_utils
+    import sim_utils
+    import segment_utils
+    import metrics_utils
+    import plot_utils
+
 from friction_calibration_tool.utils_module.motor import MotorData
 from friction_calibration_tool.utils_module.trajectory import TrjInfo, MultisineTrjInfo
 from friction_calibration_tool.utils_module.simulation import Simulation
@@ -36,11 +50,186 @@ from friction_calibration_tool.regression.concrete import ( NonLinearRegression,
                                                               scipy_lsq_linear_strategy)
 
 
-#calculate RMSE
-def RMSE(actual, pred):
-    return sqrt(mean_squared_error(actual, pred)) / np.std(pred)
+def predict_many(model, pos=None, vel=None, acc=None, num_of_checks=16):
+    '''model.predict over whole trajectories: returns the prediction of every sample as an array.
+    Models with a predict_many method use it. Otherwise predict is called once on the arrays, which works for models written
+    with numpy operations; the result is checked against per-sample predictions on a few samples, and if the model cannot
+    handle arrays it is evaluated one sample at a time'''
+    if hasattr(model, 'predict_many'):
+        return np.asarray(model.predict_many(pos, vel, acc), dtype=float)
+
+    args = [None if a is None else np.asarray(a, dtype=float) for a in (pos, vel, acc)]
+    n = max(len(a) for a in args if a is not None)
+    def one(i):
+        return model.predict(*[None if a is None else a[i] for a in args], None)
+
+    try:
+        pred = np.broadcast_to(np.asarray(model.predict(*args, None), dtype=float), (n,))
+        checks = np.unique(np.linspace(0, n - 1, num_of_checks).astype(int)) if n else []
+        if np.allclose([pred[i] for i in checks], [one(i) for i in checks], rtol=1e-9, atol=1e-12):
+            return np.array(pred)
+    except (ValueError, TypeError):
+        pass
+    return np.fromiter((one(i) for i in range(n)), dtype=float, count=n)
+
+def lowpass_batches(df, columns, cutoff, samp_freq, order=2, workers=None):
+    '''Zero-phase Butterworth low-pass of the given columns of df, in place, each batch (run of rows with the same batch_id) on its own.
+    Batches of the same length are stacked and filtered, all columns at once, with a single sosfiltfilt call;
+    the groups of batches are spread over a thread pool (sosfiltfilt runs without the GIL)'''
+    sos = signal.butter(order, cutoff, fs=samp_freq, output='sos')
+    batches = segment_utils.Segments.from_changes(df['batch_id'].to_numpy())
+    data = np.stack([df[c].to_numpy(dtype=float) for c in columns])
+    out = data.copy()
+
+    def filter_group(length):
+        starts = batches.starts[batches.lengths == length]
+        idx = starts[:, None] + np.arange(length)
+        # short batches are padded as much as they allow
+        padlen = min(3 * (2 * len(sos) + 1), length - 1)
+        out[:, idx] = signal.sosfiltfilt(sos, data[:, idx], axis=-1, padlen=padlen)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(filter_group, np.unique(batches.lengths)))
+    for c, col in zip(columns, out):
+        df[c] = col
+
+def fit_friction(pos, vel, acc, lhs, samp_freq, min_gamma, max_gamma, init_gamma=1000):
+    '''Non linear regression of the friction model on lhs = tau_m - tau_l, with gamma in [min_gamma, max_gamma] starting from init_gamma'''
+    friction_model = motor_terms.NonLinearFriction(pos, vel, acc, lhs, samp_freq, init_gamma=init_gamma)
+    regression = NonLinearRegression(lower_bound=min_gamma, upperbound=max_gamma)
+    regression.set_pos_vel_acc(pos, vel, acc)
+    regression.set_samp_freq(samp_freq)
+    regression.set_lhs(lhs)
+    regression.add_model(friction_model)
+    param_dict = regression.solve()
+    return regression, friction_model, param_dict
+
+def _sweep_window(pos, vel, acc, lhs, samp_freq, vel_window, gamma_bounds, init_gamma):
+    # fits of one velocity window, over the gamma bounds in order, each one starting from the gamma found by the
+    # previous one when it is within the bounds (otherwise from init_gamma, clipped to them)
+    min_const_vel, max_const_vel = vel_window
+    window = (vel >= min_const_vel) & (vel <= max_const_vel)
+    rows = []
+    previous = None
+    for min_gamma, max_gamma in gamma_bounds:
+        row = {'min_const_vel': float(min_const_vel), 'max_const_vel': float(max_const_vel),
+               'min_gamma': float(min_gamma), 'max_gamma': float(max_gamma), 'samples': int(np.sum(window))}
+        if row['samples'] < 10:
+            row['error'] = 'not enough samples'
+            rows.append(row)
+            continue
+        if previous is not None and min_gamma <= previous <= max_gamma:
+            start = previous
+        else:
+            start = float(np.clip(init_gamma, min_gamma, max_gamma))
+        try:
+            regression, friction_model, _ = fit_friction(pos[window], vel[window], acc[window], lhs[window], samp_freq,
+                                                         min_gamma, max_gamma, init_gamma=start)
+        except Exception as e:
+            row['error'] = str(e)
+            rows.append(row)
+            continue
+        params = dict(regression.get_param_dict())
+        params.update(friction_model.coulomb_frict.get_param_dict())
+        params.update(friction_model.viscous_frict.get_param_dict())
+        for k in ('gamma_c', 'gamma_v', 'dc_plus', 'dc_minus', 'dv_plus', 'dv_minus'):
+            row[k] = float(params[k])
+        row['friction_RMSE'] = float(metrics_utils.rmse(lhs[window], predict_many(regression.get_model_copy(), vel=vel[window])))
+        rows.append(row)
+        previous = row['gamma_c']
+    return rows
+
+def sweep_friction(pos, vel, acc, lhs, samp_freq, gamma_bounds, vel_windows, init_gamma=1000, workers=None):
+    '''Fit the friction model on every combination of gamma bounds and velocity window.
+    Velocity windows run in parallel (one process each); within a window the gamma bounds are fitted in increasing order,
+    warm starting each fit from the neighbouring solution. Returns one row per combination and the best one (lowest friction_RMSE)'''
+    pos, vel, acc, lhs = (np.asarray(a, dtype=float) for a in (pos, vel, acc, lhs))
+    gamma_bounds = sorted((float(lo), float(hi)) for lo, hi in gamma_bounds)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_sweep_window, pos, vel, acc, lhs, samp_freq, window, gamma_bounds, init_gamma)
+                   for window in vel_windows]
+        table = [row for f in futures for row in f.result()]
+    fitted = [row for row in table if 'friction_RMSE' in row]
+    best = min(fitted, key=lambda row: row['friction_RMSE']) if fitted else None
+    return table, best
 
 #process friction and inertia
+def plot_friction(motor_vel, lhs, vel_range, modeled_friction, fig_name, figsize=(6,4), dpi=300, show=False):
+    '''Friction torque (tau_m - tau_l) vs velocity, with the model'''
+    f, axs = plt.subplots(figsize=figsize, dpi=dpi)
+    plot_utils.plot(axs, motor_vel, lhs, '*', color='#8e8e8e', markersize=0.5, label='tau_m - tau_l')
+    axs.plot(vel_range, modeled_friction, color='#ff7f0e', markersize=0.8, label='model')
+    axs.set_xlabel('Velocity (rad/s)'), axs.set_ylabel('Torque (Nm)')
+    axs.grid(b=True, which='major', axis='y', linestyle=':')
+    axs.spines['top'].set_visible(False)
+    axs.spines['right'].set_visible(False)
+    # axs.spines['left'].set_visible(False)
+    # axs.title(title)
+    axs.legend()
+    f.savefig(fname=fig_name, bbox_inches='tight')
+    print('[i] Saved graph as: ' + fig_name)
+    if show:
+        plt.show()
+
+
+def plot_friction_time(time, lhs, predicted_friction, fig_name, figsize=(6,4), dpi=300, show=False):
+    f = plt.figure(figsize=figsize, dpi=dpi)
+    plot_utils.plot(plt.gca(), time, lhs, 'b*', label='actual: tau_m - tau_l')
+    plot_utils.plot(plt.gca(), time, predicted_friction,'r*' , label='predicted: tau_m - tau_l')
+    plt.xlabel('time [s]'), plt.ylabel('Torque [Nm]')
+    # plt.title(title)
+    plt.legend()
+    f.savefig(fname=fig_name, bbox_inches='tight')
+    print('[i] Saved graph as: ' + fig_name)
+    if show:
+        plt.show()
+
+
+def plot_error_hist(error, fig_name, figsize=(6,4), dpi=300, show=False):
+    f = plt.figure(figsize=figsize, dpi=dpi)
+    plt.hist(error, 200, label='error [Nm]')
+    plt.xlabel('Torque [Nm]')
+    # plt.title(title)
+    plt.legend()
+    f.savefig(fname=fig_name, bbox_inches='tight')
+    print('[i] Saved graph as: ' + fig_name)
+    if show:
+        plt.show()
+
+
+def plot_error_vs_vel(motor_vel, error, fig_name, figsize=(6,4), dpi=300, show=False):
+    f = plt.figure(figsize=figsize, dpi=dpi)
+    plot_utils.plot(plt.gca(), motor_vel, error, '*', label='error [Nm]')
+    plt.xlabel('w [rad/s]'), plt.ylabel('Torque [Nm]')
+    # plt.title(title)
+    plt.legend()
+    f.savefig(fname=fig_name, bbox_inches='tight')
+    print('[i] Saved graph as: ' + fig_name)
+    if show:
+        plt.show()
+
+
+def plot_simulation(pos_log, pos_sim, fig_name, figsize=(6,4), dpi=300, show=False):
+    '''Measured and simulated position of the multisine trajectory'''
+    f, axs = plt.subplots(figsize=figsize, dpi=dpi)
+    plot_utils.plot(axs, np.arange(len(pos_sim)), pos_log, label='original')
+    plot_utils.plot(axs, np.arange(len(pos_sim)), pos_sim, label='model')
+    axs.set_xlabel('time [ms]'), axs.set_ylabel('Theta [rad]')
+
+    axs.axhline(0, color='black', lw=0.75)
+    # axs.axvline(0, color='black')#, lw=1.2)
+    axs.grid(b=True, which='major', axis='y', linestyle=':')
+    axs.set_xlim(0, len(pos_sim))
+    axs.spines['top'].set_visible(False)
+    axs.spines['right'].set_visible(False)
+    # axs.spines['left'].set_visible(False)
+    axs.legend()
+    f.savefig(fname=fig_name, bbox_inches='tight')
+    print('[i] Saved graph as: ' + fig_name)
+    if show:
+        plt.show()
+
+
 def process(yaml_file,
             verbose=False,
             min_gamma=1000.,
@@ -48,7 +237,14 @@ def process(yaml_file,
             min_const_vel=-np.inf,
             max_const_vel=np.inf,
             const_vel_lowpass_cutoff=None,
+            const_vel_lowpass_order=2,
+            lowpass_workers=None,
+            sweep_gamma=None,
+            sweep_const_vel=None,
+            sweep_workers=None,
             run_simulation=True,
+            simulation_backend='ode',
+            simulation_segments=1,
             save_cvs=False,
             plot_all=False):
 
@@ -95,13 +291,8 @@ def process(yaml_file,
 
     # filter motor current and link torque
     if const_vel_lowpass_cutoff is not None:
-        dfs = []
-        for batch in range(motor_df.df['batch_id'].nunique()):
-            df = motor_df.range('batch_id', batch, batch).filter(['aux'], const_vel_lowpass_cutoff)
-            df = df.range('batch_id', batch, batch).filter(['torque'], const_vel_lowpass_cutoff)
-            dfs.append(df.df)
-
-        motor_df = MotorDf.Concat(dfs)
+        lowpass_batches(motor_df.df, ['aux', 'torque'], const_vel_lowpass_cutoff, samp_freq,
+                        order=const_vel_lowpass_order, workers=lowpass_workers)
 
     const_vel_data_dict = motor_df.to_dict()
     const_vel_trj = TrjInfo(samp_freq)
@@ -127,29 +318,38 @@ def process(yaml_file,
                                      trans_time=motor_yaml['calib_inertia']['trans_time'])
     multisine_motor = MotorData.from_dict(multisine_data_dict, multisine_trj, k_tau=k_tau, gear_ratio=gear_ratio)
 
-    non_lin_friction_model = motor_terms.NonLinearFriction(const_vel_trj.pos, const_vel_trj.vel, const_vel_trj.acc, cons_vel_trj_lhs,
-                                                           const_vel_trj.samp_freq, init_gamma=1000)
-
-    non_linear_regression = NonLinearRegression(lower_bound=min_gamma, upperbound=max_gamma)
-    non_linear_regression.set_pos_vel_acc(const_vel_trj.pos, const_vel_trj.vel, const_vel_trj.acc)
-    non_linear_regression.set_samp_freq(const_vel_trj.samp_freq)
-    non_linear_regression.set_lhs(cons_vel_trj_lhs)
-    non_linear_regression.add_model(non_lin_friction_model)
-    non_lin_param_dict = non_linear_regression.solve()
+    non_linear_regression, non_lin_friction_model, non_lin_param_dict = fit_friction(
+        const_vel_trj.pos, const_vel_trj.vel, const_vel_trj.acc, cons_vel_trj_lhs, const_vel_trj.samp_freq,
+        min_gamma, max_gamma, init_gamma=1000)
     if verbose:
         pprint(non_lin_param_dict)
 
+    # compare other gamma bounds and velocity windows (within the loaded one), starting from this solution
+    if sweep_gamma is not None or sweep_const_vel is not None:
+        print('[i] Started gamma and velocity window sweep')
+        sweep_table, sweep_best = sweep_friction(
+            const_vel_trj.pos, const_vel_trj.vel, const_vel_trj.acc, cons_vel_trj_lhs, const_vel_trj.samp_freq,
+            gamma_bounds=sweep_gamma if sweep_gamma is not None else [(min_gamma, max_gamma)],
+            vel_windows=sweep_const_vel if sweep_const_vel is not None else [(min_const_vel, max_const_vel)],
+            init_gamma=non_lin_param_dict['gamma_c'],
+            workers=sweep_workers)
+        print(' min_vel\t max_vel\t min_gamma\t max_gamma\t gamma_c\t gamma_v\t RMSE')
+        for row in sweep_table:
+            print(' {:.3f}\t {:.3f}\t {:.1f}\t {:.1f}\t '.format(row['min_const_vel'], row['max_const_vel'], row['min_gamma'], row['max_gamma']) +
+                  ('{:.1f}\t {:.1f}\t {:.5f}'.format(row['gamma_c'], row['gamma_v'], row['friction_RMSE']) if 'friction_RMSE' in row else row['error']))
+
     friction_model = non_linear_regression.get_model_copy()
-    predicted_friction = [friction_model.predict(None, vel, None, None) for vel in motor_df['motor_vel']]
+    # every prediction is computed once, and shared by the statistics and the plots
+    predicted_friction = predict_many(friction_model, vel=motor_df['motor_vel'])
     actual_friction = cons_vel_trj_lhs
-    friction_rmse = RMSE(actual_friction, predicted_friction)
-    friction_nrmse = friction_rmse / np.std(predicted_friction)
+    friction_stats = metrics_utils.error_stats(actual_friction, predicted_friction)
+    friction_rmse = friction_stats.rmse
+    friction_nrmse = friction_stats.nrmse('std')
 
-    multisine_trj_zip = list(zip(multisine_motor.pos, multisine_motor.vel, multisine_motor.acc))
     no_offset_multisine_trj_tau_l = multisine_motor.torque - tau_l_offset
 
-    multisine_trj_friction = [friction_model.predict(None, vel, None, None) for pos, vel, acc in multisine_trj_zip]
-    multisine_trj_lhs = multisine_motor.tau_m - np.array(multisine_trj_friction) - no_offset_multisine_trj_tau_l
+    multisine_trj_friction = predict_many(friction_model, vel=multisine_motor.vel)
+    multisine_trj_lhs = multisine_motor.tau_m - multisine_trj_friction - no_offset_multisine_trj_tau_l
 
     inertia = motor_terms.MotorInertia()
     regressor = LinearRegressor(huber_regr_strategy)
@@ -164,10 +364,11 @@ def process(yaml_file,
 
     inertia_model = linear_regression.get_model_copy()
 
-    predicted_inertia_torque = [inertia_model.predict(pos, vel, acc, None) for pos, vel, acc in multisine_trj_zip]
+    predicted_inertia_torque = predict_many(inertia_model, multisine_motor.pos, multisine_motor.vel, multisine_motor.acc)
     actual_inertia_torque = multisine_trj_lhs
-    inertia_rmse = RMSE(actual_inertia_torque, predicted_inertia_torque)
-    inertia_nrmse = inertia_rmse / np.std(predicted_inertia_torque)
+    inertia_stats = metrics_utils.error_stats(actual_inertia_torque, predicted_inertia_torque)
+    inertia_rmse = inertia_stats.rmse
+    inertia_nrmse = inertia_stats.nrmse('std')
 
     motor_model = CompositeModel()
     motor_model.push(friction_model)
@@ -198,6 +399,7 @@ def process(yaml_file,
     results.update({'actual_motor_inertia': motor_yaml['results']['flash_params']['gearedMotorInertia']})
     results.update({'friction_RMSE': friction_rmse, 'inertia_RMSE': inertia_rmse})
     results.update({'friction_NRMSE': friction_nrmse, 'inertia_NRMSE': inertia_nrmse})
+    results.update({'friction_max_error': friction_stats.max_error, 'inertia_max_error': inertia_stats.max_error})
 
     # save resultsto cvs
     df = pd.DataFrame(results, index=(code_string[:-6],))
@@ -210,91 +412,66 @@ def process(yaml_file,
     extension = ".png"
     dpi = 300
 
-    f, axs = plt.subplots(figsize=figsize, dpi=dpi)
     params = non_lin_friction_model.coulomb_frict.get_param_dict()
     params.update(non_lin_friction_model.viscous_frict.get_param_dict())
-    axs.plot(motor_df['motor_vel'], motor_df['lhs'], '*', color='#8e8e8e', markersize=0.5, label='tau_m - tau_l')
     vel_range = np.arange(min(const_vel_trj.vel), max(const_vel_trj.vel), 1 / const_vel_trj.samp_freq)
-    modeled_friction = [friction_model.predict(None, vel, None, None) for vel in vel_range]
-    axs.plot(vel_range, modeled_friction, color='#ff7f0e', markersize=0.8, label='model')
-    # axs.plot(vel_full, modeled_friction_full, 'r', label='modeled_friction:\n - gamma_c: {:.3f}\n - gamma_v: {:.3f}\n - dc_minus: {:.3f}\n - dc_plus {:.3f}\n - dv_minus: {:.3f}\n - dv_plus {:.3f}'.format(
-    #   non_lin_param_dict["gamma_c"], non_lin_param_dict["gamma_v"], params["dc_minus"], params["dc_plus"], params["dv_minus"], params["dv_plus"]))
-    axs.set_xlabel('Velocity (rad/s)'), axs.set_ylabel('Torque (Nm)')
-    axs.grid(b=True, which='major', axis='y', linestyle=':')
-    axs.spines['top'].set_visible(False)
-    axs.spines['right'].set_visible(False)
-    # axs.spines['left'].set_visible(False)
-    # axs.title(title)
-    axs.legend()
+    modeled_friction = predict_many(friction_model, vel=vel_range)
+    motor_vel = np.asarray(motor_df['motor_vel'])
+    motor_lhs = np.asarray(motor_df['lhs'])
+    error = np.array(actual_friction) - predicted_friction
+
     fname = f"{code_string}_friction-calib_torque-vs-w{extension}"
-    f.savefig(fname=os.path.join(save_path, fname), format=extension[1:], bbox_inches='tight')
-    print('[i] Saved graph as: ' + str(os.path.join(save_path, fname)))
+    plot_utils.render(plot_friction, motor_vel, motor_lhs, vel_range, modeled_friction,
+                      fig_name=os.path.join(save_path, fname), figsize=figsize, dpi=dpi, show=plot_all)
 
-    f = plt.figure(figsize=figsize, dpi=dpi)
-    plt.plot(motor_df['time'], motor_df['lhs'], 'b*', label='actual: tau_m - tau_l')
-    plt.plot(motor_df['time'], [friction_model.predict(None, vel, None, None) for vel in motor_df['motor_vel']],'r*' , label='predicted: tau_m - tau_l')
-    plt.xlabel('time [s]'), plt.ylabel('Torque [Nm]')
-    # plt.title(title)
-    plt.legend()
     fname = f"{code_string}_friction-calib_torque-vs-time{extension}"
-    f.savefig(fname=os.path.join(save_path, fname), format=extension[1:], bbox_inches='tight')
-    print('[i] Saved graph as: ' + str(os.path.join(save_path, fname)))
+    plot_utils.render(plot_friction_time, np.asarray(motor_df['time']), motor_lhs, predicted_friction,
+                      fig_name=os.path.join(save_path, fname), figsize=figsize, dpi=dpi, show=plot_all)
 
-    error = np.array(actual_friction) - np.array(predicted_friction) #motor_df.df['lhs'].to_numpy() - np.array([friction_model.predict(None, vel, None, None) for vel in motor_df['motor_vel']])
-
-    f = plt.figure(figsize=figsize, dpi=dpi)
-    plt.hist(error, 200, label='error [Nm]')
-    plt.xlabel('Torque [Nm]')
-    # plt.title(title)
-    plt.legend()
     fname = f"{code_string}_friction-calib_error-hist{extension}"
-    f.savefig(fname=os.path.join(save_path, fname), format=extension[1:], bbox_inches='tight')
-    print('[i] Saved graph as: ' + str(os.path.join(save_path, fname)))
+    plot_utils.render(plot_error_hist, error,
+                      fig_name=os.path.join(save_path, fname), figsize=figsize, dpi=dpi, show=plot_all)
 
-    f = plt.figure(figsize=figsize, dpi=dpi)
-    plt.plot(motor_df['motor_vel'], error, '*', label='error [Nm]')
-    plt.xlabel('w [rad/s]'), plt.ylabel('Torque [Nm]')
-    # plt.title(title)
-    plt.legend()
     fname = f"{code_string}_friction-calib_error-vs-w{extension}"
-    f.savefig(fname=os.path.join(save_path, fname), format=extension[1:], bbox_inches='tight')
-    print('[i] Saved graph as: ' + str(os.path.join(save_path, fname)))
+    plot_utils.render(plot_error_vs_vel, motor_vel, error,
+                      fig_name=os.path.join(save_path, fname), figsize=figsize, dpi=dpi, show=plot_all)
 
     if run_simulation:
-        simulation = Simulation()
-        simulation.set_init_conditions(multisine_motor)
-        simulation.set_time_interval(multisine_trj)
-        simulation.set_model(motor_model)
-        simulation.set_motor_torque(multisine_motor)
         print('[i] Started simulation')
-        pos, vel = simulation.solve_ODE()
+        if simulation_backend == 'fixed_step':
+            # same model and motor torque input as Simulation, with the fitted inertia
+            pos, vel = sim_utils.simulate(tau=multisine_motor.tau_m,
+                                          pos=multisine_motor.pos,
+                                          vel=multisine_motor.vel,
+                                          samp_freq=multisine_motor.samp_freq,
+                                          inertia=float(linear_regression.get_param_dict()['motor_inertia']),
+                                          friction=lambda v: predict_many(friction_model, vel=v),
+                                          segments=simulation_segments)
+        elif simulation_backend == 'ode':
+            simulation = Simulation()
+            simulation.set_init_conditions(multisine_motor)
+            simulation.set_time_interval(multisine_trj)
+            simulation.set_model(motor_model)
+            simulation.set_motor_torque(multisine_motor)
+            pos, vel = simulation.solve_ODE()
+        else:
+            raise Exception(f"unknown simulation backend '{simulation_backend}'")
         print('[i] Simulation completed')
 
-        position_rmse = RMSE(multisine_motor.pos[:-2], pos)
-        position_nrmse = position_rmse / np.std(pos)
+        position_stats = metrics_utils.error_stats(multisine_motor.pos[:len(pos)], pos)
+        position_rmse = position_stats.rmse
+        position_nrmse = position_stats.nrmse('std')
 
-        velocity_rmse = RMSE(multisine_motor.vel[:-2], vel)
-        velocity_nrmse = position_rmse / np.std(vel)
+        velocity_stats = metrics_utils.error_stats(multisine_motor.vel[:len(vel)], vel)
+        velocity_rmse = velocity_stats.rmse
+        velocity_nrmse = velocity_stats.nrmse('std')
 
         results.update({'position_RMSE': position_rmse, 'velocity_RMSE': velocity_rmse})
         results.update({'position_NRMSE': position_nrmse, 'velocity_NRMSE': velocity_nrmse})
 
-        f, axs = plt.subplots(figsize=figsize, dpi=dpi)
-        axs.plot(multisine_motor.pos[:-2], label='original')
-        axs.plot(pos, label='model')
-        axs.set_xlabel('time [ms]'), axs.set_ylabel('Theta [rad]')
-
-        axs.axhline(0, color='black', lw=0.75)
-        # axs.axvline(0, color='black')#, lw=1.2)
-        axs.grid(b=True, which='major', axis='y', linestyle=':')
-        axs.set_xlim(0, len(pos))
-        axs.spines['top'].set_visible(False)
-        axs.spines['right'].set_visible(False)
-        # axs.spines['left'].set_visible(False)
-        axs.legend()
         fname = f"{code_string}_friction-calib_simulation{extension}"
-        f.savefig(fname=os.path.join(save_path, fname), format=extension[1:], bbox_inches='tight')
-        print('[i] Saved graph as: ' + str(os.path.join(save_path, fname)))
+        plot_utils.render(plot_simulation, np.asarray(multisine_motor.pos[:len(pos)]), np.asarray(pos),
+                          fig_name=os.path.join(save_path, fname), figsize=figsize, dpi=dpi, show=plot_all)
 
     # Print results
     print("[i] Results:")
@@ -330,6 +507,8 @@ def process(yaml_file,
     motor_yaml['results']['friction']['statistics']['inertia_model_NRMSE'] = float(results['inertia_NRMSE'])
     motor_yaml['results']['friction']['statistics']['friction_model_RMSE'] = float(results['friction_RMSE'])
     motor_yaml['results']['friction']['statistics']['friction_model_NRMSE'] = float(results['friction_NRMSE'])
+    motor_yaml['results']['friction']['statistics']['inertia_model_max_error'] = float(results['inertia_max_error'])
+    motor_yaml['results']['friction']['statistics']['friction_model_max_error'] = float(results['friction_max_error'])
     if run_simulation:
         motor_yaml['results']['friction']['statistics']['position_model_RMSE'] = float(results['position_RMSE'])
         motor_yaml['results']['friction']['statistics']['position_model_NRMSE'] = float(results['position_NRMSE'])
@@ -337,12 +516,13 @@ def process(yaml_file,
         motor_yaml['results']['friction']['statistics']['velocity_model_NRMSE'] = float(results['velocity_NRMSE'])
 
 
-    with open(yaml_file, 'w', encoding='utf8') as outfile:
-        yaml.dump(motor_yaml, outfile, default_flow_style=False, allow_unicode=True)
-    print('[i] Saved results in: ' + yaml_file)
+    if sweep_gamma is not None or sweep_const_vel is not None:
+        motor_yaml['results']['friction']['sweep'] = {}
+        motor_yaml['results']['friction']['sweep']['table'] = sweep_table
+        motor_yaml['results']['friction']['sweep']['best'] = sweep_best
 
-    if plot_all:
-        plt.show()
+    log_utils.save_yaml(yaml_file, motor_yaml)
+    print('[i] Saved results in: ' + yaml_file)
 
 
 if __name__ == '__main__':
@@ -355,10 +535,21 @@ if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('yaml_file', type=str, help="the path of the calibration yaml file")
+    parser.add_argument('--sweep-gamma', type=float, nargs=2, action='append', metavar=('MIN', 'MAX'), help="gamma bounds to compare (repeatable)")
+    parser.add_argument('--sweep-vel', type=float, nargs=2, action='append', metavar=('MIN', 'MAX'), help="constant velocity windows to compare (repeatable)")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="parallel processes of the sweep (default: one per core)")
+    parser.add_argument('--simulation', type=str, choices=['ode', 'fixed_step'], default='ode', help="backend of the multisine simulation (default: ode)")
+    parser.add_argument('--simulation-segments', type=int, default=1, help="segments simulated at once by the fixed_step backend")
     args = parser.parse_args()
     process(yaml_file=args.yaml_file,
             min_gamma=min_gamma,
             max_gamma=max_gamma,
             min_const_vel=min_const_vel,
             max_const_vel=max_const_vel,
-            const_vel_lowpass_cutoff=const_vel_lowpass_cutoff)
+            const_vel_lowpass_cutoff=const_vel_lowpass_cutoff,
+            sweep_gamma=args.sweep_gamma,
+            sweep_const_vel=args.sweep_vel,
+            sweep_workers=args.jobs,
+            simulation_backend=args.simulation,
+            simulation_segments=args.simulation_segments)
+    plot_utils.flush()
@@ -6,15 +6,80 @@ import sys
 import glob
 import yaml
 import numpy as np
+from scipy import signal
 from matplotlib import pyplot as plt
 
 #import costum
 try:
     from utils import plot_utils
+    from utils import log_utils
+    from utils import segment_utils
 except ImportError:
     import plot_utils
+    import log_utils
+    import segment_utils
 
-def process(yaml_file, plot_all=False):
+def plot_phase(keys_1, vals_1, keys_2, vals_2, fit_1, fit_2, fit_angle, fit_value, xlim, fig_name, show=False):
+    '''Velocity amplitude vs phase angle of the two rounds (repeated one turn before), with the fitted parabolas
+    fit_1 and fit_2 (x, y) and the best angle'''
+    fig, axs = plt.subplots()
+
+    l1, = axs.plot(keys_1, vals_1, color='#1f77b4', marker='.', linestyle='--')
+    l2, = axs.plot(keys_2, vals_2, color='#ff7f0e', marker='.', linestyle='-')
+
+    keys_1s = [v - 2 * np.pi for v in keys_1]
+    keys_2s = [v - 2 * np.pi for v in keys_2]
+    axs.plot(keys_1s, vals_1, color='#1f77b4', marker='.', linestyle='--')
+    axs.plot(keys_2s, vals_2, color='#ff7f0e', marker='.', linestyle='-')
+
+    l3, = axs.plot(fit_1[0], fit_1[1], color='#2ca02c', linestyle=':')
+    axs.plot(fit_2[0], fit_2[1], color='#2ca02c', linestyle=':')
+
+    axs.set_xlim(*xlim)
+    l4, = axs.plot(fit_angle,
+                   fit_value,
+                   color='r',
+                   marker='x',
+                   linestyle='None')
+
+    # make plot pretty
+    #fig.suptitle('Result: ph_angle = {:.3f}'.format(fit_angle))
+    axs.set_ylabel('max velocity (mrad/s)')
+    axs.set_xlabel('phase angle (rad)')
+    axs.grid(b=True, which='major', axis='x', linestyle=':')
+    axs.grid(b=True, which='major', axis='y', linestyle='-')
+    axs.grid(b=True, which='minor', axis='y', linestyle=':')
+
+    axs.axvline(0, color='black', lw=1.2)
+    axs.set_ylim(min(vals_1) * 1.1, max(vals_2) * 1.1)
+    axs.yaxis.set_major_locator(
+        plt.MultipleLocator((max(vals_1) - min(vals_1)) * 1.1 / 6))
+    axs.yaxis.set_minor_locator(
+        plt.MultipleLocator((max(vals_1) - min(vals_1)) * 1.1 / 18))
+
+    axs.axhline(0, color='black', lw=1.2)
+    axs.xaxis.set_major_locator(plt.MultipleLocator(np.pi / 4))
+    axs.xaxis.set_minor_locator(plt.MultipleLocator(np.pi / 12))
+    axs.xaxis.set_major_formatter(
+        plt.FuncFormatter(
+            plot_utils.multiple_formatter(denominator=4,
+                                          number=np.pi,
+                                          latex='\pi')))
+
+    axs.spines['top'].set_visible(False)
+    axs.spines['right'].set_visible(False)
+    axs.spines['left'].set_visible(False)
+    axs.legend(handles=(l1, l2, l3, l4),
+               labels=('Round 1', 'Round 2', 'Fitted curve', 'best ph_angle'))
+    if show:
+        plt.show()
+
+    # Save the graph
+    plt.savefig(fname=fig_name, format='png', bbox_inches='tight')
+    print('[i] Saved graph as: ' + fig_name)
+
+
+def process(yaml_file, plot_all=False, use_cache=True):
     plt.rcParams['savefig.dpi'] = 300
     repeat = 3
     steps_1 = 13
@@ -69,26 +134,23 @@ def process(yaml_file, plot_all=False):
     print('[i] Reading log_file: ' + log_file)
 
     # log format: '%u64\t%u\t%u\t%u\t%u\t%f\t%f\t%d\t%f\t%f\t%f'
-    ns        = [np.uint64(x.split('\t')[ 0]) for x in open(log_file).readlines()]
-    curr_type = [np.uint32(x.split('\t')[ 1]) for x in open(log_file).readlines()]
-    loop_cnt  = [np.uint32(x.split('\t')[ 2]) for x in open(log_file).readlines()]
-    step_cnt  = [np.uint32(x.split('\t')[ 3]) for x in open(log_file).readlines()]
-    trj_cnt   = [np.uint32(x.split('\t')[ 4]) for x in open(log_file).readlines()]
-    ph_angle  = [    float(x.split('\t')[ 5]) for x in open(log_file).readlines()]
-    i_q       = [    float(x.split('\t')[ 6]) for x in open(log_file).readlines()]
-    motor_vel = [ np.int16(x.split('\t')[ 7]) for x in open(log_file).readlines()]
-    motor_pos = [    float(x.split('\t')[ 8]) for x in open(log_file).readlines()]
-    link_pos  = [    float(x.split('\t')[ 9]) for x in open(log_file).readlines()]
-    aux_var   = [    float(x.split('\t')[10]) for x in open(log_file).readlines()]
+    log = log_utils.load_log(log_file, 'phase-calib', use_cache=use_cache)
+    ns        = log['ns']
+    curr_type = log['curr_type']
+    loop_cnt  = log['loop_cnt']
+    step_cnt  = log['step_cnt']
+    trj_cnt   = log['trj_cnt']
+    ph_angle  = log['ph_angle']
+    i_q       = log['i_q']
+    motor_vel = log['motor_vel']
+    motor_pos = log['motor_pos']
+    link_pos  = log['link_pos']
+    aux_var   = log['aux_var']
 
     print('[i] Processing data')
     # find where we start testing id instead of iq
-    cc = len(curr_type) - 2
-    for i in range(1, len(curr_type)):
-        if (curr_type[i] != curr_type[i - 1]):
-            # disp('found change of current curr_type')
-            cc = i
-            break
+    type_changes = segment_utils.changes(curr_type)
+    cc = type_changes[0] if len(type_changes) else len(curr_type) - 2
 
     # Plot full test --------------------------------------------------------------
     if plot_all:
@@ -190,32 +252,25 @@ def process(yaml_file, plot_all=False):
         plt.show()
 
     # split trajectories in individual motions -----------------------------------------------------
-    trj_v = [
-        i for i in range(0, len(trj_cnt))
-        if (trj_cnt[i] == 0 and curr_type[i] == 0)
-    ]
-    for i in range(trj_v[-1], len(curr_type)):
-        if curr_type[i] != curr_type[i - 1]:
-            trj_v.append(i)
-            break
-
-    phase = [
-        ph_angle[i] for i in range(0,
-                                   len(ph_angle) - 1)
-        if (ph_angle[i] != ph_angle[i + 1])
-    ]
+    trj_v = np.flatnonzero((trj_cnt == 0) & (curr_type == 0))
+    # the last one ends where the current type changes
+    trj_v = np.concatenate((trj_v, type_changes[type_changes >= trj_v[-1]][:1]))
+    trajectories = segment_utils.Segments.from_bounds(trj_v)
+
+    phase = ph_angle[segment_utils.changes(ph_angle) - 1].tolist()
     phase.append(ph_angle[-2])
 
-    ts = [[s - ns[trj_v[j - 1]] for s in ns[trj_v[j - 1]:trj_v[j]]]
-          for j in range(1, len(trj_v))]
-    steps = [[v for v in motor_vel[trj_v[j - 1]:trj_v[j]]]
-             for j in range(1, len(trj_v))]
+    ts = [t - t[0] for t in trajectories.split(ns)]
 
+    # exponential moving average of each trajectory, all at once:
+    # smooth[j] = alpha*steps[j] + (1-alpha)*smooth[j-1], starting from smooth[0] = steps[0]
     alpha = 0.1
-    smooth = steps
-    for i in range(0, len(steps)):
-        for j in range(1, len(steps[i])):
-            smooth[i][j] = alpha * steps[i][j] + (1 - alpha) * smooth[i][j - 1]
+    padded = trajectories.pad(motor_vel.astype(float))
+    padded, _ = signal.lfilter([alpha], [1, alpha - 1], padded, axis=1, zi=(1 - alpha) * padded[:, :1])
+    vel_smooth = trajectories.unpad(padded, motor_vel)
+
+    steps = trajectories.split(motor_vel)
+    smooth = trajectories.split(vel_smooth)
 
     # Plot individual trajectories ----------------------------------------------------------------------
     if plot_all:
@@ -240,48 +295,26 @@ def process(yaml_file, plot_all=False):
         plt.show()
 
     # evaluate performance of each trajectory -----------------------------------------------------------
-    score = [[], [], []]
-    for i in range(0, len(steps)):
-        score[0].append(phase[i])
-        tmp = sum(steps[i][0:int(len(steps[i]) / 2)])
-        if tmp > 0:
-            score[1].append((max(steps[i][:]) - min(steps[i][:])) / 2)
-            score[2].append((max(smooth[i][:]) - min(smooth[i][:])) / 2)
-        else:
-            score[1].append(-(max(steps[i][:]) - min(steps[i][:])) / 2)
-            score[2].append(-(max(smooth[i][:]) - min(smooth[i][:])) / 2)
+    # the sign is given by the direction of the first half of each trajectory
+    direction = np.where(trajectories.first_half().sum(vel_smooth) > 0, 1., -1.)
+    score = [phase[:len(trajectories)],
+             direction * trajectories.ptp(motor_vel) / 2,
+             direction * trajectories.ptp(vel_smooth) / 2]
 
     base2 = steps_1 * repeat
 
     keys_1 = phase[:steps_1]
     keys_2 = phase[base2:base2 + steps_1]
 
-    vals_1 = []
-    for i in range(0, steps_1):
-        tmp = 0.0
-        for j in range(0, repeat):
-            tmp += score[1][i + steps_1 * j]
-        vals_1.append(tmp / repeat)
-
-    vals_2 = []
-    for i in range(base2, base2 + steps_1):
-        tmp=0.0
-        for j in range(0,repeat):
-            tmp += score[1][i + steps_1 * j]
-        vals_2.append(tmp / repeat)
+    # average the repetitions of each phase angle, using the smoothed amplitude
+    vals_1 = (score[2][:base2].reshape(repeat, steps_1).sum(axis=0) / repeat).tolist()
+    vals_2 = (score[2][base2:2 * base2].reshape(repeat, steps_1).sum(axis=0) / repeat).tolist()
 
     # Fit 2nd order polinomial and plot max vs phase ------------------------------------------------------
-    fig, axs = plt.subplots()
-
     keys_1.append(keys_1[0] + 2 * np.pi)
     vals_1.append(vals_1[0])
-    l1, = axs.plot(keys_1, vals_1, color='#1f77b4', marker='.', linestyle='--')
-    l2, = axs.plot(keys_2, vals_2, color='#ff7f0e', marker='.', linestyle='-')
-
     keys_1s = [v - 2 * np.pi for v in keys_1]
     keys_2s = [v - 2 * np.pi for v in keys_2]
-    axs.plot(keys_1s, vals_1, color='#1f77b4', marker='.', linestyle='--')
-    axs.plot(keys_2s, vals_2, color='#ff7f0e', marker='.', linestyle='-')
 
     z1 = np.polyfit(keys_2, vals_2, 2)
     z2 = np.polyfit(keys_2s, vals_2, 2)
@@ -290,75 +323,25 @@ def process(yaml_file, plot_all=False):
     x1 = np.linspace(p1.roots[0], p1.roots[1], 1000)
     x2 = np.linspace(p2.roots[0], p2.roots[1], 1000)
 
-    l3, = axs.plot(x1, p1(x1), color='#2ca02c', linestyle=':')
-    axs.plot(x2, p2(x2), color='#2ca02c', linestyle=':')
-
     # find best
     fit_angle = p1.deriv().roots[0]
     if keys_2[0] <= 0:
-        axs.set_xlim(-np.pi, np.pi)
-        l4, = axs.plot(fit_angle,
-                       p1(fit_angle),
-                       color='r',
-                       marker='x',
-                       linestyle='None')
-
+        fit_value = p1(fit_angle)
+        xlim = (-np.pi, np.pi)
     elif fit_angle > 2 * np.pi:
         fit_angle = fit_angle - 2 * np.pi
-        axs.set_xlim(-np.pi, np.pi)
-        l4, = axs.plot(fit_angle,
-                       p2(fit_angle),
-                       color='r',
-                       marker='x',
-                       linestyle='None')
-
+        fit_value = p2(fit_angle)
+        xlim = (-np.pi, np.pi)
     else:
-        axs.set_xlim(0, 2 * np.pi)
-        l4, = axs.plot(fit_angle,
-                       p1(fit_angle),
-                       color='r',
-                       marker='x',
-                       linestyle='None')
-
-    # make plot pretty
-    #fig.suptitle('Result: ph_angle = {:.3f}'.format(fit_angle))
-    axs.set_ylabel('max velocity (mrad/s)')
-    axs.set_xlabel('phase angle (rad)')
-    axs.grid(b=True, which='major', axis='x', linestyle=':')
-    axs.grid(b=True, which='major', axis='y', linestyle='-')
-    axs.grid(b=True, which='minor', axis='y', linestyle=':')
-
-    axs.axvline(0, color='black', lw=1.2)
-    axs.set_ylim(min(vals_1) * 1.1, max(vals_2) * 1.1)
-    axs.yaxis.set_major_locator(
-        plt.MultipleLocator((max(vals_1) - min(vals_1)) * 1.1 / 6))
-    axs.yaxis.set_minor_locator(
-        plt.MultipleLocator((max(vals_1) - min(vals_1)) * 1.1 / 18))
-
-    axs.axhline(0, color='black', lw=1.2)
-    axs.xaxis.set_major_locator(plt.MultipleLocator(np.pi / 4))
-    axs.xaxis.set_minor_locator(plt.MultipleLocator(np.pi / 12))
-    axs.xaxis.set_major_formatter(
-        plt.FuncFormatter(
-            plot_utils.multiple_formatter(denominator=4,
-                                          number=np.pi,
-                                          latex='\pi')))
-
-    axs.spines['top'].set_visible(False)
-    axs.spines['right'].set_visible(False)
-    axs.spines['left'].set_visible(False)
-    axs.legend(handles=(l1, l2, l3, l4),
-               labels=('Round 1', 'Round 2', 'Fitted curve', 'best ph_angle'))
-    if plot_all:
-        plt.show()
+        fit_value = p1(fit_angle)
+        xlim = (0, 2 * np.pi)
 
     print(plot_utils.bcolors.OKGREEN + u'[\u2713] Result: ph_angle = ' + str(fit_angle) +
           plot_utils.bcolors.ENDC)
 
-    # Save the graph
     fig_name = image_base_path + '.png'
-    plt.savefig(fname=fig_name, format='png', bbox_inches='tight')
-    print('[i] Saved graph as: ' + fig_name)
+    plot_utils.render(plot_phase, keys_1, vals_1, keys_2, vals_2, (x1, p1(x1)), (x2, p2(x2)), fit_angle, fit_value, xlim,
+                      fig_name=fig_name, show=plot_all)
 
     # Save result
     if 'name' in out_dict['log']:
@@ -375,8 +358,7 @@ def process(yaml_file, plot_all=False):
 
     out_dict['results']['phase']={}
     out_dict['results']['phase']['phase_angle'] = float(fit_angle)
-    with open(yaml_name, 'w', encoding='utf8') as outfile:
-        yaml.dump(out_dict, outfile, default_flow_style=False, allow_unicode=True)
+    log_utils.save_yaml(yaml_name, out_dict)
     return yaml_name
 
 if __name__ == "__main__":
@@ -384,5 +366,6 @@ if __name__ == "__main__":
 
     print(plot_utils.bcolors.OKBLUE + "[i] Starting process_phase" + plot_utils.bcolors.ENDC)
     yaml_file = process(yaml_file=sys.argv[1], plot_all=False)
+    plot_utils.flush()
 
     print(plot_utils.bcolors.OKGREEN + u'[\u2713] Ending program successfully' + plot_utils.bcolors.ENDC)
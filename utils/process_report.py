@@ -7,6 +7,12 @@ import yaml
 import numpy as np
 from fpdf import FPDF
 
+#import costum files
+try:
+    from utils import plot_utils
+except ImportError:
+    import plot_utils
+
 
 class PDF(FPDF):
     def __init__(self, title_txt = 'title goes here', subtitle_txt1='', subtitle_txt2='', *args, **kwargs):
@@ -64,6 +70,9 @@ def process(yaml_file='NULL'):
     if yaml_file == 'NULL':
         raise Exception('missing required yaml file')
 
+    # the figures of the processing may still be rendering
+    plot_utils.flush()
+
     print('[i] Generating report from: ' + yaml_file)
     with open(yaml_file) as f:
         try:
@@ -3,6 +3,7 @@
 
 import os
 import sys
+import math
 import glob
 import yaml
 import statistics
@@ -18,11 +19,131 @@ from matplotlib.lines import Line2D
 try:
     from utils import plot_utils
     from utils import fit_sine
+    from utils import log_utils
+    from utils import segment_utils
+    from utils import metrics_utils
 except ImportError:
     import plot_utils
     import fit_sine
+    import log_utils
+    import segment_utils
+    import metrics_utils
+
+def cluster_by_position(pos, tol):
+    '''Group the positions in pos: each one joins the first group whose first position is closer than tol, otherwise it starts a new one.
+    Groups are looked up in a grid of tol-wide bins, so only the ones in the neighbouring bins are checked. Returns the group of each position'''
+    labels = np.arange(len(pos))
+    if tol <= 0:
+        return labels
+    first = []
+    bins = {}
+    for i, p in enumerate(pos):
+        b = math.floor(p / tol)
+        near = [g for k in (b - 1, b, b + 1) for g in bins.get(k, ()) if abs(first[g] - p) < tol]
+        if near:
+            labels[i] = min(near)
+        else:
+            labels[i] = len(first)
+            bins.setdefault(b, []).append(len(first))
+            first.append(p)
+    return labels
+
+def cluster_motions(motions, pos, torque, tol):
+    '''Group the motions (segment_utils.Segments) starting less than tol apart.
+    Returns the samples of each group, in their original order, and the mean position and torque of each group'''
+    labels = cluster_by_position(pos[motions.starts], tol)
+    # log index and group of every sample
+    idx = motions.indices()
+    sample_labels = labels[motions.ids()]
+
+    counts = np.bincount(sample_labels)
+    mean_pos = np.bincount(sample_labels, weights=pos[idx]) / counts
+    mean_torque = np.bincount(sample_labels, weights=torque[idx]) / counts
+
+    order = idx[np.argsort(sample_labels, kind='stable')]
+    split = np.cumsum(counts)[:-1]
+    return np.split(pos[order], split), np.split(torque[order], split), mean_pos, mean_torque
+
+def plot_ripple(temp11, temp21, ts1, tq1, sins, tor_min, tor_max, fig_name, show=False):
+    '''Torque of every motion vs the motor position with its median, and the multisine fits'''
+    fig, axs = plt.subplots(2)
+
+    #axs[0].plot(ts1, tq1, label='Torque$_{raw}$', color='k', marker='.')
+    plot_utils.plot_many(axs[0], temp11, temp21, label='raw data', color='#8e8e8e')
+    axs[0].plot(ts1, tq1, label='median', color='#1f77b4', marker='.')
+    axs[0].set_ylabel('torque (Nm)')
+    axs[0].set_xlabel('position (rad)')
+    axs[0].grid(b=True, which='major', axis='y', linestyle='-')
+    axs[0].grid(b=True, which='minor', axis='y', linestyle=':')
+    axs[0].grid(b=True, which='major', axis='x', linestyle=':')
+
+    plt_pad = (tor_max - tor_min) * 0.02
+    axs[0].set_ylim(tor_min - plt_pad, tor_max + plt_pad)
+    #plt_pad = (max(ts1) - min(ts1)) * 0.02
+    #axs[0].set_xlim(min(ts1) - plt_pad, max(ts1) + plt_pad)
+    axs[0].set_xlim(-np.pi, np.pi)
+    axs[0].spines['top'].set_visible(False)
+    axs[0].spines['right'].set_visible(False)
+    axs[0].spines['left'].set_visible(False)
+    axs[0].yaxis.set_major_locator(plt.MultipleLocator((tor_max - tor_min) / 4))
+    axs[0].yaxis.set_minor_locator(plt.MultipleLocator((tor_max - tor_min) / 12))
+    axs[0].xaxis.set_major_locator(plt.MultipleLocator(np.pi / 4))
+    axs[0].xaxis.set_minor_locator(plt.MultipleLocator(np.pi / 12))
+    axs[0].xaxis.set_major_formatter(
+        plt.FuncFormatter(
+            plot_utils.multiple_formatter(denominator=4,
+                                          number=np.pi,
+                                          latex='\pi')))
+    axs[0].ticklabel_format(axis="y",
+                            style="plain",#"sci",
+                            scilimits=(0, 0),
+                            useOffset=False)
+
+    legend_elements = [
+        Line2D([0], [0], label='Raw torque', color='#8e8e8e'),
+        Line2D([0], [0], label='Median',     color='#1f77b4', marker='.'),
+    ]
+    axs[0].legend(handles=legend_elements, loc='best')
+
+    axs[1].plot(ts1, tq1, label='mean', marker='.')
+    for i, sin in enumerate(sins):
+        axs[1].plot(ts1, sin, label=f'{i+1} sin', marker='.')
+
+    plt_pad = (max(tq1) - min(tq1)) * 0.02
+    axs[1].set_ylim(min(tq1) - plt_pad, max(tq1) + plt_pad)
+    axs[1].set_xlim(-np.pi, np.pi)
+    axs[1].set_ylabel('torque (Nm)')
+    axs[1].set_xlabel('position (rad)')
+    axs[1].grid(b=True, which='major', axis='y', linestyle='-')
+    axs[1].grid(b=True, which='minor', axis='y', linestyle=':')
+    axs[1].grid(b=True, which='major', axis='x', linestyle=':')
+    axs[1].spines['top'].set_visible(False)
+    axs[1].spines['right'].set_visible(False)
+    axs[1].spines['left'].set_visible(False)
+    axs[1].yaxis.set_major_locator(plt.MultipleLocator((max(tq1) - min(tq1)) / 4))
+    axs[1].yaxis.set_minor_locator(plt.MultipleLocator((max(tq1) - min(tq1)) / 12))
+    axs[1].xaxis.set_major_locator(plt.MultipleLocator(np.pi / 4))
+    axs[1].xaxis.set_minor_locator(plt.MultipleLocator(np.pi / 12))
+    axs[1].xaxis.set_major_formatter(
+        plt.FuncFormatter(
+            plot_utils.multiple_formatter(denominator=4,
+                                          number=np.pi,
+                                          latex='\pi')))
+
+    axs[1].ticklabel_format(axis="y",
+                            style="plain",#"sci",
+                            scilimits=(0, 0),
+                            useOffset=False)
+    axs[1].legend()
+    plt.tight_layout()
+    if show:
+        plt.show()
 
-def process(yaml_file, plot_all=False):
+    # Save the graph
+    plt.savefig(fname=fig_name, format='png', bbox_inches='tight')
+    print('[i] Saving graph as: ' + fig_name)
+
+def process(yaml_file, plot_all=False, use_cache=True):
     plt.rcParams['savefig.dpi'] = 300
 
     # read parameters from yaml file
@@ -74,18 +195,19 @@ def process(yaml_file, plot_all=False):
     log_file=head+f'{code_string}_ripple-calib.log'
     print('[i] Reading log_file: ' + log_file)
 
-    # '%u64\t%u\t%u\t%u\t%u\t%f\t%f\t%d\t%f\t%f\t%f'
-    ts = [np.uint64(x.split('\t')[0]) for x in open(log_file).readlines()]
-    is_moving  = [np.uint32(x.split('\t')[ 1]) for x in open(log_file).readlines()]
-    trj_cnt    = [np.uint32(x.split('\t')[ 2]) for x in open(log_file).readlines()]
-    curr_ref   = [    float(x.split('\t')[ 3]) for x in open(log_file).readlines()]
-    torque     = [    float(x.split('\t')[ 4]) for x in open(log_file).readlines()]
-    pos_target = [    float(x.split('\t')[ 5]) for x in open(log_file).readlines()]
-    pos_motor  = [    float(x.split('\t')[ 6]) for x in open(log_file).readlines()]
-    pos_link   = [    float(x.split('\t')[ 7]) for x in open(log_file).readlines()]
-    vel_motor  = [ np.int16(x.split('\t')[ 8]) for x in open(log_file).readlines()]
-    vel_link   = [ np.int16(x.split('\t')[ 9]) for x in open(log_file).readlines()]
-    aux_var    = [    float(x.split('\t')[10]) for x in open(log_file).readlines()]
+    # '%u64\t%u\t%u\t%f\t%f\t%f\t%f\t%f\t%d\t%d\t%f'
+    log = log_utils.load_log(log_file, 'ripple-calib', use_cache=use_cache)
+    ts         = log['ts']
+    is_moving  = log['is_moving']
+    trj_cnt    = log['trj_cnt']
+    curr_ref   = log['curr_ref']
+    torque     = log['torque']
+    pos_target = log['pos_target']
+    pos_motor  = log['pos_motor']
+    pos_link   = log['pos_link']
+    vel_motor  = log['vel_motor']
+    vel_link   = log['vel_link']
+    aux_var    = log['aux_var']
 
     print('[i] Processing data')
     # find where we start testing id instead of iq
@@ -99,7 +221,7 @@ def process(yaml_file, plot_all=False):
 
     plt_max = max([max(torque), -min(torque)]) * 1.1
 
-    axs[0].plot(ts, torque,
+    plot_utils.plot(axs[0], ts, torque,
                 label='Motor Vel',
                 color='b',
                 marker='.')
@@ -136,189 +258,44 @@ def process(yaml_file, plot_all=False):
         plt.show()
 
     # split trajectories in individual motions -----------------------------------------------------
-    trj_v = [ i for i in range(0, len(trj_cnt)) if (trj_cnt[i] == 1) ]
-
-    #ns = [ [s - ts[trj_v[j - 1]] for s in ts[trj_v[j - 1] : trj_v[j]]] for j in range(1, len(trj_v)) ]
-    temp11=[]
-    temp12=[]
-    temp21=[]
-    temp22=[]
-    is_there=False
-    for j in range(1, len(trj_v)):
-        is_there=False
-        if is_moving[trj_v[j]]:
-            for ii in range(0, len(temp11)):
-                if (abs(temp11[ii][0] - pos_motor[trj_v[j - 1]]) < 2*trj_error) and not(is_there):
-                    temp11[ii].extend([v for v in pos_motor[trj_v[j - 1]:trj_v[j]]] )
-                    temp21[ii].extend([v for v in torque[trj_v[j - 1] : trj_v[j]]])
-                    is_there = True
-            if not is_there:
-                temp11.append([v for v in pos_motor[trj_v[j - 1] : trj_v[j]]])
-                temp21.append([v for v in  torque[trj_v[j - 1] : trj_v[j]]])
-        else:
-            for ii in range(0, len(temp12)):
-                if (abs(temp12[ii][0] - pos_motor[trj_v[j - 1]]) < 2*trj_error) and not (is_there):
-                    temp12[ii].extend([v for v in pos_motor[trj_v[j - 1]:trj_v[j]]] )
-                    temp22[ii].extend([v for v in torque[trj_v[j - 1] : trj_v[j]]])
-                    is_there = True
-            if not is_there:
-                temp12.append([v for v in pos_motor[trj_v[j - 1] : trj_v[j]]])
-                temp22.append([v for v in torque[trj_v[j - 1] : trj_v[j]]])
-
-    ts1 = [sum(v)/len(v) for v in temp11]
-    tq1 = [sum(v)/len(v) for v in temp21]
+    motions = segment_utils.Segments.from_bounds(np.flatnonzero(trj_cnt == 1))
+    # as before, a motion is labelled by is_moving at the start of the following one
+    moving = is_moving[motions.ends].astype(bool)
+
+    temp11, temp21, ts1, tq1 = cluster_motions(motions[moving], pos_motor, torque, 2*trj_error)
     key_order = np.argsort(ts1)
-    ts1.sort()
-    tq1 = [tq1[key] for key in key_order]
+    ts1 = ts1[key_order].tolist()
+    tq1 = tq1[key_order].tolist()
 
-    ts2 = [sum(v)/len(v) for v in temp12]
-    tq2 = [sum(v)/len(v) for v in temp22]
+    temp12, temp22, ts2, tq2 = cluster_motions(motions[~moving], pos_motor, torque, 2*trj_error)
     key_order = np.argsort(ts2)
-    ts2.sort()
-    tq2 = [tq2[key] for key in key_order]
-
-    fig, axs = plt.subplots(2)
-
-
-
-    #axs[0].plot(ts1, tq1, label='Torque$_{raw}$', color='k', marker='.')
-    for t, q in zip(temp11, temp21):
-        axs[0].plot(t, q, label='raw data', color='#8e8e8e')
-    axs[0].plot(ts1, tq1, label='median', color='#1f77b4', marker='.')
-    axs[0].set_ylabel('torque (Nm)')
-    axs[0].set_xlabel('position (rad)')
-    axs[0].grid(b=True, which='major', axis='y', linestyle='-')
-    axs[0].grid(b=True, which='minor', axis='y', linestyle=':')
-    axs[0].grid(b=True, which='major', axis='x', linestyle=':')
-
-    plt_pad = (max(torque) - min(torque)) * 0.02
-    axs[0].set_ylim(min(torque) - plt_pad, max(torque) + plt_pad)
-    #plt_pad = (max(ts1) - min(ts1)) * 0.02
-    #axs[0].set_xlim(min(ts1) - plt_pad, max(ts1) + plt_pad)
-    axs[0].set_xlim(-np.pi, np.pi)
-    axs[0].spines['top'].set_visible(False)
-    axs[0].spines['right'].set_visible(False)
-    axs[0].spines['left'].set_visible(False)
-    axs[0].yaxis.set_major_locator(plt.MultipleLocator((max(torque) - min(torque)) / 4))
-    axs[0].yaxis.set_minor_locator(plt.MultipleLocator((max(torque) - min(torque)) / 12))
-    axs[0].xaxis.set_major_locator(plt.MultipleLocator(np.pi / 4))
-    axs[0].xaxis.set_minor_locator(plt.MultipleLocator(np.pi / 12))
-    axs[0].xaxis.set_major_formatter(
-        plt.FuncFormatter(
-            plot_utils.multiple_formatter(denominator=4,
-                                          number=np.pi,
-                                          latex='\pi')))
-    axs[0].ticklabel_format(axis="y",
-                            style="plain",#"sci",
-                            scilimits=(0, 0),
-                            useOffset=False)
-
-    legend_elements = [
-        Line2D([0], [0], label='Raw torque', color='#8e8e8e'),
-        Line2D([0], [0], label='Median',     color='#1f77b4', marker='.'),
-    ]
-    axs[0].legend(handles=legend_elements, loc='best')
-
-    # fit multisine waves
-    ts_exended = [ph - 2 * np.pi for ph in ts1]
-    ts_exended += ts1
-    ts_exended += [t + 2 * np.pi for t in ts1]
-    tq_exended = tq1 + tq1 + tq1
-
-    s1 = fit_sine.fit_sin1(ts_exended, tq_exended)
-    s2 = fit_sine.fit_sin2(ts_exended, tq_exended)
-    s3 = fit_sine.fit_sin3(ts_exended, tq_exended)
-    print("1 sin:" + str(s1["c"]) + " + " + str(s1["a1"]) + "*sin(" + str(s1["w1"]) + "*t + " + str(s1["p1"]) + ")")
-    print("2 sin:" + str(s2["c"]) + " + " + str(s2["a1"]) + "*sin(" + str(s2["w1"]) + "*t + " + str(s2["p1"]) + ") + " + \
-                                            str(s2["a2"]) + "*sin(" + str(s2["w2"]) + "*t + " + str(s2["p2"]) + ")")
-    print("3 sin:" + str(s3["c"]) + " + " + str(s3["a1"]) + "*sin(" + str(s3["w1"]) + "*t + " + str(s3["p1"]) + ") + " + \
-                                            str(s3["a2"]) + "*sin(" + str(s3["w2"]) + "*t + " + str(s3["p2"]) + ") + " + \
-                                            str(s3["a3"]) + "*sin(" + str(s3["w3"]) + "*t + " + str(s3["p3"]) + ")")
-
-
-
-    sin1 = [
-        fit_sine.sine_1(t=t,
-                         A1=s1["a1"],
-                         w1=s1["w1"],
-                         p1=s1["p1"],
-                         c=s1["c"])
-        for t in ts1
-    ]
-    sin2 = [
-        fit_sine.sine_2(t=t,
-                          A1=s2["a1"],
-                          A2=s2["a2"],
-                          w1=s2["w1"],
-                          w2=s2["w2"],
-                          p1=s2["p1"],
-                          p2=s2["p2"],
-                          c=s2["c"])
-        for t in ts1
-    ]
-    sin3 = [
-        fit_sine.sine_3(t=t,
-                          A1=s3["a1"],
-                          A2=s3["a2"],
-                          A3=s3["a3"],
-                          w1=s3["w1"],
-                          w2=s3["w2"],
-                          w3=s3["w3"],
-                          p1=s3["p1"],
-                          p2=s3["p2"],
-                          p3=s3["p3"],
-                          c=s3["c"])
-        for t in ts1
-    ]
+    ts2 = ts2[key_order].tolist()
+    tq2 = tq2[key_order].tolist()
+
+    # fit multisine waves: with integer angular velocities the model is 2pi-periodic in the position,
+    # so the data of one turn is fitted as it is
+    harmonics = [1., 2., 4.]
+    if 'harmonics' in yaml_dict:
+        harmonics = [float(w) for w in yaml_dict['harmonics']]
+    criterion = 'bic'
+    if 'order_criterion' in yaml_dict:
+        criterion = yaml_dict['order_criterion']
+
+    fits, sins, best = fit_sine.fit_orders(ts1, tq1, w=harmonics, criterion=criterion)
+    for i, s in enumerate(fits):
+        print(str(i+1) + " sin:" + str(s["c"]) + " + " + \
+              " + ".join(str(s[f"a{j}"]) + "*sin(" + str(s[f"w{j}"]) + "*t + " + str(s[f"p{j}"]) + ")" for j in range(1, i+2)))
 
     #compute Root Mean Squared Error
-    RMSE=[]
-    RMSE.append(np.sqrt(np.mean(np.square([tq1[v] - sin1[v] for v in range(0,len(tq1))]))))
-    RMSE.append(np.sqrt(np.mean(np.square([tq1[v] - sin2[v] for v in range(0,len(tq1))]))))
-    RMSE.append(np.sqrt(np.mean(np.square([tq1[v] - sin3[v] for v in range(0,len(tq1))]))))
+    RMSE = [metrics_utils.rmse(tq1, sin) for sin in sins]
     RMSE =[v/min(RMSE) for v in RMSE]
 
     print('RMSE:' + str(RMSE))
+    print(criterion.upper() + ':' + str([s['ic'] for s in fits]))
 
-    axs[1].plot(ts1, tq1, label='mean', marker='.')
-    axs[1].plot(ts1, sin1, label='1 sin', marker='.')
-    axs[1].plot(ts1, sin2, label='2 sin', marker='.')
-    axs[1].plot(ts1, sin3, label='3 sin', marker='.')
-
-    plt_pad = (max(tq1) - min(tq1)) * 0.02
-    axs[1].set_ylim(min(tq1) - plt_pad, max(tq1) + plt_pad)
-    axs[1].set_xlim(-np.pi, np.pi)
-    axs[1].set_ylabel('torque (Nm)')
-    axs[1].set_xlabel('position (rad)')
-    axs[1].grid(b=True, which='major', axis='y', linestyle='-')
-    axs[1].grid(b=True, which='minor', axis='y', linestyle=':')
-    axs[1].grid(b=True, which='major', axis='x', linestyle=':')
-    axs[1].spines['top'].set_visible(False)
-    axs[1].spines['right'].set_visible(False)
-    axs[1].spines['left'].set_visible(False)
-    axs[1].yaxis.set_major_locator(plt.MultipleLocator((max(tq1) - min(tq1)) / 4))
-    axs[1].yaxis.set_minor_locator(plt.MultipleLocator((max(tq1) - min(tq1)) / 12))
-    axs[1].xaxis.set_major_locator(plt.MultipleLocator(np.pi / 4))
-    axs[1].xaxis.set_minor_locator(plt.MultipleLocator(np.pi / 12))
-    axs[1].xaxis.set_major_formatter(
-        plt.FuncFormatter(
-            plot_utils.multiple_formatter(denominator=4,
-                                          number=np.pi,
-                                          latex='\pi')))
-
-    axs[1].ticklabel_format(axis="y",
-                            style="plain",#"sci",
-                            scilimits=(0, 0),
-                            useOffset=False)
-    axs[1].legend()
-    plt.tight_layout()
-    if plot_all:
-        plt.show()
-
-    # Save the graph
     fig_name = image_base_path + '.png'
-    plt.savefig(fname=fig_name, format='png', bbox_inches='tight')
-    print('[i] Saving graph as: ' + fig_name)
+    plot_utils.render(plot_ripple, temp11, temp21, ts1, tq1, sins, float(np.min(torque)), float(np.max(torque)),
+                      fig_name=fig_name, show=plot_all)
 
     # Save result
     if 'name' in out_dict['log']:
@@ -333,37 +310,19 @@ def process(yaml_file, plot_all=False):
     if not('results' in out_dict):
         out_dict['results'] = {}
 
-    num_of_sinusoids = int(np.argsort(RMSE)[0]) + 1
+    # the order with the lowest information criterion: more sines always lower the RMSE, but must pay for their parameters
+    num_of_sinusoids = best + 1
+    s = fits[best]
 
     out_dict['results']['ripple']={}
     out_dict['results']['ripple']['num_of_sinusoids'] = num_of_sinusoids
-    if num_of_sinusoids == 1:
-        out_dict['results']['ripple']['c']  = float(s1['c'])
-        out_dict['results']['ripple']['a1'] = float(s1['a1'])
-        out_dict['results']['ripple']['w1'] = float(s1['w1'])
-        out_dict['results']['ripple']['p1'] = float(s1['p1'])
-    if num_of_sinusoids == 2:
-        out_dict['results']['ripple']['c']  = float(s2['c'])
-        out_dict['results']['ripple']['a1'] = float(s2['a1'])
-        out_dict['results']['ripple']['w1'] = float(s2['w1'])
-        out_dict['results']['ripple']['p1'] = float(s2['p1'])
-        out_dict['results']['ripple']['a2'] = float(s2['a2'])
-        out_dict['results']['ripple']['w2'] = float(s2['w2'])
-        out_dict['results']['ripple']['p2'] = float(s2['p2'])
-    if num_of_sinusoids == 3:
-        out_dict['results']['ripple']['c']  = float(s3['c'])
-        out_dict['results']['ripple']['a1'] = float(s3['a1'])
-        out_dict['results']['ripple']['w1'] = float(s3['w1'])
-        out_dict['results']['ripple']['p1'] = float(s3['p1'])
-        out_dict['results']['ripple']['a2'] = float(s3['a2'])
-        out_dict['results']['ripple']['w2'] = float(s3['w2'])
-        out_dict['results']['ripple']['p2'] = float(s3['p2'])
-        out_dict['results']['ripple']['a3'] = float(s3['a3'])
-        out_dict['results']['ripple']['w3'] = float(s3['w3'])
-        out_dict['results']['ripple']['p3'] = float(s3['p3'])
-
-    with open(yaml_name, 'w', encoding='utf8') as outfile:
-        yaml.dump(out_dict, outfile, default_flow_style=False, allow_unicode=True)
+    out_dict['results']['ripple']['c']  = float(s['c'])
+    for i in range(1, num_of_sinusoids + 1):
+        out_dict['results']['ripple'][f'a{i}'] = float(s[f'a{i}'])
+        out_dict['results']['ripple'][f'w{i}'] = float(s[f'w{i}'])
+        out_dict['results']['ripple'][f'p{i}'] = float(s[f'p{i}'])
+
+    log_utils.save_yaml(yaml_name, out_dict)
     return yaml_name
 
 if __name__ == "__main__":
@@ -371,5 +330,6 @@ if __name__ == "__main__":
 
     print(plot_utils.bcolors.OKBLUE + "[i] Starting process_ripple" + plot_utils.bcolors.ENDC)
     yaml_file = process(yaml_file=sys.argv[1], plot_all=False)
+    plot_utils.flush()
 
     print(plot_utils.bcolors.OKGREEN + u'[\u2713] Ending program successfully' + plot_utils.bcolors.ENDC)
@@ -5,8 +5,9 @@ import os
 import sys
 import glob
 import yaml
-import statistics
+import time
 import numpy as np
+import multiprocessing as mp
 from scipy import odr
 from sklearn.linear_model import LinearRegression
 
@@ -18,11 +19,264 @@ from matplotlib import pyplot as plt
 #import costum
 try:
     from utils import plot_utils
+    from utils import log_utils
+    from utils import segment_utils
+    from utils import metrics_utils
 except ImportError:
     import plot_utils
+    import log_utils
+    import segment_utils
+    import metrics_utils
+
+
+def average_steps(i_ref, tor, decimals=2):
+    '''Group the samples by current reference (rounded to decimals) and reduce the torque of each group.
+    Returns the current steps, in the order they first appear, with the mean and standard deviation of their torque and their number of samples'''
+    i_round = np.round(i_ref, decimals)
+    steps, first, inverse, counts = np.unique(i_round, return_index=True, return_inverse=True, return_counts=True)
+    # np.unique sorts the steps: renumber them by first appearance (the first step is the zero current offset)
+    order = np.argsort(first, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    inverse = rank[inverse.ravel()]
+    steps = steps[order]
+    counts = counts[order]
+
+    mean = np.bincount(inverse, weights=tor, minlength=len(steps)) / counts
+    dev = tor - mean[inverse]
+    std = np.sqrt(np.bincount(inverse, weights=dev * dev, minlength=len(steps)) / counts)
+    return steps, mean, std, counts
+
+
+def hysteresis_branches(i_ref):
+    '''Label every sample as rising or falling current, and by ramp (one ramp per run of the same branch).
+    A ramp turns falling as soon as the current decreases and rising again when the current is back to zero.
+    Returns the rising mask and the ramp index of every sample'''
+    i_ref = np.asarray(i_ref)
+    idx = np.arange(len(i_ref))
+    # 0: the current decreased, 1: the current is back to zero, -1: nothing changes
+    event = np.full(len(i_ref), -1, dtype=np.int8)
+    event[1:][i_ref[1:] == 0.0] = 1
+    event[1:][i_ref[1:] < i_ref[:-1]] = 0
+    # the branch of each sample is set by the last event up to it (rising before the first one)
+    last = np.maximum.accumulate(np.where(event >= 0, idx, -1)) if len(i_ref) else idx
+    rising = np.where(last >= 0, event[last] == 1, True)
+    ramp = np.concatenate(([0], np.cumsum(rising[1:] != rising[:-1])))
+    return rising, ramp
+
+
+def hysteresis_width(i_ref, tor, rising, decimals=2):
+    '''Mean torque of the rising branch minus the one of the falling branch, at the current steps both branches go through'''
+    steps_r, mean_r, _, _ = average_steps(i_ref[rising], tor[rising], decimals)
+    steps_f, mean_f, _, _ = average_steps(i_ref[~rising], tor[~rising], decimals)
+    steps, idx_r, idx_f = np.intersect1d(steps_r, steps_f, return_indices=True)
+    return steps, mean_r[idx_r] - mean_f[idx_f]
+
+
+def linear_func(p, x):
+    m, c = p
+    return m*x + c
+
+
+def poly2_func(p, x):
+    a, b, c = p
+    return a*x*x + b*x + c
+
+
+def odr_fit(func, x, y, beta0):
+    '''scipy.odr fit of y = func(beta, x), with the standard deviations of x and y as weights'''
+    odr_data = odr.RealData(x, y, sx=np.std(x, ddof=1), sy=np.std(y, ddof=1))
+    return odr.ODR(odr_data, odr.Model(func), beta0=beta0).run()
+
+
+# data of the bootstrap problems, sent once to every worker of the pool
+_bootstrap_data = {}
+
+def _bootstrap_init(data):
+    _bootstrap_data.update(data)
+
+def _bootstrap_chunk(name, seed, n):
+    # n refits of one problem, each on blocks drawn with replacement
+    x, y, starts, ends, beta0 = _bootstrap_data[name]
+    blocks = segment_utils.Segments(starts, ends)
+    rng = np.random.default_rng(seed)
+    slopes = np.empty(n)
+    for k in range(n):
+        idx = blocks[rng.integers(len(blocks), size=len(blocks))].indices()
+        slopes[k] = odr_fit(linear_func, x[idx], y[idx], beta0=beta0).beta[0]
+    return name, slopes
+
+
+def bootstrap_slopes(problems, samples=200, time_budget=10., confidence=0.95, jobs=None, chunk_size=10, seed=0):
+    '''Block bootstrap of the slope of linear ODR fits, in a process pool.
+    problems maps a name to (x, y, blocks, beta0): each refit draws as many blocks (segment_utils.Segments of x and y)
+    as there are, with replacement, so the samples of a current step stay together.
+    The refits stop when time_budget seconds are over, keeping the ones done so far.
+    Returns for each name the confidence interval (None if less than 10 refits were done) and the number of refits'''
+    t0 = time.monotonic()
+    data = {name: (x, y, blocks.starts, blocks.ends, beta0) for name, (x, y, blocks, beta0) in problems.items()}
+    seeds = iter(np.random.SeedSequence(seed).spawn(len(problems) * (samples // chunk_size + 1)))
+    slopes = {name: [] for name in problems}
+
+    pool = mp.Pool(processes=jobs, initializer=_bootstrap_init, initargs=(data,))
+    try:
+        pending = []
+        # interleave the problems, so they all get refits when the budget runs out
+        for i in range(0, samples, chunk_size):
+            for name in problems:
+                pending.append(pool.apply_async(_bootstrap_chunk, (name, next(seeds), min(chunk_size, samples - i))))
+        while pending and time.monotonic() - t0 < time_budget:
+            pending[0].wait(timeout=min(0.1, max(time_budget - (time.monotonic() - t0), 0.)))
+            for r in [r for r in pending if r.ready()]:
+                name, s = r.get()
+                slopes[name].append(s)
+                pending.remove(r)
+        if pending:
+            print(f'[!] Bootstrap stopped after {time_budget}s')
+    finally:
+        # the chunks still running are dropped, not waited for
+        pool.terminate()
+        pool.join()
+
+    out = {}
+    alpha = (1. - confidence) / 2.
+    for name in problems:
+        s = np.concatenate(slopes[name]) if slopes[name] else np.empty(0)
+        ci = np.quantile(s, [alpha, 1. - alpha]).tolist() if len(s) >= 10 else None
+        out[name] = (ci, len(s))
+    return out
+
+
+def plot_currents(ns_, i_fb_, i_ref_, tor_motor_, tor_cell_, torque_const, fig_name, show=False):
+    '''Current, motor torque and loadcell torque over the whole test'''
+    fig, axs = plt.subplots()
+    l0, = plot_utils.plot(axs, ns_, i_fb_*torque_const, color='#8e8e8e', marker='.', markersize=0.5, linestyle='')
+    l1, = plot_utils.plot(axs, ns_, i_ref_*torque_const, color='#000000', marker='.', markersize=0.5, linestyle='')
+    l2, = plot_utils.plot(axs, ns_, tor_motor_, color='#1f77b4',marker='.', markersize=0.5, linestyle='')
+    l3, = plot_utils.plot(axs, ns_, tor_cell_, color='#ff7f0e',marker='.', markersize=0.5, linestyle='')
+
+    axs.set_ylabel('Torque (Nm)')
+    axs.set_xlabel('Time (ns)')
+    plt_max = np.ptp(ns_) * 0.05
+    axs.set_xlim(np.min(ns_)-plt_max, np.max(ns_)+plt_max)
+    plt.ticklabel_format(style='sci', axis='x', scilimits=(0,0))
+    axs.set_ylim(np.min(i_fb_)*torque_const, np.max(i_fb_)*torque_const)
+    axs.grid(b=True, which='major', axis='y', linestyle='-')
+    axs.grid(b=True, which='minor', axis='y', linestyle=':')
+    axs.grid(b=True, which='major', axis='x', linestyle=':')
+    axs.spines['top'].set_visible(False)
+    axs.spines['right'].set_visible(False)
+    axs.spines['left'].set_visible(False)
+    lgnd = axs.legend(handles=(l0,l1,l2,l3), labels=('i_fb', 'i_ref','tor_motor','tor_loadcell'))
+    for handle in lgnd.legendHandles:
+        handle._legmarker.set_markersize(6)
+    plt.ticklabel_format(style='sci', axis='x', scilimits=(0,0))
+    if show:
+        plt.show()
+
+    # Save the graph
+    plt.savefig(fname=fig_name, format='png', bbox_inches='tight')
+    print('[i] Saved graph as: ' + fig_name)
+
+
+def plot_stiffness(tor_motor_, tor_cell_, tor_x, tor_cell, tor_SDO, tor_odr, Torsion_bar_stiff, fig_name, show=False):
+    '''Loadcell torque vs the torsion bar displacement, with the stiffness fits'''
+    fig, axs = plt.subplots()
+    axs.axhline(0, color='black', lw=1.2)
+    axs.axvline(0, color='black', lw=1.2)
+
+    l0, = plot_utils.plot(axs, tor_motor_/Torsion_bar_stiff, tor_cell_, color='#8e8e8e', marker='.', markersize=0.5, linestyle='')
+    l1, = plot_utils.plot(axs, tor_x, tor_cell, color='#000000', marker='.', markersize=0.5, linestyle='')
+    #axs.legend(handles=(l1, l2), labels=('full test','t_log only'))
+    # l1, = axs.plot(tor_displ, tor_cell, color='#8e8e8e', marker='.', markersize=0.5, linestyle='')
+    # the fits are lines: draw them along increasing displacement, so they can be decimated
+    order = np.argsort(tor_x)
+    l2, = plot_utils.plot(axs, tor_x[order], tor_SDO[order], color='#1f77b4', linestyle='-', linewidth=1)
+    # l3, = axs.plot(tor_displ, tor_linear, color='#ff7f0e', linestyle='-', linewidth=1)
+    # l4, = axs.plot(tor_displ, tor_odr, color='#2ca02c', linestyle='-', linewidth=1)
+    # axs.legend(handles=(l0, l1, l2, l3, l4), labels=('full test datapoints', 't_log datapoints', 'SDO', 'sklean.LinearRegression','scipy.odr'))
+    l3, = plot_utils.plot(axs, tor_x[order], tor_odr[order], color='#ff7f0e', linestyle='-', linewidth=1)
+    lgnd= axs.legend(handles=(l0, l1, l2, l3), labels=('full test datapoints', 't_log datapoints', 'SDO','Total least squares'))
+    for handle in lgnd.legendHandles:
+        handle._legmarker.set_markersize(6)
+
+    axs.set_ylabel('Torque from loadcell reading (Nm)')
+    axs.set_xlabel('Motor torque sensor displacement (rad)')
+    plt_max = (np.max(tor_x) -np.min(tor_x)) * 0.05
+    axs.set_xlim(np.min(tor_x)-plt_max, np.max(tor_x)+plt_max)
+    plt.ticklabel_format(style='sci', axis='x', scilimits=(0,0))
+    plt_max = np.ptp(tor_cell) * 0.05
+    axs.set_ylim(np.min(tor_cell)-plt_max, np.max(tor_cell)+plt_max)
+    axs.grid(b=True, which='major', axis='y', linestyle='-')
+    axs.grid(b=True, which='minor', axis='y', linestyle=':')
+    axs.grid(b=True, which='major', axis='x', linestyle=':')
+    axs.spines['top'].set_visible(False)
+    axs.spines['right'].set_visible(False)
+    axs.spines['left'].set_visible(False)
+    axs.spines['bottom'].set_visible(False)
+
+    if show:
+        plt.show()
+
+    # Save the graph
+    plt.savefig(fname=fig_name, format='png', bbox_inches='tight')
+    print('[i] Saved graph as: ' + fig_name)
+
+
+def plot_torque_constant(i_ref_, tor_cell_, i_ref, tor_cell, i_steps, tor_SDO, tor_avar, i_rising, t_rising,
+                         i_falling, t_falling, linear_beta, poly2_beta, torque_const, fig_name):
+    '''Loadcell torque vs the current reference, with the torque constant fits'''
+    fig, axs = plt.subplots()
+    axs.axhline(0, color='black', lw=1.0)
+    axs.axvline(0, color='black', lw=1.0)
+
+    #l0, = axs.plot(i_fb_, [i*torque_const for i in i_fb_], color='#8e8e8e', marker='.', markersize=0.5, linestyle='')
+    l0, = plot_utils.plot(axs, i_ref_, tor_cell_, color='#8e8e8e', marker='.', markersize=0.5, linestyle='')
+    l1, = plot_utils.plot(axs, i_ref, tor_cell, color='#000000', marker='.', markersize=0.5, linestyle='')
+    l2, = axs.plot(i_steps, tor_SDO, color='#1f77b4', marker='.', markersize=3.0, linestyle='-', alpha=0.5)
+    axs.vlines(i_steps, tor_SDO*0.9, tor_SDO*1.1, color='#1f77b4', alpha=0.2, linestyle='-')
+    #axs.fill_between(i_ref, [t*0.9 for t in tor_SDO], [t*1.1 for t in tor_SDO], color='#ff7f0e', alpha=0.2, interpolate=True)
+    # axs.plot(i_steps, tor_avar, color='#1f77b4', marker='', linestyle='--', alpha=0.5)
+
+
+    # l1, = axs.plot(i_ref_, [i*torque_const for i in i_ref_], color='#000000', marker='.', markersize=0.5, linestyle='')
+    # l1, = axs.plot(i_ref, [i*torque_const for i in i_ref], color='#000000', marker='.', markersize=0.5, linestyle='')
+    # l1, = axs.plot(i_ref, tor_cell, color='#8e8e8e', marker='.', markersize=0.5, linestyle='')
+    # l2 = axs.plot(i_ref, tor_SDO, color='#1f77b4', linestyle='-', linewidth=1)
+    # l3, = axs.plot(i_ref, tor_linear, color='#ff7f0e', linestyle='-', linewidth=1)
+    # l4, = axs.plot(i_steps, tor_odr, color='#2ca02c', linestyle='--', linewidth=1, alpha=0.5)
+    l3, = plot_utils.plot(axs, i_rising, t_rising, color='#ff0000', marker='.', markersize=0.5, linestyle='')
+    l3c,= plot_utils.plot(axs, i_falling, t_falling, color='#9467bd', marker='.', markersize=0.5, linestyle='')
+    l3b,= axs.plot(i_steps, tor_avar, color='#005794', marker='.', markersize=3.0, linestyle='')
+    l4, = axs.plot(i_steps, linear_func(linear_beta, i_steps), color='#ff7f0e', marker='.', markersize=3.0, linestyle='-', alpha=0.5)
+    l5, = axs.plot(i_steps, poly2_func(poly2_beta, i_steps), color='#2ca02c', marker='.', markersize=3.0, linestyle='-', alpha=0.5)
+    # axs.legend(handles=(l0, l1, l2, l3), labels=('full test datapoints', 't_log datapoints', 'expected (10% tollerance)', 'test avarage'))
+    # axs.legend(handles=(l0, l1, l3, l2, l4), labels=('full test datapoints', 't_log datapoints', 'avarage', 'SDO','scipy.odr'))
+    lgnd = axs.legend(handles=(l0, l1, l3, l3c, l3b, l2, l4, l5), labels=('full test datapoints', 't_log datapoints', 't_log w/ rising current only', 't_log w/ falling current only', 'avarage', 'SDO', 'scipy.ord (linear)','scipy.ord (poly2)'))
+    for handle in lgnd.legendHandles:
+        handle._legmarker.set_markersize(6)
+
+    axs.set_ylabel('Torque from loadcell reading (Nm)')
+    axs.set_xlabel('Current reference (A)')
+    plt_max = np.ptp(i_ref) * 0.05
+    axs.set_xlim(np.min(i_ref)-plt_max, np.max(i_ref)+plt_max)
+    #plt.ticklabel_format(style='sci', axis='x', scilimits=(0,0))
+    plt_max = np.ptp(tor_cell) * 0.05
+    axs.set_ylim(np.min(tor_cell)-plt_max, max(np.max(tor_cell),np.max(i_ref)*torque_const)+plt_max)
+    axs.grid(b=True, which='major', axis='y', linestyle='-')
+    axs.grid(b=True, which='minor', axis='y', linestyle=':')
+    axs.grid(b=True, which='major', axis='x', linestyle=':')
+    axs.spines['top'].set_visible(False)
+    axs.spines['right'].set_visible(False)
+    axs.spines['left'].set_visible(False)
+    axs.spines['bottom'].set_visible(False)
 
+    # Save the graph
+    plt.savefig(fname=fig_name, format='png', bbox_inches='tight')
+    print('[i] Saved graph as: ' + fig_name)
 
-def process(yaml_file, plot_all=False):
+
+def process(yaml_file, plot_all=False, use_cache=True):
     plt.rcParams['savefig.dpi'] = 300
 
     # read parameters from yaml file
@@ -68,74 +322,40 @@ def process(yaml_file, plot_all=False):
     print('[i] Reading log_file: ' + log_file)
 
     # log format: '%u64\t%u\t%f\t%f\t%f\t%f\t%f\t%f'
-    ns_        = [np.uint64(x.split('\t')[0]) for x in open(log_file).readlines()]
-    stationary = [np.uint32(x.split('\t')[1]) for x in open(log_file).readlines()]
-    tor_cell_  = [    float(x.split('\t')[2]) for x in open(log_file).readlines()]
-    tor_motor_ = [    float(x.split('\t')[3]) for x in open(log_file).readlines()]
-    pos_link   = [    float(x.split('\t')[4]) for x in open(log_file).readlines()]
-    pos_motor  = [    float(x.split('\t')[5]) for x in open(log_file).readlines()]
-    i_ref_     = [    float(x.split('\t')[6]) for x in open(log_file).readlines()]
-    i_fb_      = [    float(x.split('\t')[7]) for x in open(log_file).readlines()]
+    log = log_utils.load_log(log_file, 'torque-calib', use_cache=use_cache)
+    ns_        = log['ns']
+    stationary = log['stationary']
+    tor_cell_  = log['tor_cell']
+    tor_motor_ = log['tor_motor']
+    pos_link   = log['pos_link']
+    pos_motor  = log['pos_motor']
+    i_ref_     = log['i_ref']
+    i_fb_      = log['i_fb']
 
     print('loaded ',len(ns_), ' points')
 
     print('[i] Processing data')
     # Plot current, mototr torque and loadcell torque oveer the all experiment ---------------------------------------------------------------------------
-    fig, axs = plt.subplots()
-    l0, = axs.plot(ns_, [i*torque_const for i in i_fb_], color='#8e8e8e', marker='.', markersize=0.5, linestyle='')
-    l1, = axs.plot(ns_, [i*torque_const for i in i_ref_], color='#000000', marker='.', markersize=0.5, linestyle='')
-    l2, = axs.plot(ns_, tor_motor_, color='#1f77b4',marker='.', markersize=0.5, linestyle='')
-    l3, = axs.plot(ns_, tor_cell_, color='#ff7f0e',marker='.', markersize=0.5, linestyle='')
-
-    axs.set_ylabel('Torque (Nm)')
-    axs.set_xlabel('Time (ns)')
-    plt_max = (max(ns_) -min(ns_)) * 0.05
-    axs.set_xlim(min(ns_)-plt_max, max(ns_)+plt_max)
-    plt.ticklabel_format(style='sci', axis='x', scilimits=(0,0))
-    axs.set_ylim(min([i*torque_const for i in i_fb_]), max([i*torque_const for i in i_fb_]))
-    axs.grid(b=True, which='major', axis='y', linestyle='-')
-    axs.grid(b=True, which='minor', axis='y', linestyle=':')
-    axs.grid(b=True, which='major', axis='x', linestyle=':')
-    axs.spines['top'].set_visible(False)
-    axs.spines['right'].set_visible(False)
-    axs.spines['left'].set_visible(False)
-    lgnd = axs.legend(handles=(l0,l1,l2,l3), labels=('i_fb', 'i_ref','tor_motor','tor_loadcell'))
-    for handle in lgnd.legendHandles:
-        handle._legmarker.set_markersize(6)
-    plt.ticklabel_format(style='sci', axis='x', scilimits=(0,0))
-    if plot_all:
-        plt.show()
-
-    # Save the graph
     fig_name = image_base_path + '1.png'
-    plt.savefig(fname=fig_name, format='png', bbox_inches='tight')
-    print('[i] Saved graph as: ' + fig_name)
+    plot_utils.render(plot_currents, ns_, i_fb_, i_ref_, tor_motor_, tor_cell_, torque_const, fig_name=fig_name, show=plot_all)
 
 
     # Torsion_bar_stiff: torque read from the loadcell vs the motor's torque cell deflexion --------------------------------------------------------------
-    tor_motor=[tor_motor_[v] for v in range(0,len(ns_)) if stationary[v]]
-    tor_cell=[tor_cell_[v] for v in range(0,len(ns_)) if stationary[v]]
-    ns=[ns_[v] for v in range(0,len(ns_)) if stationary[v]]
-    tor_cell_np = np.array(tor_cell)
-    tor_displ = np.array([t/Torsion_bar_stiff for t in tor_motor]).reshape((-1, 1))
-    tor_SDO = [Torsion_bar_stiff*t+tor_cell[0]-tor_motor[0] for t in tor_displ]
+    is_stationary = stationary.astype(bool)
+    tor_motor = tor_motor_[is_stationary]
+    tor_cell = tor_cell_[is_stationary]
+    ns = ns_[is_stationary]
+    tor_displ = (tor_motor/Torsion_bar_stiff).reshape((-1, 1))
+    tor_SDO = Torsion_bar_stiff*tor_displ[:, 0]+tor_cell[0]-tor_motor[0]
 
     model = LinearRegression().fit(tor_displ,tor_cell)
     r_sq = model.score(tor_displ,tor_cell)
     tor_linear = model.predict(tor_displ)
 
-    def linear_func(p, x):
-        m, c = p
-        return m*x + c
-
-    odr_linear = odr.Model(linear_func)
-    tor_x = [t/Torsion_bar_stiff for t in tor_motor]
-    sx=statistics.stdev(tor_x)
-    sy=statistics.stdev(tor_cell)
-    odr_data = odr.RealData(np.array(tor_x), tor_cell_np, sx=sx, sy=sy)
-    odr_obj = odr.ODR(odr_data, odr_linear, beta0=[Torsion_bar_stiff, tor_cell[0]-tor_motor[0]])
-    odr_out = odr_obj.run()
-    tor_odr = [linear_func(odr_out.beta,x) for x in tor_x]
+    tor_x = tor_displ[:, 0]
+    odr_out = odr_fit(linear_func, tor_x, tor_cell, beta0=[Torsion_bar_stiff, tor_cell[0]-tor_motor[0]])
+    tor_odr = linear_func(odr_out.beta, tor_x)
+    stiff_beta = odr_out.beta
 
     # store results
     RESULT = []
@@ -144,9 +364,9 @@ def process(yaml_file, plot_all=False):
     RESULT.append(odr_out.beta[0])
     #compute Root Mean Squared Error
     NRMSE=[]
-    NRMSE.append(np.sqrt(np.mean(np.square([tor_cell[v] - tor_SDO[v] for v in range(0,len(tor_displ))])))/(max(tor_cell)-min(tor_cell)))
-    NRMSE.append(np.sqrt(np.mean(np.square([tor_cell[v] - tor_linear[v] for v in range(0,len(tor_displ))])))/(max(tor_cell)-min(tor_cell)))
-    NRMSE.append(np.sqrt(np.mean(np.square([tor_cell[v] - tor_odr[v] for v in range(0,len(tor_displ))])))/(max(tor_cell)-min(tor_cell)))
+    NRMSE.append(metrics_utils.nrmse(tor_cell, tor_SDO))
+    NRMSE.append(metrics_utils.nrmse(tor_cell, tor_linear))
+    NRMSE.append(metrics_utils.nrmse(tor_cell, tor_odr))
     #RMSE =[v/min(RMSE) for v in RMSE]
 
     print('SDO                    :{:.3f}\tNRMSE:{:.5f}'.format(RESULT[0], NRMSE[0]))
@@ -154,52 +374,15 @@ def process(yaml_file, plot_all=False):
     print('scipy.ord (linear)     :{:.3f}\tNRMSE:{:.5f}'.format(RESULT[2], NRMSE[2]))
 
     ## plot
-    fig, axs = plt.subplots()
-    axs.axhline(0, color='black', lw=1.2)
-    axs.axvline(0, color='black', lw=1.2)
-
-    l0, = axs.plot([t/Torsion_bar_stiff for t in tor_motor_], tor_cell_, color='#8e8e8e', marker='.', markersize=0.5, linestyle='')
-    l1, = axs.plot(tor_displ, tor_cell, color='#000000', marker='.', markersize=0.5, linestyle='')
-    #axs.legend(handles=(l1, l2), labels=('full test','t_log only'))
-    # l1, = axs.plot(tor_displ, tor_cell, color='#8e8e8e', marker='.', markersize=0.5, linestyle='')
-    l2, = axs.plot(tor_displ,tor_SDO, color='#1f77b4', linestyle='-', linewidth=1)
-    # l3, = axs.plot(tor_displ, tor_linear, color='#ff7f0e', linestyle='-', linewidth=1)
-    # l4, = axs.plot(tor_displ, tor_odr, color='#2ca02c', linestyle='-', linewidth=1)
-    # axs.legend(handles=(l0, l1, l2, l3, l4), labels=('full test datapoints', 't_log datapoints', 'SDO', 'sklean.LinearRegression','scipy.odr'))
-    l3, = axs.plot(tor_displ, tor_odr, color='#ff7f0e', linestyle='-', linewidth=1)
-    lgnd= axs.legend(handles=(l0, l1, l2, l3), labels=('full test datapoints', 't_log datapoints', 'SDO','Total least squares'))
-    for handle in lgnd.legendHandles:
-        handle._legmarker.set_markersize(6)
-
-    axs.set_ylabel('Torque from loadcell reading (Nm)')
-    axs.set_xlabel('Motor torque sensor displacement (rad)')
-    plt_max = (max(tor_displ) -min(tor_displ)) * 0.05
-    axs.set_xlim(min(tor_displ)-plt_max, max(tor_displ)+plt_max)
-    plt.ticklabel_format(style='sci', axis='x', scilimits=(0,0))
-    plt_max = (max(tor_cell) -min(tor_cell)) * 0.05
-    axs.set_ylim(min(tor_cell)-plt_max, max(tor_cell)+plt_max)
-    axs.grid(b=True, which='major', axis='y', linestyle='-')
-    axs.grid(b=True, which='minor', axis='y', linestyle=':')
-    axs.grid(b=True, which='major', axis='x', linestyle=':')
-    axs.spines['top'].set_visible(False)
-    axs.spines['right'].set_visible(False)
-    axs.spines['left'].set_visible(False)
-    axs.spines['bottom'].set_visible(False)
-
-    if plot_all:
-        plt.show()
+    fig_name = image_base_path + '2.png'
+    plot_utils.render(plot_stiffness, tor_motor_, tor_cell_, tor_x, tor_cell, tor_SDO, tor_odr, Torsion_bar_stiff,
+                      fig_name=fig_name, show=plot_all)
 
     # we desided to keep only the result of ODR
     Torsion_bar_stiff=RESULT[2]
     Torsion_bar_stiff_NRMSE=NRMSE[2]
     print(plot_utils.bcolors.OKGREEN + u'[\u2713] Result: Torsion_bar_stiff = ' + str(Torsion_bar_stiff) + plot_utils.bcolors.ENDC)
 
-
-    # Save the graph
-    fig_name = image_base_path + '2.png'
-    plt.savefig(fname=fig_name, format='png', bbox_inches='tight')
-    print('[i] Saved graph as: ' + fig_name)
-
     # Save result ------------------------------------------------------------------------------------------
     if 'name' in out_dict['log']:
         yaml_name = yaml_file
@@ -220,62 +403,63 @@ def process(yaml_file, plot_all=False):
 
 
     # Plot current vs loadcell torque over the all experiment --------------------------------------------------------------------------------------------
-    i_ref = [i_ref_[v] for v in range(0,len(i_ref_)) if stationary[v]]
-    #i_steps = list(dict.fromkeys(i_ref))
+    i_ref = i_ref_[is_stationary]
 
     # find avarage torque for a ginve current ref
-    i_steps = []
-    i_reps = []
-    tor_avar = []
-    for t,i in zip(tor_cell,i_ref):
-        i=round(i,2)
-        if i not in i_steps:
-            i_steps.append(i)
-            i_reps.append(1)
-            tor_avar.append(t)
-        else:
-            tor_avar[i_steps.index(i)] += t
-            i_reps[i_steps.index(i)] += 1
-    tor_avar = [t/i for t,i in zip(tor_avar, i_reps)]
-    tor_SDO = [i*torque_const + tor_avar[0] for i in i_steps]
-
-    # get values only for rising current
-    i_rising = []
-    t_rising = []
-    rising = True
-    for i in range(1,len(i_ref)):
-        if i_ref[i] < i_ref[i-1]:
-            rising = False
-        elif i_ref[i] == 0.0:
-            rising= True
-
-        if rising:
-            i_rising.append(i_ref[i])
-            t_rising.append(tor_cell[i])
-
-    tor_SDO_rising=[i*torque_const + tor_avar[0] for i in i_rising]
-    efficiency = [100*t1/t2 for t1, t2 in zip(t_rising,tor_SDO_rising) if t2 > 0]
-    i_plot = [i for i, t2 in zip(i_rising,tor_SDO_rising) if t2 > 0]
-
-
-    odr_linear = odr.Model(linear_func)
-    sx=statistics.stdev(i_rising)
-    sy=statistics.stdev(t_rising)
-    odr_data = odr.RealData(np.array(i_rising), np.array(t_rising), sx=sx, sy=sy)
-    odr_obj = odr.ODR(odr_data, odr_linear, beta0=[torque_const,tor_avar[0]])
-    odr_out = odr_obj.run()
-    tor_odr = [linear_func(odr_out.beta,x) for x in i_rising]
-
-    def poly2_func(p, x):
-        a, b, c = p
-        return a*x*x + b*x + c
-    odr_linear = odr.Model(poly2_func)
-    sx=statistics.stdev(i_rising)
-    sy=statistics.stdev(t_rising)
-    odr_data = odr.RealData(np.array(i_rising), np.array(t_rising), sx=sx, sy=sy)
-    odr_obj = odr.ODR(odr_data, odr_linear, beta0=[-1,-max(i_steps),-max(tor_avar)])
-    odr_out2 = odr_obj.run()
-    tor_odr2 = [poly2_func(odr_out2.beta,x) for x in i_rising]
+    i_steps, tor_avar, tor_std, i_reps = average_steps(i_ref, tor_cell)
+    tor_SDO = i_steps*torque_const + tor_avar[0]
+
+    # split rising and falling current: the gap between the two branches is the hysteresis (e.g. gearbox backlash)
+    rising, ramp = hysteresis_branches(i_ref)
+    i_rising = i_ref[rising]
+    t_rising = tor_cell[rising]
+    i_falling = i_ref[~rising]
+    t_falling = tor_cell[~rising]
+
+    if len(np.unique(np.round(i_rising, 2))) < 2:
+        raise Exception('not enough rising current steps to fit the motor torque constant')
+    tor_SDO_rising = i_rising*torque_const + tor_avar[0]
+
+    odr_out = odr_fit(linear_func, i_rising, t_rising, beta0=[torque_const,tor_avar[0]])
+    tor_odr = linear_func(odr_out.beta, i_rising)
+
+    odr_out2 = odr_fit(poly2_func, i_rising, t_rising, beta0=[-1,-np.max(i_steps),-np.max(tor_avar)])
+    tor_odr2 = poly2_func(odr_out2.beta, i_rising)
+
+    # a test without falling current (or a single falling step) has no falling branch to fit
+    odr_falling = None
+    if len(np.unique(np.round(i_falling, 2))) >= 2:
+        odr_falling = odr_fit(linear_func, i_falling, t_falling, beta0=odr_out.beta)
+        tor_odr_falling = linear_func(odr_falling.beta, i_falling)
+    hyst_steps, hyst_width = hysteresis_width(i_ref, tor_cell, rising)
+    # a ramp is a run of rising current up from zero (the samples back at zero after a ramp are rising too)
+    num_ramps = len(np.unique(ramp[rising & (i_ref != 0)]))
+
+    # confidence intervals of the stiffness and of the torque constant: block bootstrap over the current steps
+    boot_samples = 200
+    boot_time = 10.
+    boot_confidence = 0.95
+    if 'calib_torque' in out_dict:
+        if 'bootstrap_samples' in out_dict['calib_torque']:
+            boot_samples = int(out_dict['calib_torque']['bootstrap_samples'])
+        if 'bootstrap_time' in out_dict['calib_torque']:
+            boot_time = float(out_dict['calib_torque']['bootstrap_time'])
+        if 'bootstrap_confidence' in out_dict['calib_torque']:
+            boot_confidence = float(out_dict['calib_torque']['bootstrap_confidence'])
+    if boot_samples > 0:
+        i_round = np.round(i_ref, 2)
+        steps = segment_utils.Segments.from_bounds(np.union1d(
+            np.concatenate(([0], segment_utils.changes(i_round), [len(i_ref)])), segment_utils.changes(ramp)))
+        t_boot = time.monotonic()
+        boot = bootstrap_slopes({'Torsion_bar_stiff': (tor_x, tor_cell, steps, stiff_beta),
+                                 'motor_torque_contstant': (i_ref, tor_cell, steps[rising[steps.starts]], odr_out.beta)},
+                                samples=boot_samples, time_budget=boot_time, confidence=boot_confidence)
+        t_boot = time.monotonic() - t_boot
+        for name, (ci, n) in boot.items():
+            if ci is None:
+                print(f'[!] {name}: only {n} bootstrap refits, no confidence interval')
+            else:
+                print(f'{name}: {100*boot_confidence:.0f}% CI [{ci[0]:.4f}, {ci[1]:.4f}] from {n} refits')
 
     # store results
     RESULT = []
@@ -284,65 +468,30 @@ def process(yaml_file, plot_all=False):
     RESULT.append(odr_out2.beta[0])
     #compute Root Mean Squared Error
     NRMSE=[]
-    NRMSE.append(np.sqrt(np.mean(np.square([t_rising[v] - tor_SDO_rising[v] for v in range(0,len(i_rising))])))/(max(t_rising)-min(t_rising)))
-    NRMSE.append(np.sqrt(np.mean(np.square([t_rising[v] - tor_odr[v]  for v in range(0,len(i_rising))])))/(max(t_rising)-min(t_rising)))
-    NRMSE.append(np.sqrt(np.mean(np.square([t_rising[v] - tor_odr2[v] for v in range(0,len(i_rising))])))/(max(t_rising)-min(t_rising)))
+    NRMSE.append(metrics_utils.nrmse(t_rising, tor_SDO_rising))
+    NRMSE.append(metrics_utils.nrmse(t_rising, tor_odr))
+    NRMSE.append(metrics_utils.nrmse(t_rising, tor_odr2))
+    NRMSE_falling = None
+    if odr_falling is not None:
+        NRMSE_falling = metrics_utils.nrmse(t_falling, tor_odr_falling)
     #RMSE =[v/min(RMSE) for v in RMSE]
 
     print('SDO                :{:.2f}  {:.2f}  \t NRMSE:{:.5f}'.format(torque_const, tor_avar[0], NRMSE[0]))
     print('scipy.ord (linear) :{:.2f}  {:.2f}  \t NRMSE:{:.5f}'.format(odr_out.beta[0], odr_out.beta[1], NRMSE[1]))
     print('scipy.ord (poly2)  :{:.2f}  {:.2f}  {:.2f}\t NRMSE:{:.5f}'.format(odr_out2.beta[0], odr_out2.beta[1], odr_out2.beta[2], NRMSE[2]))
+    if odr_falling is not None:
+        print('falling, ord (lin.):{:.2f}  {:.2f}  \t NRMSE:{:.5f}'.format(odr_falling.beta[0], odr_falling.beta[1], NRMSE_falling))
+    else:
+        print('[!] falling, ord (lin.): not enough falling current steps to fit')
+    if len(hyst_steps):
+        print('hysteresis width   :{:.4f} Nm (max {:.4f} Nm) over {} steps, {} ramps'.format(np.mean(hyst_width), np.max(np.abs(hyst_width)), len(hyst_steps), num_ramps))
+    else:
+        print('[!] hysteresis width: no current step on both branches, {} ramps'.format(num_ramps))
 
 
-    fig, axs = plt.subplots()
-    axs.axhline(0, color='black', lw=1.0)
-    axs.axvline(0, color='black', lw=1.0)
-
-    #l0, = axs.plot(i_fb_, [i*torque_const for i in i_fb_], color='#8e8e8e', marker='.', markersize=0.5, linestyle='')
-    l0, = axs.plot(i_ref_, tor_cell_, color='#8e8e8e', marker='.', markersize=0.5, linestyle='')
-    l1, = axs.plot(i_ref, tor_cell, color='#000000', marker='.', markersize=0.5, linestyle='')
-    l2, = axs.plot(i_steps, tor_SDO, color='#1f77b4', marker='.', markersize=3.0, linestyle='-', alpha=0.5)
-    for i,t in zip(i_steps, tor_SDO):
-        axs.plot([i, i], [t*0.9, t*1.1], color='#1f77b4', alpha=0.2, marker='', linestyle='-')
-    #axs.fill_between(i_ref, [t*0.9 for t in tor_SDO], [t*1.1 for t in tor_SDO], color='#ff7f0e', alpha=0.2, interpolate=True)
-    # axs.plot(i_steps, tor_avar, color='#1f77b4', marker='', linestyle='--', alpha=0.5)
-
-
-    # l1, = axs.plot(i_ref_, [i*torque_const for i in i_ref_], color='#000000', marker='.', markersize=0.5, linestyle='')
-    # l1, = axs.plot(i_ref, [i*torque_const for i in i_ref], color='#000000', marker='.', markersize=0.5, linestyle='')
-    # l1, = axs.plot(i_ref, tor_cell, color='#8e8e8e', marker='.', markersize=0.5, linestyle='')
-    # l2 = axs.plot(i_ref, tor_SDO, color='#1f77b4', linestyle='-', linewidth=1)
-    # l3, = axs.plot(i_ref, tor_linear, color='#ff7f0e', linestyle='-', linewidth=1)
-    # l4, = axs.plot(i_steps, tor_odr, color='#2ca02c', linestyle='--', linewidth=1, alpha=0.5)
-    l3, = axs.plot(i_rising, t_rising, color='#ff0000', marker='.', markersize=0.5, linestyle='')
-    l3b,= axs.plot(i_steps, tor_avar, color='#005794', marker='.', markersize=3.0, linestyle='')
-    l4, = axs.plot(i_steps, [linear_func(odr_out.beta,x) for x in i_steps], color='#ff7f0e', marker='.', markersize=3.0, linestyle='-', alpha=0.5)
-    l5, = axs.plot(i_steps, [poly2_func(odr_out2.beta,x) for x in i_steps], color='#2ca02c', marker='.', markersize=3.0, linestyle='-', alpha=0.5)
-    # axs.legend(handles=(l0, l1, l2, l3), labels=('full test datapoints', 't_log datapoints', 'expected (10% tollerance)', 'test avarage'))
-    # axs.legend(handles=(l0, l1, l3, l2, l4), labels=('full test datapoints', 't_log datapoints', 'avarage', 'SDO','scipy.odr'))
-    lgnd = axs.legend(handles=(l0, l1, l3, l3b, l2, l4, l5), labels=('full test datapoints', 't_log datapoints', 't_log w/ rising current only', 'avarage', 'SDO', 'scipy.ord (linear)','scipy.ord (poly2)'))
-    for handle in lgnd.legendHandles:
-        handle._legmarker.set_markersize(6)
-
-    axs.set_ylabel('Torque from loadcell reading (Nm)')
-    axs.set_xlabel('Current reference (A)')
-    plt_max = (max(i_ref) -min(i_ref)) * 0.05
-    axs.set_xlim(min(i_ref)-plt_max, max(i_ref)+plt_max)
-    #plt.ticklabel_format(style='sci', axis='x', scilimits=(0,0))
-    plt_max = (max(tor_cell) -min(tor_cell)) * 0.05
-    axs.set_ylim(min(tor_cell)-plt_max, max(max(tor_cell),max(i_ref)*torque_const)+plt_max)
-    axs.grid(b=True, which='major', axis='y', linestyle='-')
-    axs.grid(b=True, which='minor', axis='y', linestyle=':')
-    axs.grid(b=True, which='major', axis='x', linestyle=':')
-    axs.spines['top'].set_visible(False)
-    axs.spines['right'].set_visible(False)
-    axs.spines['left'].set_visible(False)
-    axs.spines['bottom'].set_visible(False)
-
-    # Save the graph
     fig_name = image_base_path + '3.png'
-    plt.savefig(fname=fig_name, format='png', bbox_inches='tight')
-    print('[i] Saved graph as: ' + fig_name)
+    plot_utils.render(plot_torque_constant, i_ref_, tor_cell_, i_ref, tor_cell, i_steps, tor_SDO, tor_avar, i_rising, t_rising,
+                      i_falling, t_falling, odr_out.beta, odr_out2.beta, torque_const, fig_name=fig_name)
 
     # Save result ------------------------------------------------------------------------------------------
 
@@ -361,40 +510,42 @@ def process(yaml_file, plot_all=False):
     out_dict['results']['torque']['motor_torque_contstant']['ord_poly2']['c'] = float(odr_out2.beta[2])
     out_dict['results']['torque']['motor_torque_contstant']['ord_poly2']['NRMSE'] = float(NRMSE[2])
 
+    if boot_samples > 0:
+        out_dict['results']['torque']['bootstrap'] = {}
+        out_dict['results']['torque']['bootstrap']['confidence'] = boot_confidence
+        out_dict['results']['torque']['bootstrap']['time'] = float(t_boot)
+        for name, (ci, n) in boot.items():
+            out_dict['results']['torque']['bootstrap'][name] = {}
+            out_dict['results']['torque']['bootstrap'][name]['CI'] = ci
+            out_dict['results']['torque']['bootstrap'][name]['samples'] = n
+
+    out_dict['results']['torque']['hysteresis'] = {}
+    out_dict['results']['torque']['hysteresis']['falling_ord_linear'] = None
+    if odr_falling is not None:
+        out_dict['results']['torque']['hysteresis']['falling_ord_linear'] = {}
+        out_dict['results']['torque']['hysteresis']['falling_ord_linear']['a'] = float(odr_falling.beta[0])
+        out_dict['results']['torque']['hysteresis']['falling_ord_linear']['b'] = float(odr_falling.beta[1])
+        out_dict['results']['torque']['hysteresis']['falling_ord_linear']['NRMSE'] = float(NRMSE_falling)
+    out_dict['results']['torque']['hysteresis']['width_mean'] = None
+    out_dict['results']['torque']['hysteresis']['width_max'] = None
+    if len(hyst_steps):
+        out_dict['results']['torque']['hysteresis']['width_mean'] = float(np.mean(hyst_width))
+        out_dict['results']['torque']['hysteresis']['width_max'] = float(np.max(np.abs(hyst_width)))
+    out_dict['results']['torque']['hysteresis']['num_ramps'] = num_ramps
+    out_dict['results']['torque']['hysteresis']['steps'] = hyst_steps.tolist()
+    out_dict['results']['torque']['hysteresis']['width'] = hyst_width.tolist()
+
+    out_dict['results']['torque']['steps'] = {}
+    out_dict['results']['torque']['steps']['i_ref'] = i_steps.tolist()
+    out_dict['results']['torque']['steps']['tor_mean'] = tor_avar.tolist()
+    out_dict['results']['torque']['steps']['tor_std'] = tor_std.tolist()
+    out_dict['results']['torque']['steps']['count'] = i_reps.tolist()
 
-    #-----------------------------------------------------------------------------------
-
-    fig, axs = plt.subplots()
-    axs.axhline(0, color='black', lw=1.2)
-    axs.axvline(0, color='black', lw=1.2)
-
-    l0, = axs.plot(i_plot, efficiency, color='#ff7f0e', marker='.', markersize=3.0, linestyle='')
-
-    #axs.set_ylabel('Static Efficiency (%)')
-    axs.set_ylabel('Red dots / Orange dots (%)')
-    axs.set_xlabel('Current reference (A)')
-    plt_max = (max(i_ref) -min(i_ref)) * 0.05
-    axs.set_xlim(min(i_ref)-plt_max, max(i_ref)+plt_max)
-    #plt.ticklabel_format(style='sci', axis='x', scilimits=(0,0))
-    #plt_max = (max(tor_cell) -min(tor_cell)) * 0.05
-    #axs.set_ylim(min(tor_cell)-plt_max, max(max(tor_cell),max(i_ref)*torque_const)+plt_max)
-    axs.grid(b=True, which='major', axis='y', linestyle='-')
-    axs.grid(b=True, which='minor', axis='y', linestyle=':')
-    axs.grid(b=True, which='major', axis='x', linestyle=':')
-    axs.spines['top'].set_visible(False)
-    axs.spines['right'].set_visible(False)
-    axs.spines['left'].set_visible(False)
-    axs.spines['bottom'].set_visible(False)
-
-    # Save the graph
-    fig_name = image_base_path + '4.png'
-    # plt.savefig(fname=fig_name, format='png', bbox_inches='tight')
-    # print('[i] Saved graph as: ' + fig_name)
 
+    #-----------------------------------------------------------------------------------
 
     print('Saving results to: ' + yaml_name)
-    with open(yaml_name, 'w', encoding='utf8') as outfile:
-        yaml.dump(out_dict, outfile, default_flow_style=False, allow_unicode=True)
+    log_utils.save_yaml(yaml_name, out_dict)
     return yaml_name
 
 if __name__ == "__main__":
@@ -403,5 +554,6 @@ if __name__ == "__main__":
 
     print(plot_utils.bcolors.OKBLUE + "[i] Starting process_torque" + plot_utils.bcolors.ENDC)
     yaml_file = process(yaml_file=sys.argv[1], plot_all=False)
+    plot_utils.flush()
 
     print(plot_utils.bcolors.OKGREEN + u'[\u2713] Ending program successfully' + plot_utils.bcolors.ENDC)
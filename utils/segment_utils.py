@@ -0,0 +1,123 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Split log columns in segments (trajectories, steps, loops) from their counters, without python loops"""
+
+import numpy as np
+
+
+def changes(counter):
+    '''Indices where counter differs from the previous sample'''
+    counter = np.asarray(counter)
+    return np.flatnonzero(counter[1:] != counter[:-1]) + 1
+
+
+class Segments:
+    '''Ragged view of the log: segment i covers the samples starts[i]:ends[i] of every column.
+    Segments only hold the boundaries, so the same object splits and reduces any column of the log'''
+
+    def __init__(self, starts, ends):
+        self.starts = np.asarray(starts, dtype=np.intp)
+        self.ends = np.asarray(ends, dtype=np.intp)
+        if self.starts.shape != self.ends.shape or np.any(self.ends < self.starts):
+            raise Exception('segments need one end per start, not before it')
+
+    @classmethod
+    def from_bounds(cls, bounds):
+        '''Consecutive segments bounds[i]:bounds[i+1]'''
+        bounds = np.asarray(bounds, dtype=np.intp)
+        return cls(bounds[:-1], bounds[1:])
+
+    @classmethod
+    def from_changes(cls, counter):
+        '''One segment for each run of equal values of counter'''
+        return cls.from_bounds(np.concatenate(([0], changes(counter), [len(counter)])))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, key):
+        '''Subset of the segments (slice, index array or boolean mask)'''
+        return Segments(self.starts[key], self.ends[key])
+
+    @property
+    def lengths(self):
+        return self.ends - self.starts
+
+    @property
+    def offsets(self):
+        '''Where each segment starts in the flat data returned by take'''
+        return np.concatenate(([0], np.cumsum(self.lengths)))
+
+    def first_half(self):
+        return Segments(self.starts, self.starts + self.lengths // 2)
+
+    def ids(self):
+        '''Segment of every sample of take'''
+        return np.repeat(np.arange(len(self)), self.lengths)
+
+    def indices(self):
+        '''Log index of every sample of take'''
+        return np.arange(np.sum(self.lengths)) + np.repeat(self.starts - self.offsets[:-1], self.lengths)
+
+    def mask(self):
+        '''(segments, longest segment) mask of the samples of pad'''
+        return np.arange(np.max(self.lengths, initial=0)) < self.lengths[:, None]
+
+    def pad(self, column, fill=0.):
+        '''2-D copy of the segments of column, one per row, padded with fill after their end'''
+        column = np.asarray(column)
+        mask = self.mask()
+        out = np.full(mask.shape, fill, dtype=np.result_type(column, type(fill)))
+        out[mask] = column[self.indices()]
+        return out
+
+    def unpad(self, padded, column):
+        '''Copy of column with the samples of the segments taken from padded (the inverse of pad)'''
+        out = np.array(column, dtype=np.result_type(column, padded))
+        out[self.indices()] = padded[self.mask()]
+        return out
+
+    def split(self, column):
+        '''List of the segments of column, as views (no copies)'''
+        return [column[s:e] for s, e in zip(self.starts, self.ends)]
+
+    def take(self, column):
+        '''Samples of all the segments of column, one after the other'''
+        return np.asarray(column)[self.indices()]
+
+    def reduce(self, ufunc, column, empty=np.nan, dtype=None):
+        '''ufunc.reduceat over each segment of column, empty for the segments with no samples'''
+        column = np.asarray(column)
+        if len(self) == 0:
+            return np.empty(0, dtype=dtype if dtype is not None else column.dtype)
+        # reduceat reduces between consecutive indices: interleave starts and ends and keep every other result
+        idx = np.empty(2 * len(self), dtype=np.intp)
+        idx[0::2] = self.starts
+        idx[1::2] = self.ends
+        if np.any(idx >= len(column)):
+            column = np.append(column, column[:1])
+        out = ufunc.reduceat(column, idx, dtype=dtype)[0::2]
+        if np.any(self.lengths == 0):
+            out = out.astype(np.result_type(out, type(empty)))
+            out[self.lengths == 0] = empty
+        return out
+
+    def sum(self, column):
+        column = np.asarray(column)
+        # integer columns (e.g. int16 velocities) are summed in int64 to not overflow
+        return self.reduce(np.add, column, empty=0, dtype=np.int64 if column.dtype.kind in 'biu' else None)
+
+    def mean(self, column):
+        return self.sum(np.asarray(column, dtype=float)) / self.lengths
+
+    def max(self, column):
+        return self.reduce(np.maximum, column)
+
+    def min(self, column):
+        return self.reduce(np.minimum, column)
+
+    def ptp(self, column):
+        column = np.asarray(column)
+        if column.dtype.kind in 'biu':
+            return self.max(column).astype(np.int64) - self.min(column)
+        return self.max(column) - self.min(column)
@@ -0,0 +1,73 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Fixed-step simulation of the motor model (friction + inertia) driven by the measured torque"""
+
+import numpy as np
+
+
+def velocity_grid(v_max, points=4000, v_min=1e-7):
+    '''Symmetric velocity grid, log-spaced so that the steep part of the friction around zero velocity is resolved'''
+    half = np.geomspace(v_min, v_max, points)
+    return np.concatenate((-half[::-1], [0.], half))
+
+
+def friction_table(friction, v_max, points=4000):
+    '''Tabulate the friction torque (a function of the velocity array) once, so the simulation only needs np.interp'''
+    v = velocity_grid(v_max, points)
+    return v, np.asarray(friction(v), dtype=float)
+
+
+def simulate(tau, pos, vel, samp_freq, inertia, friction, segments=1, substeps=1, points=4000):
+    '''Simulate inertia * acc = tau - friction(vel) over the samples of tau, returning the simulated position and velocity.
+    tau:       motor torque tau_m of every sample
+    pos, vel:  measured trajectory, only used for the initial conditions of the segments
+    friction:  friction torque as a function of a velocity array, tabulated once on a log-spaced grid
+    segments:  the trajectory is split in this many segments, each starting from the measured state,
+               and all of them are integrated at once (vectorized along the segments)
+    substeps:  integration steps per sample, with the torque linearly interpolated between samples
+
+    The friction around zero velocity is very steep (stiff ODE), so the velocity uses implicit Euler:
+    inertia * (v' - v) / dt + friction(v') = tau' is solved exactly by inverting the monotone table
+    of inertia * v / dt + friction(v). Position is integrated with the trapezoidal rule'''
+    tau = np.asarray(tau, dtype=float)
+    pos = np.asarray(pos, dtype=float)
+    vel = np.asarray(vel, dtype=float)
+    n = len(tau)
+    if n == 0:
+        return np.empty(0), np.empty(0)
+    if inertia <= 0:
+        raise Exception('the inertia must be positive to simulate the motor')
+    segments = max(1, min(int(segments), n))
+    substeps = max(1, int(substeps))
+    dt = 1. / (samp_freq * substeps)
+
+    # implicit Euler lookup: h(v) = inertia * v / dt + friction(v) is increasing for a dissipative friction
+    v_max = 10. * np.max(np.abs(vel)) + 10.
+    v_grid, f_grid = friction_table(friction, v_max, points)
+    h_grid = inertia * v_grid / dt + f_grid
+    if np.any(np.diff(h_grid) <= 0):
+        raise Exception('friction decreases too fast with the velocity for the fixed-step simulation, use more substeps')
+
+    # one row per segment, padded with the last torque sample; with n not a multiple of the length the last
+    # segments could start past the data, so only the segments that hold samples are kept
+    length = -(-n // segments)
+    segments = -(-n // length)
+    starts = np.arange(segments) * length
+    idx = np.minimum(starts[:, None] + np.arange(length + 1), n - 1)
+    tau_seg = tau[idx]
+
+    sim_pos = np.empty((segments, length))
+    sim_vel = np.empty((segments, length))
+    p = pos[starts].copy()
+    v = vel[starts].copy()
+    for k in range(length):
+        sim_pos[:, k] = p
+        sim_vel[:, k] = v
+        for s in range(substeps):
+            # torque at the end of the substep, interpolated between samples k and k+1
+            a = (s + 1) / substeps
+            t_next = (1. - a) * tau_seg[:, k] + a * tau_seg[:, k + 1]
+            v_next = np.interp(inertia * v / dt + t_next, h_grid, v_grid)
+            p = p + dt * (v + v_next) / 2.
+            v = v_next
+    return sim_pos.ravel()[:n], sim_vel.ravel()[:n]
@@ -0,0 +1,247 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Run the processing stages only when their inputs changed since the last run"""
+
+import os
+import yaml
+import hashlib
+import importlib
+
+# custom files
+try:
+    from utils import log_utils
+    from utils import plot_utils
+except ImportError:
+    import log_utils
+    import plot_utils
+
+# Stages in the order they are run. For each of them:
+#  logs:    the logs it processes
+#  inputs:  the yaml entries it reads ('a.b' stands for out_dict['a']['b'])
+#  outputs: the yaml entry (or the file, for the report) it writes
+# The outputs of a stage are part of the inputs of the ones using them, so a change
+# upstream also invalidates them (e.g. results.ripple.c for friction, everything for the report).
+STAGES = {
+    'phase': {
+        'logs':    ['phase-calib'],
+        'inputs':  ['calib_phase'],
+        'outputs': 'results.phase',
+    },
+    'torque': {
+        'logs':    ['torque-calib'],
+        'inputs':  ['calib_torque', 'results.flash_params'],
+        'outputs': 'results.torque',
+    },
+    'ripple': {
+        'logs':    ['ripple-calib'],
+        'inputs':  ['calib_ripple'],
+        'outputs': 'results.ripple',
+    },
+    'friction': {
+        'logs':    ['friction-calib', 'inertia-calib'],
+        'inputs':  ['calib_friction', 'calib_inertia', 'ec_board_ctrl', 'results.flash_params', 'results.ripple.c'],
+        'outputs': 'results.friction',
+    },
+    'frequency': {
+        'logs':    ['frequency-calib'],
+        'inputs':  ['calib_freq', 'results.flash_params'],
+        'outputs': 'results.frequency_response',
+    },
+    'report': {
+        'logs':    [],
+        'inputs':  ['log', 'calib_phase', 'calib_torque', 'calib_ripple', 'calib_friction', 'calib_inertia', 'calib_freq', 'results'],
+        'outputs': None,
+    },
+}
+
+
+def load_yaml(yaml_file):
+    with open(yaml_file) as f:
+        try:
+            return yaml.safe_load(f)
+        except Exception:
+            raise Exception('error in yaml parsing')
+
+
+def log_files(yaml_file, out_dict=None):
+    '''Path of every log of the calibration, with the same lookup done by the process_* stages'''
+    if out_dict is None:
+        out_dict = load_yaml(yaml_file)
+    log = out_dict.get('log', {}) if out_dict else {}
+
+    if 'location' in log:
+        head = log['location']
+    else:
+        head, _ = os.path.split(yaml_file)
+
+    if 'name' in log:
+        code_string = log['name']
+    else:
+        _, tail = os.path.split(yaml_file)
+        code_string = tail[:-len("_results.yaml")]
+
+    return {name: os.path.join(head, f'{code_string}_{name}.log')
+            for stage in STAGES.values() for name in stage['logs']}
+
+
+def report_file(yaml_file):
+    # same name used by process_report
+    return yaml_file[:-13] + '_report.pdf'
+
+
+def get_entry(out_dict, key):
+    '''out_dict['a']['b'] for key 'a.b', None if missing'''
+    for k in key.split('.'):
+        if not isinstance(out_dict, dict) or k not in out_dict:
+            return None
+        out_dict = out_dict[k]
+    return out_dict
+
+
+def set_entry(out_dict, key, value):
+    '''out_dict['a']['b'] = value for key 'a.b', adding the missing levels'''
+    keys = key.split('.')
+    for k in keys[:-1]:
+        if not isinstance(out_dict.get(k), dict):
+            out_dict[k] = {}
+        out_dict = out_dict[k]
+    out_dict[keys[-1]] = value
+
+
+def merge_outputs(stage, src_file, dst_file):
+    '''Copy the outputs of stage (and its fingerprint) from the yaml src_file into dst_file, replaced atomically'''
+    src = load_yaml(src_file)
+    dst = load_yaml(dst_file)
+    for key in (STAGES[stage]['outputs'], 'fingerprints.' + stage):
+        value = get_entry(src, key)
+        if value is not None:
+            set_entry(dst, key, value)
+    log_utils.save_yaml(dst_file, dst)
+
+
+def process_copy(process, yaml_file, earlier=(), **kwargs):
+    '''process(yaml_file=yaml_file, **kwargs) on a copy of the results yaml, e.g. in the background while a test
+    writes the original. The outputs of the (stage, copy) in earlier, processed before on their own copies and
+    not merged back yet, are merged in first. Returns once the figures are saved too'''
+    for stage, src_file in earlier:
+        merge_outputs(stage, src_file, yaml_file)
+    ret = process(yaml_file=yaml_file, **kwargs)
+    plot_utils.flush()
+    return ret
+
+
+def code_hash(module):
+    '''sha1 of the source of a stage module and of the custom modules it uses, so that changing the algorithm also invalidates its results'''
+    utils_dir = os.path.dirname(os.path.abspath(module.__file__))
+    files = {os.path.abspath(module.__file__)}
+    for v in vars(module).values():
+        f = getattr(v, '__file__', None)
+        if f is not None and os.path.dirname(os.path.abspath(f)) == utils_dir:
+            files.add(os.path.abspath(f))
+    h = hashlib.sha1()
+    for f in sorted(files):
+        h.update(os.path.basename(f).encode())
+        h.update(log_utils.file_hash(f).encode())
+    return h.hexdigest()
+
+
+def import_stage(stage):
+    try:
+        return importlib.import_module('utils.process_' + stage)
+    except ModuleNotFoundError as e:
+        if e.name != 'utils':
+            raise
+        return importlib.import_module('process_' + stage)
+
+
+def fingerprint(stage, yaml_file, out_dict=None):
+    '''Content hash of everything the stage reads: its logs, its yaml inputs and its code'''
+    if out_dict is None:
+        out_dict = load_yaml(yaml_file)
+    logs = log_files(yaml_file, out_dict)
+    module = import_stage(stage)
+
+    h = hashlib.sha1()
+    for name in STAGES[stage]['logs']:
+        h.update(name.encode())
+        h.update(log_utils.log_hash(logs[name]).encode())
+    for key in STAGES[stage]['inputs']:
+        h.update(key.encode())
+        h.update(yaml.safe_dump(get_entry(out_dict, key), sort_keys=True).encode())
+    h.update(code_hash(module).encode())
+    return h.hexdigest()
+
+
+def is_up_to_date(stage, yaml_file, out_dict=None, fp=None):
+    '''True if the stage already ran on the current inputs and its outputs are still there'''
+    if out_dict is None:
+        out_dict = load_yaml(yaml_file)
+    if fp is None:
+        fp = fingerprint(stage, yaml_file, out_dict)
+    if get_entry(out_dict, 'fingerprints.' + stage) != fp:
+        return False
+    if stage == 'report':
+        return os.path.isfile(report_file(yaml_file))
+    return get_entry(out_dict, STAGES[stage]['outputs']) is not None
+
+
+def save_fingerprint(stage, yaml_file, fp):
+    '''Record fp in the yaml the stage just wrote; the yaml is replaced atomically, never rewritten in place'''
+    out_dict = load_yaml(yaml_file)
+    if not 'fingerprints' in out_dict:
+        out_dict['fingerprints'] = {}
+    out_dict['fingerprints'][stage] = fp
+    log_utils.save_yaml(yaml_file, out_dict)
+
+
+def run_stage(stage, yaml_file, use_cache=True, force=False):
+    '''Run one stage on yaml_file, unless its inputs did not change since it last ran (or force is set).
+    Returns the (possibly moved) yaml file and whether the stage ran'''
+    if stage not in STAGES:
+        raise Exception(f"unknown stage '{stage}'")
+    out_dict = load_yaml(yaml_file)
+    fp = fingerprint(stage, yaml_file, out_dict)
+    if not force and is_up_to_date(stage, yaml_file, out_dict, fp):
+        print(f'[i] Skipping {stage}: inputs unchanged since last run')
+        return yaml_file, False
+
+    module = import_stage(stage)
+    if stage == 'report':
+        module.process(yaml_file=yaml_file)
+    elif stage == 'friction':
+        module.process(yaml_file=yaml_file, plot_all=False)
+    else:
+        ret = module.process(yaml_file=yaml_file, plot_all=False, use_cache=use_cache)
+        # phase, torque and ripple may move the results to the log location
+        if stage in ('phase', 'torque', 'ripple') and ret:
+            yaml_file = ret
+    save_fingerprint(stage, yaml_file, fp)
+    return yaml_file, True
+
+
+def process(yaml_file, stages=None, use_cache=True, force=False):
+    '''Run the given stages (default: all) in order, skipping the ones that are up to date'''
+    if stages is None:
+        stages = list(STAGES)
+    logs = log_files(yaml_file)
+    for stage in [s for s in STAGES if s in stages]:
+        missing = [logs[name] for name in STAGES[stage]['logs'] if not os.path.isfile(logs[name])]
+        if missing:
+            print('[i] Skipping ' + stage + ', missing: ' + ', '.join(missing))
+            continue
+        yaml_file, _ = run_stage(stage, yaml_file, use_cache=use_cache, force=force)
+    plot_utils.flush()
+    return yaml_file
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Process a calibration, re-running only the stages whose inputs changed")
+    parser.add_argument('yaml_file', type=str, help="the path of the calibration yaml file")
+    parser.add_argument('-s', '--stages', type=str, nargs='+', choices=list(STAGES), default=list(STAGES), help="the stages to run (default: all)")
+    parser.add_argument('-f', '--force', action='store_true', help="run the stages even if they are up to date")
+    args = parser.parse_args()
+
+    plot_utils.print_alberobotics()
+    process(yaml_file=args.yaml_file, stages=args.stages, force=args.force)
+    print(plot_utils.bcolors.OKGREEN + u'[✓] Ending program successfully' + plot_utils.bcolors.ENDC)